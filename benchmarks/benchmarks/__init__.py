@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------------------------
+# (C) British Crown Copyright 2017-2020 Met Office.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+# -----------------------------------------------------------------------------
+"""
+Benchmarks of CATNIP, run with airspeed velocity (asv), see the
+Benchmarks section of CONTRIBUTING.md.
+
+The benchmarks make synthetic cubes, rather than reading the test data,
+so that the sizes of the grids and the number of time steps can be set.
+"""
+
+import numpy as np
+import iris.coords
+import iris.coord_systems
+import iris.cube
+
+
+# global grids of the Unified Model, as (latitudes, longitudes)
+RESOLUTIONS = {"n96": (145, 192), "n216": (325, 432), "n512": (769, 1024)}
+
+CS = iris.coord_systems.GeogCS(6371229.0)
+
+
+def _cube(lats, lons, ntimes, circular=False):
+    """
+    Returns a cube of air temperature, of shape (ntimes, lats, lons), with a
+    smooth field plus some noise on the grid, and bounds on the grid.
+    """
+
+    time = iris.coords.DimCoord(
+        np.arange(ntimes) * 30.0 + 15.0,
+        standard_name="time",
+        units="days since 2000-01-01",
+    )
+    lat = iris.coords.DimCoord(
+        lats, standard_name="latitude", units="degrees", coord_system=CS
+    )
+    lon = iris.coords.DimCoord(
+        lons,
+        standard_name="longitude",
+        units="degrees",
+        coord_system=CS,
+        circular=circular,
+    )
+    lat.guess_bounds()
+    lon.guess_bounds()
+    lat.bounds = np.clip(lat.bounds, -90.0, 90.0)
+
+    rng = np.random.RandomState(0)
+    field = 280.0 + 20.0 * np.cos(np.radians(lats))[:, np.newaxis]
+    field = field + 5.0 * np.sin(np.radians(2.0 * lons))[np.newaxis, :]
+    noise = rng.standard_normal((ntimes, len(lats), len(lons)))
+    data = (field[np.newaxis] + noise).astype(np.float32)
+
+    return iris.cube.Cube(
+        data,
+        standard_name="air_temperature",
+        units="K",
+        dim_coords_and_dims=[(time, 0), (lat, 1), (lon, 2)],
+    )
+
+
+def global_cube(resolution, ntimes=1):
+    """
+    Returns a cube with ntimes time steps on the regular global grid of
+    resolution, one of RESOLUTIONS.
+    """
+
+    ny, nx = RESOLUTIONS[resolution]
+    lats = np.linspace(-90.0, 90.0, ny)
+    lons = np.arange(nx) * 360.0 / nx
+
+    return _cube(lats, lons, ntimes, circular=True)
+
+
+def regional_cube(ntimes=1, res=0.22):
+    """
+    Returns a cube on a regular lat-lon grid over Europe, of about the
+    resolution of a regional model, crossing the Greenwich meridian.
+    """
+
+    lats = np.arange(30.0, 70.0, res)
+    lons = np.arange(-20.0, 40.0, res)
+
+    return _cube(lats, lons, ntimes)
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------------------------
+# (C) British Crown Copyright 2017-2020 Met Office.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+# -----------------------------------------------------------------------------
+"""
+Benchmarks of regridding with regrid_to_target and set_regridder, from
+global grids of several resolutions onto a regional grid.
+"""
+
+from catnip.analysis import regrid_cache_clear, regrid_to_target, set_regridder
+
+from . import RESOLUTIONS, global_cube, regional_cube
+
+
+METHODS = ["linear", "nearest", "areaweighted"]
+
+
+class SetRegridder:
+    """Setting up a regridder, which works out the weights."""
+
+    params = [METHODS, list(RESOLUTIONS)]
+    param_names = ["method", "resolution"]
+    timeout = 600
+
+    def setup(self, method, resolution):
+        self.source = global_cube(resolution)
+        self.target = regional_cube()
+
+    def time_set_regridder(self, method, resolution):
+        set_regridder(self.source, self.target, method)
+
+    def time_regrid_to_target_first(self, method, resolution):
+        # with an empty cache, regrid_to_target works out the weights
+        regrid_cache_clear()
+        regrid_to_target(self.source, self.target, method)
+
+    def peakmem_regrid_to_target_first(self, method, resolution):
+        regrid_cache_clear()
+        regrid_to_target(self.source, self.target, method)
+
+
+class ApplyRegridder:
+    """Regridding cubes with many time steps, once the weights are known."""
+
+    params = [METHODS, list(RESOLUTIONS), [1, 12, 120]]
+    param_names = ["method", "resolution", "time steps"]
+    timeout = 600
+
+    def setup(self, method, resolution, ntimes):
+        self.source = global_cube(resolution, ntimes)
+        self.target = regional_cube()
+        self.regridder = set_regridder(self.source, self.target, method)
+
+        # fill the cache of regrid_to_target, from a single time step
+        regrid_cache_clear()
+        regrid_to_target(self.source[0], self.target, method)
+
+    def time_set_regridder_apply(self, method, resolution, ntimes):
+        self.regridder(self.source)
+
+    def time_regrid_to_target(self, method, resolution, ntimes):
+        regrid_to_target(self.source, self.target, method)
+
+    def peakmem_set_regridder_apply(self, method, resolution, ntimes):
+        self.regridder(self.source)
+
+    def peakmem_regrid_to_target(self, method, resolution, ntimes):
+        regrid_to_target(self.source, self.target, method)
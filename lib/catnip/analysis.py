@@ -30,12 +30,25 @@
 # POSSIBILITY OF SUCH DAMAGE.
 # -----------------------------------------------------------------------------
 
+import collections
+import concurrent.futures
+import functools
+import hashlib
+import tempfile
+import threading
 import numpy as np
-from scipy.stats.distributions import t
+import scipy.sparse
+import scipy.spatial
+from scipy.stats.distributions import t, norm
 import iris
+import iris.cube
+import iris.util
+import cf_units
 import cartopy.crs as ccrs
 import doctest
 import os.path
+import dask
+from dask import array as da
 import catnip.config as conf
 
 
@@ -170,8 +183,7 @@ def ci_interval(xi, yi, alpha=0.05):
     # degrees of freedom
     dof = n - 2  # assuming 2 parameters
     # student-t value for the dof and confidence level
-    # Note, ppf - Percent point function (inverse of cdf - percentiles).
-    t_val = t.ppf(1.0 - alpha / 2.0, dof)
+    t_val = _t_value(alpha, dof)
 
     # Return the least-squares solution to a linear matrix equation
     slope, intcp, xp, yp, sum_res = linear_regress(xi, yi)
@@ -220,123 +232,3597 @@ def ci_interval(xi, yi, alpha=0.05):
         # intcp_lo = intcp - intcp_conf_int
         # intcp_hi = intcp + intcp_conf_int
 
-        return (
-            slope_conf_int,
-            intcp_conf_int,
-            xpts,
-            slope_lo_pts,
-            slope_hi_pts,
-            xreg,
-            y_conf_int_lo,
-            y_conf_int_hi,
+        return (
+            slope_conf_int,
+            intcp_conf_int,
+            xpts,
+            slope_lo_pts,
+            slope_hi_pts,
+            xreg,
+            y_conf_int_lo,
+            y_conf_int_hi,
+        )
+
+
+def _pairwise_sum(values, axis=-1, keepdims=False):
+    """
+    Sums values along axis by repeatedly adding neighbouring pairs, so
+    each term goes through only about log2(n) additions. The rounding
+    error is then at most about log2(n) * eps times the sum of the
+    absolute values of the terms, rather than n * eps for a running sum,
+    which keeps single precision sums accurate. Takes the same arguments
+    as the chunk and aggregate functions of dask.array.reduction.
+    """
+
+    if isinstance(axis, tuple):
+        (axis,) = axis
+    values = np.moveaxis(np.asarray(values), axis, -1)
+    if values.shape[-1] == 0:
+        return np.sum(np.moveaxis(values, -1, axis), axis=axis, keepdims=keepdims)
+
+    while values.shape[-1] > 1:
+        if values.shape[-1] % 2:
+            values = np.concatenate([values, np.zeros_like(values[..., :1])], axis=-1)
+        values = values[..., ::2] + values[..., 1::2]
+
+    if keepdims:
+        return np.moveaxis(values, -1, axis)
+    return values[..., 0]
+
+
+def _sum_last(values, dtype):
+    """
+    Sums values along their last dimension, using pairwise sums for
+    single precision and the usual numpy or dask sum otherwise.
+    """
+
+    if dtype != np.float32:
+        return np.sum(values, axis=-1)
+    if isinstance(values, da.Array):
+        return da.reduction(
+            values, _pairwise_sum, _pairwise_sum, axis=-1, dtype=values.dtype
+        )
+    return _pairwise_sum(values)
+
+
+def _dot_last(values, dx, dtype):
+    """
+    Returns the dot product of the last dimension of values with dx,
+    using pairwise sums of the products for single precision.
+    """
+
+    if dtype != np.float32:
+        return values @ dx
+    return _sum_last(values * dx, dtype)
+
+
+def _check_dtype(dtype):
+    """Returns dtype as a numpy type, if it is float32 or float64."""
+
+    if np.dtype(dtype) not in (np.float32, np.float64):
+        raise ValueError(
+            "dtype must be float32 or float64, not {}".format(str(np.dtype(dtype)))
+        )
+
+    return np.dtype(dtype).type
+
+
+def _regress_sums(xi, yi, dtype=np.float64):
+    """
+    Accumulates the sums needed to solve y = mx + c along the last
+    dimension of yi, for every series in yi at once. xi is centred on
+    its mean and each series of yi is shifted by its first value so
+    that the sums stay small and accurate.
+
+    Masked points of yi are left out of the sums, so the number of
+    points, n, is counted separately for each series.
+
+    args
+    ----
+    xi: numpy array of dimension 1
+    yi: numpy, numpy masked or dask array, the last dimension must be
+        the same length as xi
+    dtype: np.float64 (default) or np.float32. With np.float32, yi is
+           never copied to double precision and the sums are pairwise.
+
+    Returns
+    -------
+    sums: tuple of (n, x0, y0, sx, sy, sxx, sxy, syy), where x0 and y0
+          are the shifts removed from xi and yi and the remaining terms
+          are sums of the shifted values, their squares and products.
+    """
+
+    dtype = _check_dtype(dtype)
+    xi = np.asarray(xi, dtype=np.float64)
+    x0 = np.mean(xi)
+    dx = (xi - x0).astype(dtype)
+    x0 = dtype(x0)
+    if dtype == np.float32:
+        yi = yi.astype(np.float32, copy=False)
+
+    # dask arrays may hold masked chunks, so always check them
+    lazy = isinstance(yi, da.Array)
+    if lazy or np.ma.isMaskedArray(yi):
+        ma = da.ma if lazy else np.ma
+        valid = ~ma.getmaskarray(yi)
+        # a series with its first point masked is not shifted
+        y0 = ma.filled(yi[..., 0].astype(dtype), 0.0)
+        dy = ma.filled(yi - y0[..., np.newaxis], 0.0)
+
+        n = np.sum(valid, axis=-1)
+        if dtype == np.float32:
+            # counts are exact in single precision up to 2**24 points
+            n = n.astype(dtype)
+        sx = _dot_last(valid, dx, dtype)
+        sxx = _dot_last(valid, dx ** 2, dtype)
+    else:
+        y0 = yi[..., 0].astype(dtype)
+        dy = yi - y0[..., np.newaxis]
+
+        n = len(xi)
+        sx = _sum_last(dx, dtype)
+        sxx = _sum_last(dx ** 2, dtype)
+
+    sy = _sum_last(dy, dtype)
+    # centred dot product of every series with xi
+    sxy = _dot_last(dy, dx, dtype)
+    syy = _sum_last(dy ** 2, dtype)
+
+    return n, x0, y0, sx, sy, sxx, sxy, syy
+
+
+def _regress_fit(sums):
+    """
+    Solves y = mx + c in closed form from the sums returned
+    by _regress_sums.
+
+    args
+    ----
+    sums: tuple of (n, x0, y0, sx, sy, sxx, sxy, syy)
+
+    Returns
+    -------
+    grad: gradient i.e. m in y = mx + c
+    intcp: intercept i.e. c in y = mx + c
+    sum_res: sum of the squared residuals
+    xmean: mean of x
+    sxx: sum of the squares of the difference between each x and xmean
+    """
+
+    n, x0, y0, sx, sy, sxx, sxy, syy = sums
+
+    xmean = sx / n
+    ymean = sy / n
+    # sums of squares and products about the mean
+    cxx = sxx - sx * xmean
+    cxy = sxy - sx * ymean
+    cyy = syy - sy * ymean
+
+    grad = cxy / cxx
+    intcp = (y0 + ymean) - grad * (x0 + xmean)
+    # rounding can make a perfect fit very slightly negative
+    sum_res = np.maximum(cyy - grad * cxy, 0.0)
+
+    return grad, intcp, sum_res, x0 + xmean, cxx
+
+
+def _regress_coord(cube, coord):
+    """
+    Returns the points of the coordinate to regress against, the cube
+    dimension it spans and the units of a unit step along it. Time
+    reference units, e.g. 'days since 1970-01-01', become 'days'.
+    """
+
+    xcoord = cube.coord(coord)
+    dims = cube.coord_dims(xcoord)
+    if len(dims) != 1:
+        raise ValueError(
+            "Coordinate {} must span exactly one dimension of the cube, "
+            "it spans {}".format(xcoord.name(), str(dims))
+        )
+
+    xunits = xcoord.units
+    if xunits.is_time_reference():
+        xunits = cf_units.Unit(str(xunits).split(" since ")[0])
+
+    return xcoord.points, dims[0], xunits
+
+
+def _gradient_units(units, xunits):
+    """
+    Returns the units of a gradient of units against xunits, written
+    out as e.g. '(K) (days)-1' rather than simplified to SI units.
+    """
+
+    if units.is_unknown() or units.is_no_unit():
+        return units
+
+    return cf_units.Unit("({}) ({})-1".format(units, xunits))
+
+
+def _collapsed_template(cube, dim):
+    """
+    Returns a copy of the cube with dimension dim removed, along
+    with every coordinate spanning it.
+    """
+
+    index = [slice(None)] * cube.ndim
+    index[dim] = 0
+    template = cube[tuple(index)]
+    for coord in cube.coords(contains_dimension=dim):
+        template.remove_coord(coord.name())
+
+    return template
+
+
+def _regress_result_cube(template, data, long_name, units):
+    """
+    Puts one map of regression results into a copy of template
+    with the given name and units.
+    """
+
+    result = template.copy(data=data)
+    result.standard_name = None
+    result.long_name = long_name
+    result.var_name = None
+    result.units = units
+    result.attributes.pop("STASH", None)
+
+    return result
+
+
+def linear_regress_cube(cube, coord="time", min_samples=3, dtype=np.float64):
+    """
+    Solves y = mx + c for every grid point of a cube, where x is
+    the coordinate coord (default is time). All grid points are fitted
+    together in one closed form pass over the coordinate, rather than
+    calling linear_regress once per grid point, so trend maps of large
+    domains are quick to calculate.
+
+    args
+    ----
+    cube: iris cube to fit, y in y = mx + c
+    coord: name of the 1D coordinate to regress against, defaults to 'time'.
+    min_samples: grid points with fewer unmasked points than this are
+                 masked in the results, defaults to 3.
+    dtype: precision of the sums and results, np.float64 (default) or
+           np.float32. See Notes.
+
+    Returns
+    -------
+    grad_cube: cube of the gradient, in units of the cube per unit of coord
+    intcp_cube: cube of the intercept, in units of the cube
+    sum_res_cube: cube of the sum of the squared residuals
+
+    Notes
+    -----
+    The returned cubes keep all the coordinates of the input cube that do
+    not span the regression coordinate. Time coordinates are regressed in
+    their own units, e.g. a cube with time in 'hours since 1970-01-01'
+    gives a gradient per hour.
+
+    If the cube has lazy data it is not realised. The sums are calculated
+    by dask one chunk at a time and only the final maps are loaded, so
+    records much larger than memory can be used.
+
+    Masked data points are left out of the fit, so each grid point is
+    fitted using only its own unmasked points.
+
+    With dtype=np.float32, single precision data is never copied to double
+    precision, halving the memory and bandwidth of large jobs, and no
+    design matrix is built. The data are centred, and every sum is added
+    pairwise, so each sum has a rounding error of at most about
+    log2(n) * 6e-8 times the sum of the absolute values of its terms,
+    where n is the number of points. The gradient then has a relative
+    error of roughly log2(n) * 1e-7 / |r|, where r is the correlation of
+    the grid point with coord, e.g. under 1e-5 for a 50 year daily record
+    with |r| > 0.2. The error of weaker trends stays a small fraction of
+    their confidence interval.
+
+    A simple example:
+
+    >>> time = iris.coords.DimCoord(np.arange(10.0), standard_name='time', \
+units='days since 2000-01-01')
+    >>> lat = iris.coords.DimCoord([0.0, 10.0], standard_name='latitude', \
+units='degrees')
+    >>> data = np.outer(np.arange(10.0), [2.0, -1.0]) + 5.0
+    >>> cube = iris.cube.Cube(data, long_name='tas', units='K', \
+dim_coords_and_dims=[(time, 0), (lat, 1)])
+    >>> grad_cube, intcp_cube, sum_res_cube = linear_regress_cube(cube)
+    >>> print(grad_cube.data, grad_cube.units)
+    [ 2. -1.] (K) (days)-1
+    >>> print(intcp_cube.data)
+    [5. 5.]
+    """
+
+    if not isinstance(cube, iris.cube.Cube):
+        raise TypeError("Input is not a cube")
+
+    xi, dim, xunits = _regress_coord(cube, coord)
+
+    # centred x has no variance if all the points are the same
+    if np.all(xi == xi[0]):
+        raise ValueError("Sum of squares of difference is 0")
+
+    # work on the lazy data, if there is any, so only the
+    # final maps are realised
+    yi = np.moveaxis(cube.core_data(), dim, -1)
+    sums = _regress_sums(xi, yi, dtype)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        grad, intcp, sum_res, xmean, sxx = _regress_fit(sums)
+        n, sxx, grad, intcp, sum_res = da.compute(sums[0], sxx, grad, intcp, sum_res)
+
+    invalid = _invalid_fit(n, sxx, min_samples, grad.shape)
+    grad, intcp, sum_res = [_mask_invalid(x, invalid) for x in (grad, intcp, sum_res)]
+
+    template = _collapsed_template(cube, dim)
+    name = "{} against {}".format(cube.name(), cube.coord(coord).name())
+    grad_cube = _regress_result_cube(
+        template, grad, "gradient of " + name, _gradient_units(cube.units, xunits)
+    )
+    intcp_cube = _regress_result_cube(
+        template, intcp, "intercept of " + name, cube.units
+    )
+    sum_res_cube = _regress_result_cube(
+        template, sum_res, "sum of squared residuals of " + name, cube.units ** 2
+    )
+
+    return grad_cube, intcp_cube, sum_res_cube
+
+
+@functools.lru_cache(maxsize=None)
+def _t_value(alpha, dof):
+    """
+    Returns the two sided student-t value for a confidence level alpha
+    and degrees of freedom dof. Cached, as the same few values are
+    needed over and over again.
+    """
+
+    # Note, ppf - Percent point function (inverse of cdf - percentiles).
+    return t.ppf(1.0 - alpha / 2.0, dof)
+
+
+def _t_values(alpha, dof):
+    """
+    Returns the student-t values for an array of degrees of freedom,
+    calculating each distinct value only once.
+    """
+
+    if isinstance(dof, da.Array):
+        return dof.map_blocks(functools.partial(_t_values, alpha), dtype=np.float64)
+
+    if np.ndim(dof) == 0:
+        return _t_value(alpha, dof)
+
+    dofs, inverse = np.unique(dof, return_inverse=True)
+    t_vals = np.array([_t_value(alpha, value) for value in dofs])
+
+    return t_vals[inverse].reshape(np.shape(dof))
+
+
+def _invalid_fit(n, sxx, min_samples, shape):
+    """
+    Returns a boolean array of shape, True where a series has fewer
+    than min_samples points or no spread in x, so it can't be fitted.
+    """
+
+    with np.errstate(invalid="ignore"):
+        invalid = (np.asarray(n) < min_samples) | ~(np.asarray(sxx) > 0.0)
+
+    return np.broadcast_to(invalid, shape)
+
+
+def _mask_invalid(values, invalid):
+    """Masks values where invalid is True, if it is True anywhere."""
+
+    if np.any(invalid):
+        values = np.ma.masked_where(invalid, values)
+
+    return values
+
+
+def _ci_fit(n, xmean, sxx, sum_res, alpha):
+    """
+    Calculates the confidence interval of the slope and intercept
+    of y = mx + c from the results of _regress_fit.
+
+    args
+    ----
+    n: number of points in each series
+    xmean: mean of x
+    sxx: sum of the squares of the difference between each x and xmean
+    sum_res: sum of the squared residuals
+    alpha: required confidence interval (e.g. 0.05 for 95%)
+
+    Returns
+    -------
+    slope_conf_int: Gradient of confidence interval
+    intcp_conf_int: Intercept of confidence interval
+    sd_err: standard error of the fit
+    """
+
+    # degrees of freedom, assuming 2 parameters, which differ between
+    # series if some have masked points
+    dof = n - 2
+    sd_err = np.sqrt(sum_res / dof)
+    t_val = _t_values(alpha, dof).astype(sd_err.dtype)
+
+    # CI of slope: Formulated from vonStorch & Zwiers Sect.8.3.7
+    slope_conf_int = (t_val * sd_err) / np.sqrt(sxx)
+    # Intercept CI, using population y CI at x=0
+    intcp_conf_int = (t_val * sd_err) * np.sqrt((1.0 / n) + (xmean ** 2 / sxx))
+
+    return slope_conf_int, intcp_conf_int, sd_err
+
+
+def ci_interval_batch(
+    xi, yi, alpha=0.05, plot_pts=False, min_samples=3, dtype=np.float64
+):
+    """
+    Calculates Confidence interval (default 95%) parameters of many
+    series at once, all sharing the same x values. This is the batched
+    version of ci_interval: every series is fitted in one pass and only
+    one student-t value is calculated, and the plotting vectors are only
+    calculated if they are asked for.
+
+    args
+    ----
+    xi: numpy array of dimension 1
+    yi: dependant variable, numpy array of shape (series, len(xi)). Any
+        number of leading dimensions is allowed, the last one must match xi.
+    alpha: required confidence interval (e.g. 0.05 for 95%). Default is 0.05.
+    plot_pts: if True also return the vectors for confidence interval
+              plotting, default is False.
+    min_samples: series with fewer unmasked points than this are masked
+                 in the results, defaults to 3.
+    dtype: precision of the sums and results, np.float64 (default) or
+           np.float32, see linear_regress_cube.
+
+    Returns
+    -------
+    slope_conf_int: array of the Gradient of confidence interval of each series
+    intcp_conf_int: array of the Intercept of confidence interval of each series
+
+    and if plot_pts is True, as in ci_interval with a leading series dimension:
+
+    xpts: the min and max value of xi.
+    slope_lo_pts: min and max y value of lower bound of CI of slope
+    slope_hi_pts: min and max y value of upper bound of CI of slope
+    xreg: x values spanning xmin to xmax linearly spaced
+    y_conf_int_lo: lower bound of CI region for yi
+    y_conf_int_hi: upper bound of CI region for yi
+
+    Notes
+    -----
+    Parameters have been calculated using von Storch & Zwiers
+    Statisical Analysis in Climate Research
+    Sect.8.3.7 and 8.3.10
+
+    If yi is a masked array, masked points are left out and the degrees
+    of freedom, and so the student-t value, of each series are set by its
+    own number of unmasked points.
+
+    A simple example:
+
+    >>> x = np.array([1, 4, 2, 7, 0, 6, 3, 3, 1, 9])
+    >>> y = np.array([[5, 6, 2, 9, 1, 4, 7, 8, 2, 6], \
+                      [1, 4, 2, 8, 0, 7, 3, 2, 1, 9]])
+    >>> slope_conf_int, intcp_conf_int = ci_interval_batch(x, y)
+    Calculating the 95.0% confidence interval
+    >>> print(np.round(slope_conf_int, 2))
+    [0.62 0.14]
+    >>> print(np.round(intcp_conf_int, 2))
+    [2.81 0.65]
+    """
+
+    xi = np.asarray(xi)
+    yi = np.asanyarray(yi)
+
+    if xi.ndim != 1 or yi.shape[-1:] != xi.shape:
+        raise ValueError(
+            "The last dimension of yi must match xi, got {} and {}".format(
+                str(yi.shape), str(xi.shape)
+            )
+        )
+
+    print(("Calculating the {}% confidence interval".format(str((1 - alpha) * 100))))
+    if np.all(xi == xi[0]):
+        raise ValueError("Sum of squares of difference is 0")
+
+    sums = _regress_sums(xi, yi, dtype)
+    n = sums[0]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope, intcp, sum_res, xmean, sxx = _regress_fit(sums)
+        slope_conf_int, intcp_conf_int, sd_err = _ci_fit(
+            n, xmean, sxx, sum_res, alpha
+        )
+
+    invalid = _invalid_fit(n, sxx, min_samples, slope.shape)
+    slope_conf_int = _mask_invalid(slope_conf_int, invalid)
+    intcp_conf_int = _mask_invalid(intcp_conf_int, invalid)
+
+    if not plot_pts:
+        return slope_conf_int, intcp_conf_int
+
+    # add a trailing dimension so the plotting vectors broadcast
+    # against every series
+    slope = slope[..., np.newaxis]
+    intcp = intcp[..., np.newaxis]
+    ymean = np.mean(yi, axis=-1)[..., np.newaxis]
+    n = np.asarray(n)[..., np.newaxis]
+    xmean = np.asarray(xmean)[..., np.newaxis]
+    sxx = np.asarray(sxx)[..., np.newaxis]
+    xmin, xmax = np.min(xi), np.max(xi)
+    xpts = xmin, xmax
+    xdiff = np.array([xmin, xmax]) - xmean
+    slope_lo_pts = ymean + (slope - slope_conf_int[..., np.newaxis]) * xdiff
+    slope_hi_pts = ymean + (slope + slope_conf_int[..., np.newaxis]) * xdiff
+
+    # Population yi CI: Formulated from vonStorch & Zwiers Sect.8.3.10
+    xreg = np.linspace(xmin, xmax, 101)
+    yfact = np.sqrt((1.0 / n) + (((xreg - xmean) ** 2) / sxx))
+    ymean_conf_int = (_t_values(alpha, n - 2) * sd_err[..., np.newaxis]) * yfact
+    y_conf_int_hi = (slope * xreg) + intcp + ymean_conf_int
+    y_conf_int_lo = (slope * xreg) + intcp - ymean_conf_int
+
+    return (
+        slope_conf_int,
+        intcp_conf_int,
+        xpts,
+        slope_lo_pts,
+        slope_hi_pts,
+        xreg,
+        y_conf_int_lo,
+        y_conf_int_hi,
+    )
+
+
+def ci_interval_cube(
+    cube, coord="time", alpha=0.05, min_samples=3, dtype=np.float64
+):
+    """
+    Calculates Confidence interval (default 95%) of the gradient and
+    intercept of y = mx + c for every grid point of a cube, where x is
+    the coordinate coord (default is time). See ci_interval_batch.
+
+    args
+    ----
+    cube: iris cube to fit, y in y = mx + c
+    coord: name of the 1D coordinate to regress against, defaults to 'time'.
+    alpha: required confidence interval (e.g. 0.05 for 95%). Default is 0.05.
+    min_samples: grid points with fewer unmasked points than this are
+                 masked in the results, defaults to 3.
+    dtype: precision of the sums and results, np.float64 (default) or
+           np.float32, see linear_regress_cube.
+
+    Returns
+    -------
+    slope_conf_int_cube: cube of the Gradient of confidence interval
+    intcp_conf_int_cube: cube of the Intercept of confidence interval
+
+    Notes
+    -----
+    The gradient of the confidence interval is in the same units as the
+    gradient returned by linear_regress_cube. As with linear_regress_cube,
+    lazy data is read one chunk at a time and never fully realised.
+    Masked data points are left out, and the degrees of freedom of each
+    grid point are set by its own number of unmasked points.
+
+    A simple example:
+
+    >>> time = iris.coords.DimCoord(np.arange(10.0), standard_name='time', \
+units='days since 2000-01-01')
+    >>> lat = iris.coords.DimCoord([0.0, 10.0], standard_name='latitude', \
+units='degrees')
+    >>> data = np.array([[5, 6, 2, 9, 1, 4, 7, 8, 2, 6], \
+                         [1, 4, 2, 8, 0, 7, 3, 2, 1, 9]]).T
+    >>> cube = iris.cube.Cube(data, long_name='tas', units='K', \
+dim_coords_and_dims=[(time, 0), (lat, 1)])
+    >>> slope_ci_cube, intcp_ci_cube = ci_interval_cube(cube)
+    Calculating the 95.0% confidence interval
+    >>> print(np.round(slope_ci_cube.data, 2), slope_ci_cube.units)
+    [0.73 0.83] (K) (days)-1
+    """
+
+    if not isinstance(cube, iris.cube.Cube):
+        raise TypeError("Input is not a cube")
+
+    xi, dim, xunits = _regress_coord(cube, coord)
+    if np.all(xi == xi[0]):
+        raise ValueError("Sum of squares of difference is 0")
+
+    print(("Calculating the {}% confidence interval".format(str((1 - alpha) * 100))))
+    # work on the lazy data, if there is any, so only the
+    # final maps are realised
+    yi = np.moveaxis(cube.core_data(), dim, -1)
+    sums = _regress_sums(xi, yi, dtype)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope, intcp, sum_res, xmean, sxx = _regress_fit(sums)
+        slope_conf_int, intcp_conf_int, sd_err = _ci_fit(
+            sums[0], xmean, sxx, sum_res, alpha
+        )
+        n, sxx, slope_conf_int, intcp_conf_int = da.compute(
+            sums[0], sxx, slope_conf_int, intcp_conf_int
+        )
+
+    invalid = _invalid_fit(n, sxx, min_samples, slope_conf_int.shape)
+    slope_conf_int = _mask_invalid(slope_conf_int, invalid)
+    intcp_conf_int = _mask_invalid(intcp_conf_int, invalid)
+
+    template = _collapsed_template(cube, dim)
+    name = "{} against {}".format(cube.name(), cube.coord(coord).name())
+    slope_conf_int_cube = _regress_result_cube(
+        template,
+        slope_conf_int,
+        "confidence interval of gradient of " + name,
+        _gradient_units(cube.units, xunits),
+    )
+    intcp_conf_int_cube = _regress_result_cube(
+        template,
+        intcp_conf_int,
+        "confidence interval of intercept of " + name,
+        cube.units,
+    )
+    for result in [slope_conf_int_cube, intcp_conf_int_cube]:
+        result.attributes["confidence_level"] = "{}%".format(str((1 - alpha) * 100))
+
+    return slope_conf_int_cube, intcp_conf_int_cube
+
+
+def _rolling_sums(xi, yi, window):
+    """
+    Accumulates the sums of _regress_sums for every window of window
+    consecutive points along the last dimension of yi. The sums are
+    cumulated once along the series and each window's sums are the
+    difference of two cumulative sums, so the cost does not depend on
+    the window length.
+
+    args
+    ----
+    xi: numpy array of dimension 1
+    yi: numpy, numpy masked or dask array, the last dimension must be
+        the same length as xi
+    window: number of points in each window
+
+    Returns
+    -------
+    sums: tuple of (n, x0, y0, sx, sy, sxx, sxy, syy) as for _regress_sums,
+          with a last dimension of length len(xi) - window + 1 added
+          to all the terms except the shifts x0 and y0.
+    """
+
+    xi = np.asarray(xi, dtype=np.float64)
+    x0 = np.mean(xi)
+    dx = xi - x0
+
+    def window_sums(values):
+        # pad with a leading zero, so window i is cumsum[i + window] - cumsum[i]
+        csum = np.cumsum(values, axis=-1)
+        zeros = np.zeros_like(csum[..., :1])
+        lib = da if isinstance(csum, da.Array) else np
+        csum = lib.concatenate([zeros, csum], axis=-1)
+        return csum[..., window:] - csum[..., :-window]
+
+    lazy = isinstance(yi, da.Array)
+    if lazy or np.ma.isMaskedArray(yi):
+        ma = da.ma if lazy else np.ma
+        valid = ~ma.getmaskarray(yi)
+        y0 = ma.filled(yi[..., 0].astype(np.float64), 0.0)
+        dy = ma.filled(yi - y0[..., np.newaxis], 0.0)
+
+        n = window_sums(valid.astype(np.int64))
+        sx = window_sums(valid * dx)
+        sxx = window_sums(valid * dx ** 2)
+    else:
+        y0 = yi[..., 0].astype(np.float64)
+        dy = yi - y0[..., np.newaxis]
+
+        n = window
+        sx = window_sums(dx)
+        sxx = window_sums(dx ** 2)
+
+    sy = window_sums(dy)
+    sxy = window_sums(dy * dx)
+    syy = window_sums(dy ** 2)
+
+    return n, x0, y0[..., np.newaxis], sx, sy, sxx, sxy, syy
+
+
+def rolling_trend_cube(cube, window, coord="time", alpha=0.05, min_samples=3):
+    """
+    Calculates the gradient of y = mx + c, and its confidence interval
+    (default 95%), over every window of consecutive points along the
+    coordinate coord (default is time) for every grid point of a cube,
+    e.g. the 30 year trend starting in each year.
+
+    args
+    ----
+    cube: iris cube to fit, y in y = mx + c
+    window: number of points of coord in each window, e.g. 30 for
+            30 year windows of annual data
+    coord: name of the 1D coordinate to regress against, defaults to 'time'.
+    alpha: required confidence interval (e.g. 0.05 for 95%). Default is 0.05.
+    min_samples: windows with fewer unmasked points than this are masked
+                 in the results, defaults to 3.
+
+    Returns
+    -------
+    grad_cube: cube of the gradient in each window
+    slope_conf_int_cube: cube of the Gradient of confidence interval
+                         in each window
+
+    Notes
+    -----
+    The dimension of coord is replaced by one window per start point, so
+    the results have len(coord) - window + 1 points along it. The points
+    of coord are those of the first point in each window and the bounds
+    span the window.
+
+    Rather than refitting each window, which costs O(n * window) per grid
+    point, the sums used by linear_regress_cube are cumulated once along
+    the series and differenced between the start and end of each window,
+    costing O(n). The series are centred first, so the rounding error of
+    the differences stays small compared to the spread of the data.
+
+    As with linear_regress_cube, lazy data is not realised until the end
+    and masked points are left out of each window.
+
+    A simple example:
+
+    >>> time = iris.coords.DimCoord(np.arange(6.0), standard_name='time', \
+units='days since 2000-01-01')
+    >>> cube = iris.cube.Cube([0.0, 1.0, 2.0, 2.0, 1.0, 0.0], \
+long_name='tas', units='K', dim_coords_and_dims=[(time, 0)])
+    >>> grad_cube, slope_ci_cube = rolling_trend_cube(cube, 3)
+    Calculating the 95.0% confidence interval
+    >>> print(grad_cube.data, grad_cube.units)
+    [ 1.   0.5 -0.5 -1. ] (K) (days)-1
+    >>> print(grad_cube.coord('time').bounds[0])
+    [0. 2.]
+    """
+
+    if not isinstance(cube, iris.cube.Cube):
+        raise TypeError("Input is not a cube")
+
+    xi, dim, xunits = _regress_coord(cube, coord)
+    if not 2 <= window <= len(xi):
+        raise ValueError(
+            "window must be between 2 and {}, the length of {}, "
+            "not {}".format(str(len(xi)), coord, str(window))
+        )
+
+    print(("Calculating the {}% confidence interval".format(str((1 - alpha) * 100))))
+    yi = np.moveaxis(cube.core_data(), dim, -1)
+    sums = _rolling_sums(xi, yi, window)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        grad, intcp, sum_res, xmean, sxx = _regress_fit(sums)
+        slope_conf_int = _ci_fit(sums[0], xmean, sxx, sum_res, alpha)[0]
+        n, sxx, grad, slope_conf_int = da.compute(sums[0], sxx, grad, slope_conf_int)
+
+    invalid = _invalid_fit(n, sxx, min_samples, grad.shape)
+    grad, slope_conf_int = [
+        np.moveaxis(_mask_invalid(x, invalid), -1, dim) for x in (grad, slope_conf_int)
+    ]
+
+    # the first point of each window, with bounds spanning the window
+    nwindow = len(xi) - window + 1
+    index = [slice(None)] * cube.ndim
+    index[dim] = slice(0, nwindow)
+    template = cube[tuple(index)]
+    xcoord = template.coord(coord)
+    xcoord.bounds = np.stack([xi[:nwindow], xi[window - 1 :]], axis=-1)
+
+    name = "{} against {} in windows of {} points".format(
+        cube.name(), cube.coord(coord).name(), str(window)
+    )
+    grad_cube = _regress_result_cube(
+        template, grad, "gradient of " + name, _gradient_units(cube.units, xunits)
+    )
+    slope_conf_int_cube = _regress_result_cube(
+        template,
+        slope_conf_int,
+        "confidence interval of gradient of " + name,
+        _gradient_units(cube.units, xunits),
+    )
+    slope_conf_int_cube.attributes["confidence_level"] = "{}%".format(
+        str((1 - alpha) * 100)
+    )
+
+    return grad_cube, slope_conf_int_cube
+
+
+def _bootstrap_indices(n, nboot, block_size, rng):
+    """
+    Returns an array of shape (nboot, n) of resampled indices into a
+    series of length n. With a block_size greater than 1 a moving block
+    bootstrap is used, resampling whole blocks of consecutive points so
+    that autocorrelation within each block is kept.
+    """
+
+    nblocks = int(np.ceil(n / float(block_size)))
+    starts = rng.randint(0, n - block_size + 1, size=(nboot, nblocks))
+    indices = starts[..., np.newaxis] + np.arange(block_size)
+
+    return indices.reshape(nboot, -1)[:, :n]
+
+
+def _bootstrap_chunk(yi, xweights, counts, xmean, sxx, alpha):
+    """
+    Finds the bootstrap confidence interval bounds of every series in
+    yi, a 2D array of shape (series, time), using the weights from
+    ci_interval_bootstrap. Module level so it can run in a process pool.
+    """
+
+    n = counts[0].sum()
+    # every replicate of every series in two matrix products
+    slopes = (yi @ xweights.T) / sxx
+    intcps = (yi @ counts.T) / n - slopes * xmean
+
+    percentiles = [100.0 * alpha / 2.0, 100.0 * (1.0 - alpha / 2.0)]
+    slope_lo, slope_hi = np.percentile(slopes, percentiles, axis=-1)
+    intcp_lo, intcp_hi = np.percentile(intcps, percentiles, axis=-1)
+
+    return slope_lo, slope_hi, intcp_lo, intcp_hi
+
+
+def ci_interval_bootstrap(
+    xi, yi, alpha=0.05, nboot=1000, block_size=1, seed=None, processes=None
+):
+    """
+    Calculates the bootstrap Confidence interval (default 95%) of the
+    gradient and intercept of y = mx + c. Unlike ci_interval this makes
+    no assumption that the residuals are Gaussian. Pairs of (xi, yi) are
+    resampled with replacement nboot times and the interval is taken
+    from the percentiles of the gradients and intercepts of the resamples.
+
+    args
+    ----
+    xi: numpy array of dimension 1
+    yi: dependant variable, numpy array of dimension 1, or with any number
+        of leading dimensions, e.g. (series, time) or (lat, lon, time),
+        the last one must match xi.
+    alpha: required confidence interval (e.g. 0.05 for 95%). Default is 0.05.
+    nboot: number of bootstrap resamples, defaults to 1000.
+    block_size: length of the blocks of consecutive points resampled,
+                defaults to 1. Use a block_size of about the decorrelation
+                length for autocorrelated series (moving block bootstrap).
+    seed: integer seed for the random number generator. The same seed
+          gives the same result, whatever the value of processes.
+    processes: number of processes to share the series of a large yi
+               between, defaults to None, which runs in this process.
+
+    Returns
+    -------
+    slope_lo: lower bound of confidence interval of the gradient
+    slope_hi: upper bound of confidence interval of the gradient
+    intcp_lo: lower bound of confidence interval of the intercept
+    intcp_hi: upper bound of confidence interval of the intercept
+
+    Notes
+    -----
+    The resampled indices are generated once and turned into two weight
+    matrices of shape (nboot, len(xi)), so the gradients and intercepts of
+    every resample of every series come from two matrix products rather
+    than a loop over resamples.
+
+    A simple example:
+
+    >>> x = np.array([1, 4, 2, 7, 0, 6, 3, 3, 1, 9])
+    >>> y = np.array([5, 6, 2, 9, 1, 4, 7, 8, 2, 6])
+    >>> slope_lo, slope_hi, intcp_lo, intcp_hi = ci_interval_bootstrap(x, y, \
+seed=0)
+    Calculating the 95.0% bootstrap confidence interval
+    >>> print("{:.2f} {:.2f}".format(slope_lo, slope_hi))
+    0.07 1.26
+    """
+
+    xi = np.asarray(xi, dtype=np.float64)
+    yi = np.asanyarray(yi)
+
+    if xi.ndim != 1 or yi.shape[-1:] != xi.shape:
+        raise ValueError(
+            "The last dimension of yi must match xi, got {} and {}".format(
+                str(yi.shape), str(xi.shape)
+            )
+        )
+    if np.ma.is_masked(yi):
+        raise ValueError("Masked data is not supported by the bootstrap")
+    if not 1 <= block_size <= len(xi):
+        raise ValueError(
+            "block_size must be between 1 and {}, not {}".format(len(xi), block_size)
+        )
+
+    print(
+        (
+            "Calculating the {}% bootstrap confidence interval".format(
+                str((1 - alpha) * 100)
+            )
+        )
+    )
+
+    n = len(xi)
+    rng = np.random.RandomState(seed)
+    indices = _bootstrap_indices(n, nboot, block_size, rng)
+
+    # centred x of each resample; resamples with no spread in x
+    # can't be fitted so are dropped
+    xboot = xi[indices]
+    xmean = np.mean(xboot, axis=-1)
+    xcentred = xboot - xmean[:, np.newaxis]
+    sxx = np.sum(xcentred ** 2, axis=-1)
+    keep = sxx > 0.0
+    if not np.any(keep):
+        raise ValueError("Sum of squares of difference is 0")
+    indices, xmean, xcentred, sxx = (
+        indices[keep],
+        xmean[keep],
+        xcentred[keep],
+        sxx[keep],
+    )
+
+    # scatter the resamples into weight matrices of shape (nboot, n), so
+    # that yi @ xweights.T is the centred dot product of each resample
+    # with x and yi @ counts.T is the sum of each resample
+    nkeep = len(sxx)
+    flat = (np.arange(nkeep)[:, np.newaxis] * n + indices).ravel()
+    xweights = np.bincount(flat, weights=xcentred.ravel(), minlength=nkeep * n)
+    xweights = xweights.reshape(nkeep, n)
+    counts = np.bincount(flat, minlength=nkeep * n).reshape(nkeep, n).astype(np.float64)
+
+    series = np.reshape(np.ma.getdata(yi), (-1, n)).astype(np.float64)
+    # roughly bound the size of the (series, nboot) matrices of each chunk
+    nchunks = max(1, len(series) * nkeep // 2 ** 22)
+    if processes is None or len(series) == 1:
+        results = [
+            _bootstrap_chunk(chunk, xweights, counts, xmean, sxx, alpha)
+            for chunk in np.array_split(series, nchunks)
+        ]
+    else:
+        chunks = np.array_split(series, min(len(series), max(nchunks, processes * 4)))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+            futures = [
+                pool.submit(
+                    _bootstrap_chunk, chunk, xweights, counts, xmean, sxx, alpha
+                )
+                for chunk in chunks
+            ]
+            results = [future.result() for future in futures]
+
+    bounds = [
+        np.concatenate([result[i] for result in results]).reshape(yi.shape[:-1])
+        for i in range(4)
+    ]
+    if yi.ndim == 1:
+        bounds = [bound[()] for bound in bounds]
+
+    return tuple(bounds)
+
+
+def _count_inversions(z, strict=True):
+    """
+    Counts the pairs i < j with z[i] > z[j] (or z[i] >= z[j] if strict is
+    False) in every row of the 2D array z, in O(n log n) per row.
+
+    A bottom up merge sort is run on all the rows at once. At each level,
+    for every element of a right hand block, the number of elements of
+    the left hand block it should be swapped with is counted. As the two
+    blocks are already sorted, numpy's stable sort (timsort) merges them
+    in a single pass.
+    """
+
+    nrows, n = z.shape
+    size = 1
+    while size < n:
+        size *= 2
+    # pad to a power of 2 with values which are never inverted
+    pad = size - n
+    vals = np.concatenate([z, np.full((nrows, pad), np.inf)], axis=1)
+
+    count = np.zeros(nrows, dtype=np.int64)
+    width = 1
+    while width < size:
+        blocks = vals.reshape(nrows, size // (2 * width), 2, width)
+        left, right = blocks[:, :, 0, :], blocks[:, :, 1, :]
+        # put the left block first when the inversion has to be strict,
+        # so that ties keep their order and are not counted
+        if strict:
+            merged = np.concatenate([left, right], axis=-1)
+        else:
+            merged = np.concatenate([right, left], axis=-1)
+        order = np.argsort(merged, axis=-1, kind="stable")
+        is_left = (order < width) if strict else (order >= width)
+        # each right element is inverted with the left elements after it
+        left_before = np.cumsum(is_left, axis=-1)
+        count += np.sum(np.where(is_left, 0, width - left_before), axis=(1, 2))
+
+        vals = np.take_along_axis(merged, order, axis=-1).reshape(nrows, size)
+        width *= 2
+
+    if not strict:
+        # the padding values are all equal, so count as inverted with each other
+        count -= pad * (pad - 1) // 2
+
+    return count
+
+
+def _theil_sen_pairwise(xi, yi):
+    """
+    Theil-Sen gradient and Mann-Kendall S of every row of yi, from every
+    pairwise slope at once. Quick for short series, but uses O(n**2) memory.
+    """
+
+    i, j = np.triu_indices(len(xi), 1)
+    dy = yi[:, j] - yi[:, i]
+    grad = np.median(dy / (xi[j] - xi[i]), axis=-1)
+    s = np.sum(np.sign(dy), axis=-1)
+
+    return grad, s
+
+
+def _single_slope(xi, rows, lo, hi):
+    """
+    For rows of y with exactly one pairwise slope in (lo, hi], finds that
+    slope from the pair of points which swap order between y - lo * x and
+    y - hi * x. Returns whether the pair was found in each row, and the slope.
+    """
+
+    order_lo = np.argsort(rows - lo[:, np.newaxis] * xi, axis=-1, kind="stable")
+    order_hi = np.argsort(rows - hi[:, np.newaxis] * xi, axis=-1, kind="stable")
+    differ = order_lo != order_hi
+    pos = np.minimum(np.argmax(differ, axis=-1), len(xi) - 2)
+
+    index = np.arange(len(rows))
+    first = order_lo[index, pos]
+    second = order_lo[index, pos + 1]
+    slope = (rows[index, second] - rows[index, first]) / (xi[second] - xi[first])
+    found = (
+        (np.sum(differ, axis=-1) == 2)
+        & differ[index, pos + 1]
+        & (slope > lo)
+        & (slope <= hi)
+    )
+
+    return found, slope
+
+
+def _theil_sen_bisect(xi, yi, max_iter=100, rtol=1e-10, nsample=None, seed=0):
+    """
+    Theil-Sen gradient and Mann-Kendall S of every row of yi, using
+    O(n log n) inversion counts rather than every pairwise slope.
+
+    For xi sorted in increasing order, the number of pairwise slopes less
+    than or equal to t is the number of non-strict inversions of y - t*x,
+    so the median slope is found by bisection on t for all rows at once.
+    The bisection starts from the quantiles of a random sample of slopes
+    around the median, which are checked with an inversion count, and
+    alternates halving steps with steps interpolated on the counts. Once
+    only the slope looked for is left in the interval it is found exactly.
+    """
+
+    nrows, n = yi.shape
+    npairs = n * (n - 1) // 2
+
+    # the median is the kth smallest slope, or the mean of two of them
+    ranks = np.array([(npairs + 1) // 2, npairs // 2 + 1])
+    kth = np.tile(ranks, nrows)
+    rows = np.repeat(yi, len(ranks), axis=0)
+
+    def slopes_below(todo, trial):
+        return _count_inversions(rows[todo] - trial[:, np.newaxis] * xi, strict=False)
+
+    # every pairwise slope lies within +/- bound
+    bound = (np.max(yi, axis=-1) - np.min(yi, axis=-1)) / np.min(np.diff(xi))
+    bound = np.repeat(bound + 1.0, len(ranks))
+    lo, hi = -bound, bound.copy()
+
+    # narrow the starting interval using a sample of the slopes, with a
+    # margin of 5 standard errors either side of the rank looked for
+    nsample = nsample or 4 * n
+    rng = np.random.RandomState(seed)
+    i, j = rng.randint(0, n, size=(2, nsample))
+    i, j = np.minimum(i, j)[i != j], np.maximum(i, j)[i != j]
+    sample = np.sort((rows[:, j] - rows[:, i]) / (xi[j] - xi[i]), axis=-1)
+    frac = kth / float(npairs)
+    margin = 5.0 * np.sqrt(frac * (1.0 - frac) / len(i)) + 1.0 / len(i)
+    pos_lo = np.clip(((frac - margin) * len(i)).astype(int), 0, len(i) - 1)
+    pos_hi = np.clip(np.ceil((frac + margin) * len(i)).astype(int), 0, len(i) - 1)
+    sample_lo = np.take_along_axis(sample, pos_lo[:, np.newaxis], axis=-1)[:, 0]
+    sample_hi = np.take_along_axis(sample, pos_hi[:, np.newaxis], axis=-1)[:, 0]
+    everything = np.ones(len(rows), dtype=bool)
+    below_lo = slopes_below(everything, sample_lo)
+    below_hi = slopes_below(everything, sample_hi)
+    use_lo = below_lo < kth
+    use_hi = below_hi >= kth
+    lo[use_lo] = sample_lo[use_lo]
+    hi[use_hi] = sample_hi[use_hi]
+    # number of slopes at or below lo and hi
+    nlo = np.where(use_lo, below_lo, 0)
+    nhi = np.where(use_hi, below_hi, npairs)
+
+    # stop when the interval holds only the slope looked for, or is small
+    # relative to the gradient, or to the spread of the data if the
+    # gradient is close to 0
+    scale = 1e-6 * bound
+    exact = np.zeros(len(rows), dtype=bool)
+    for step in range(max_iter):
+        single = ~exact & (nhi - nlo == 1)
+        if np.any(single):
+            found, slope = _single_slope(xi, rows[single], lo[single], hi[single])
+            exact[single] = found
+            hi[single] = np.where(found, slope, hi[single])
+        done = exact | (
+            (hi - lo) <= rtol * np.maximum(np.maximum(np.abs(lo), np.abs(hi)), scale)
+        )
+        if np.all(done):
+            break
+        todo = np.flatnonzero(~done)
+        # alternate between interpolating on the slope counts, which
+        # converges quickly while there are many slopes in the interval,
+        # and halving the interval, which is guaranteed to converge
+        if step % 2 == 0:
+            frac = (kth[todo] - 0.5 - nlo[todo]) / (nhi[todo] - nlo[todo])
+            frac = np.clip(frac, 0.01, 0.99)
+        else:
+            frac = 0.5
+        trial = lo[todo] + frac * (hi[todo] - lo[todo])
+        below = slopes_below(todo, trial)
+        found = below >= kth[todo]
+        hi[todo[found]], nhi[todo[found]] = trial[found], below[found]
+        lo[todo[~found]], nlo[todo[~found]] = trial[~found], below[~found]
+
+    grad = np.mean(hi.reshape(nrows, len(ranks)), axis=-1)
+
+    # S is the number of increasing pairs minus the number decreasing
+    s = (
+        npairs
+        - _count_inversions(yi, strict=False)
+        - _count_inversions(yi, strict=True)
+    )
+
+    return grad, s
+
+
+def _theil_sen_chunk(xi, yi, method):
+    """
+    Theil-Sen gradient and intercept, and Mann-Kendall z score and p-value
+    of every row of the 2D array yi. Module level so it can run in a
+    process pool.
+    """
+
+    n = len(xi)
+    if method == "auto":
+        method = "pairwise" if n <= _THEIL_SEN_PAIRWISE_MAX else "bisect"
+    if method == "pairwise":
+        grad, s = _theil_sen_pairwise(xi, yi)
+    elif method == "bisect":
+        grad, s = _theil_sen_bisect(xi, yi)
+    else:
+        raise ValueError(
+            "method must be 'auto', 'pairwise' or 'bisect', not {}".format(method)
+        )
+
+    intcp = np.median(yi - grad[:, np.newaxis] * xi, axis=-1)
+
+    # variance of S, corrected for groups of tied y values
+    ysort = np.sort(yi, axis=-1)
+    starts = np.ones(ysort.shape, dtype=bool)
+    starts[:, 1:] = np.diff(ysort, axis=-1) != 0
+    group = np.cumsum(starts, axis=-1) - 1 + n * np.arange(len(yi))[:, np.newaxis]
+    ties = np.bincount(group.ravel(), minlength=n * len(yi)).reshape(len(yi), n)
+    var_s = (
+        n * (n - 1) * (2 * n + 5) - np.sum(ties * (ties - 1) * (2 * ties + 5), axis=-1)
+    ) / 18.0
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z = np.where(s == 0, 0.0, (s - np.sign(s)) / np.sqrt(var_s))
+    pval = 2.0 * norm.sf(np.abs(z))
+
+    return grad, intcp, z, pval
+
+
+# series up to this length use the pairwise Theil-Sen algorithm
+_THEIL_SEN_PAIRWISE_MAX = 300
+
+
+def _theil_sen_rows(xi, yi, method, processes):
+    """
+    Runs _theil_sen_chunk over yi in blocks of rows small enough to keep
+    memory use down, optionally sharing them between processes.
+    """
+
+    xi = np.asarray(xi, dtype=np.float64)
+    yi = np.asanyarray(yi)
+    if xi.ndim != 1 or yi.shape[-1:] != xi.shape:
+        raise ValueError(
+            "The last dimension of yi must match xi, got {} and {}".format(
+                str(yi.shape), str(xi.shape)
+            )
+        )
+    if len(xi) < 3:
+        raise ValueError("At least 3 points are needed, have {}".format(len(xi)))
+    if np.ma.is_masked(yi) or np.any(np.isnan(yi)):
+        raise ValueError("Masked or NaN data is not supported")
+
+    # sort into increasing x, which must not repeat
+    order = np.argsort(xi)
+    xi = xi[order]
+    if np.any(np.diff(xi) == 0):
+        raise ValueError("xi must not contain repeated values")
+    rows = np.reshape(np.asarray(yi, dtype=np.float64)[..., order], (-1, len(xi)))
+
+    # roughly bound the size of the largest temporary array
+    n = len(xi)
+    per_row = n * (n - 1) // 2 if n <= _THEIL_SEN_PAIRWISE_MAX else 4 * n
+    chunks = np.array_split(rows, max(1, rows.size * per_row // (n * 2 ** 22)))
+
+    if processes is None:
+        results = [_theil_sen_chunk(xi, chunk, method) for chunk in chunks]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+            futures = [
+                pool.submit(_theil_sen_chunk, xi, chunk, method) for chunk in chunks
+            ]
+            results = [future.result() for future in futures]
+
+    return [
+        np.concatenate([result[i] for result in results]).reshape(yi.shape[:-1])
+        for i in range(4)
+    ]
+
+
+def theil_sen(xi, yi, method="auto", processes=None):
+    """
+    Calculates the Theil-Sen estimate of y = mx + c, a robust
+    non-parametric alternative to linear_regress. The gradient is the
+    median of the gradients between every pair of points, the intercept
+    the median of yi - m * xi.
+
+    args
+    ----
+    xi: numpy array of dimension 1, which must not repeat values
+    yi: dependant variable, numpy array of dimension 1, or with any number
+        of leading dimensions, e.g. (lat, lon, time), the last one must
+        match xi.
+    method: 'pairwise' finds every pairwise gradient at once, which is
+            quick but needs O(n**2) memory, 'bisect' uses an O(n log n)
+            algorithm suited to long series. The default 'auto' uses
+            'pairwise' for series of up to 300 points.
+    processes: number of processes to share the series of a large yi
+               between, defaults to None, which runs in this process.
+
+    Returns
+    -------
+    grad: gradient i.e. m in y = mx + c
+    intcp: intercept i.e. c in y = mx + c
+
+    Notes
+    -----
+    The 'bisect' method counts how many pairwise gradients are below a
+    trial value in O(n log n), as inversions of yi - trial * xi, and
+    bisects on the trial value until only the median gradient is left,
+    which is then found exactly. With tied data this may not happen, and
+    the gradient is accurate to a relative tolerance of 1e-10.
+
+    A simple example:
+
+    >>> x = np.array([1, 2, 3, 4, 5, 6, 7, 8, 9, 10])
+    >>> y = np.array([2, 4, 6, 8, 10, 12, 14, 16, 18, 100])
+    >>> grad, intcp = theil_sen(x, y)
+    >>> print("{:.2f} {:.2f}".format(grad, intcp))
+    2.00 0.00
+    >>> grad, intcp = theil_sen(x, y, method='bisect')
+    >>> print("{:.2f}".format(grad))
+    2.00
+    """
+
+    grad, intcp, z, pval = _theil_sen_rows(xi, yi, method, processes)
+
+    if np.ndim(yi) == 1:
+        return grad[()], intcp[()]
+    return grad, intcp
+
+
+def mann_kendall(xi, yi, method="auto", processes=None):
+    """
+    Mann-Kendall test for a monotonic trend in yi, ordered by xi.
+
+    args
+    ----
+    xi: numpy array of dimension 1, which must not repeat values
+    yi: numpy array of dimension 1, or with any number of leading
+        dimensions, e.g. (lat, lon, time), the last one must match xi.
+    method: 'pairwise', 'bisect' or 'auto', see theil_sen.
+    processes: number of processes to share the series of a large yi
+               between, defaults to None, which runs in this process.
+
+    Returns
+    -------
+    z: Mann-Kendall z score, positive for an increasing trend
+    pval: two sided p-value of the trend
+
+    Notes
+    -----
+    The variance of the test statistic is corrected for tied values
+    of yi. With method='bisect', the statistic is found from O(n log n)
+    inversion counts rather than every pair of points.
+
+    A simple example:
+
+    >>> x = np.array([1, 2, 3, 4, 5, 6, 7, 8, 9, 10])
+    >>> y = np.array([2, 4, 6, 8, 10, 12, 14, 16, 18, 100])
+    >>> z, pval = mann_kendall(x, y)
+    >>> print("{:.2f} {:.5f}".format(z, pval))
+    3.94 0.00008
+    """
+
+    grad, intcp, z, pval = _theil_sen_rows(xi, yi, method, processes)
+
+    if np.ndim(yi) == 1:
+        return z[()], pval[()]
+    return z, pval
+
+
+def theil_sen_cube(cube, coord="time", method="auto", processes=None):
+    """
+    Calculates the Theil-Sen estimate of y = mx + c and the Mann-Kendall
+    p-value of the trend for every grid point of a cube, where x is the
+    coordinate coord (default is time). See theil_sen and mann_kendall.
+
+    args
+    ----
+    cube: iris cube to fit, y in y = mx + c
+    coord: name of the 1D coordinate to regress against, defaults to 'time'.
+    method: 'pairwise', 'bisect' or 'auto', see theil_sen.
+    processes: number of processes to share the grid points between,
+               defaults to None, which runs in this process.
+
+    Returns
+    -------
+    grad_cube: cube of the gradient, in units of the cube per unit of coord
+    intcp_cube: cube of the intercept, in units of the cube
+    pval_cube: cube of the Mann-Kendall p-value of the trend
+
+    A simple example:
+
+    >>> time = iris.coords.DimCoord(np.arange(10.0), standard_name='time', \
+units='days since 2000-01-01')
+    >>> lat = iris.coords.DimCoord([0.0, 10.0], standard_name='latitude', \
+units='degrees')
+    >>> data = np.outer(np.arange(10.0), [2.0, -1.0]) + 5.0
+    >>> data[4] = 100.0
+    >>> cube = iris.cube.Cube(data, long_name='tas', units='K', \
+dim_coords_and_dims=[(time, 0), (lat, 1)])
+    >>> grad_cube, intcp_cube, pval_cube = theil_sen_cube(cube)
+    >>> print(grad_cube.data, grad_cube.units)
+    [ 2. -1.] (K) (days)-1
+    """
+
+    if not isinstance(cube, iris.cube.Cube):
+        raise TypeError("Input is not a cube")
+
+    xi, dim, xunits = _regress_coord(cube, coord)
+    yi = np.moveaxis(cube.data, dim, -1)
+    grad, intcp, z, pval = _theil_sen_rows(xi, yi, method, processes)
+
+    template = _collapsed_template(cube, dim)
+    name = "{} against {}".format(cube.name(), cube.coord(coord).name())
+    grad_cube = _regress_result_cube(
+        template,
+        grad,
+        "Theil-Sen gradient of " + name,
+        _gradient_units(cube.units, xunits),
+    )
+    intcp_cube = _regress_result_cube(
+        template, intcp, "Theil-Sen intercept of " + name, cube.units
+    )
+    pval_cube = _regress_result_cube(
+        template, pval, "Mann-Kendall p-value of " + name, "1"
+    )
+
+    return grad_cube, intcp_cube, pval_cube
+
+
+def correlate_index(cube, index, coord="time", min_samples=3):
+    """
+    Correlates a 1D index time series, e.g. a Nino index, with every grid
+    point of a cube, and regresses each grid point onto the index. All grid
+    points are done in one vectorised pass using centred dot products with
+    the index, rather than calling np.corrcoef per grid point.
+
+    args
+    ----
+    cube: iris cube, which must have the same number of points along coord
+          as the index
+    index: numpy array of dimension 1, or a 1D cube
+    coord: name of the coordinate of the cube the index runs along,
+           defaults to 'time'.
+    min_samples: grid points with fewer unmasked points than this are
+                 masked in the results, defaults to 3.
+
+    Returns
+    -------
+    corr_cube: cube of the correlation coefficient with the index
+    regress_cube: cube of the regression coefficient, i.e. the change of
+                  the cube per unit change of the index
+    pval_cube: cube of the two sided p-value of the correlation
+
+    Notes
+    -----
+    Lazy data is read one chunk at a time and only the final maps are
+    realised. Masked data points are left out, and the degrees of freedom
+    of each grid point are set by its own number of unmasked points.
+
+    A simple example:
+
+    >>> time = iris.coords.DimCoord(np.arange(6.0), standard_name='time', \
+units='days since 2000-01-01')
+    >>> lat = iris.coords.DimCoord([0.0, 10.0], standard_name='latitude', \
+units='degrees')
+    >>> index = np.array([0.5, -1.0, 0.2, 1.5, -0.3, 0.0])
+    >>> data = np.array([2.0 * index + 1.0, [1, 2, 0, 1, 2, 3]]).T
+    >>> cube = iris.cube.Cube(data, long_name='tas', units='K', \
+dim_coords_and_dims=[(time, 0), (lat, 1)])
+    >>> corr_cube, regress_cube, pval_cube = correlate_index(cube, index)
+    >>> print(np.round(corr_cube.data, 2), np.round(regress_cube.data, 2))
+    [ 1.   -0.44] [ 2.   -0.56]
+    """
+
+    if not isinstance(cube, iris.cube.Cube):
+        raise TypeError("Input is not a cube")
+
+    regress_units = cube.units
+    if isinstance(index, iris.cube.Cube):
+        regress_units = _gradient_units(cube.units, index.units)
+        index = index.data
+    index = np.asarray(index)
+
+    xi, dim, xunits = _regress_coord(cube, coord)
+    if index.ndim != 1 or index.shape != xi.shape:
+        raise ValueError(
+            "The index must be 1D with the same length as {}, {} and {}".format(
+                coord, str(index.shape), str(xi.shape)
+            )
+        )
+    if np.all(index == index[0]):
+        raise ValueError("The index does not vary")
+
+    # regress on the index, rather than on the coordinate
+    yi = np.moveaxis(cube.core_data(), dim, -1)
+    n, x0, y0, sx, sy, sxx, sxy, syy = _regress_sums(index, yi)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # sums of squares and products about the mean
+        cxx = sxx - sx * sx / n
+        cxy = sxy - sx * sy / n
+        cyy = syy - sy * sy / n
+        # rounding can take a perfect correlation just past 1
+        corr = np.clip(cxy / np.sqrt(cxx * cyy), -1.0, 1.0)
+        regress = cxy / cxx
+        n, cxx, corr, regress = da.compute(n, cxx, corr, regress)
+
+        # student-t test of the correlation
+        dof = n - 2
+        t_val = corr * np.sqrt(dof / (1.0 - corr ** 2))
+        pval = 2.0 * t.sf(np.abs(t_val), dof)
+
+    invalid = _invalid_fit(n, cxx, min_samples, corr.shape)
+    corr, regress, pval = [_mask_invalid(x, invalid) for x in (corr, regress, pval)]
+
+    template = _collapsed_template(cube, dim)
+    name = "{} with index".format(cube.name())
+    corr_cube = _regress_result_cube(template, corr, "correlation of " + name, "1")
+    regress_cube = _regress_result_cube(
+        template,
+        regress,
+        "regression of {} on index".format(cube.name()),
+        regress_units,
+    )
+    pval_cube = _regress_result_cube(
+        template, pval, "p-value of correlation of " + name, "1"
+    )
+
+    return corr_cube, regress_cube, pval_cube
+
+
+def _merge_sums(sums1, sums2):
+    """
+    Combines two sets of sums from _regress_sums into the sums of all
+    the points together, moving sums2 onto the shifts used by sums1.
+    """
+
+    n1, x01, y01, sx1, sy1, sxx1, sxy1, syy1 = sums1
+    n2, x02, y02, sx2, sy2, sxx2, sxy2, syy2 = sums2
+
+    # difference between the shifts of the two sets of sums
+    dx = x02 - x01
+    dy = y02 - y01
+
+    sx = sx1 + sx2 + n2 * dx
+    sy = sy1 + sy2 + n2 * dy
+    sxx = sxx1 + sxx2 + 2.0 * dx * sx2 + n2 * dx ** 2
+    sxy = sxy1 + sxy2 + dy * sx2 + dx * sy2 + n2 * dx * dy
+    syy = syy1 + syy2 + 2.0 * dy * sy2 + n2 * dy ** 2
+
+    return n1 + n2, x01, y01, sx, sy, sxx, sxy, syy
+
+
+class RegressionAccumulator(object):
+    """
+    Accumulates the sufficient statistics of y = mx + c for every grid
+    point, so that a record can be extended with new time slices (e.g.
+    a new year of model output) and the regression and confidence
+    intervals found again without rereading the whole record.
+
+    The statistics kept are n and the sums of x, y, xy, x**2 and y**2.
+    To keep the sums accurate, x is shifted by the mean x of the first
+    update and y by the first y value of each grid point before summing.
+    Accumulators can be merged, e.g. when chunks of a record have been
+    processed separately, and saved to and loaded from disk.
+
+    A simple example:
+
+    >>> acc = RegressionAccumulator()
+    >>> acc.update(np.array([0, 1, 2]), np.array([[1, 3, 5], [2, 0, 1]]))
+    >>> acc.update(np.array([3, 4]), np.array([[7, 9], [0, 2]]))
+    >>> grad, intcp, sum_res = acc.linear_regress()
+    >>> print(grad, intcp)
+    [2. 0.] [1. 1.]
+    >>> print(acc.n)
+    5
+    """
+
+    # names of the statistics when saved to disk, in the order of _regress_sums
+    _names = ["n", "x0", "y0", "sx", "sy", "sxx", "sxy", "syy"]
+
+    def __init__(self):
+        self.sums = None
+
+    @property
+    def n(self):
+        """Number of points accumulated so far, per grid point if masked."""
+        if self.sums is None:
+            return 0
+        return self.sums[0]
+
+    def update(self, xi, yi):
+        """
+        Adds new points to the accumulator.
+
+        args
+        ----
+        xi: numpy array of dimension 1
+        yi: numpy array, the last dimension must be the same length as xi.
+            The other dimensions must match previous updates.
+        """
+
+        xi = np.asarray(xi)
+        if xi.ndim != 1 or np.shape(yi)[-1:] != xi.shape:
+            raise ValueError(
+                "The last dimension of yi must match xi, got {} and {}".format(
+                    str(np.shape(yi)), str(xi.shape)
+                )
+            )
+        # realise the sums of lazy yi, reading it one chunk at a time
+        self._add(da.compute(*_regress_sums(xi, yi)))
+
+    def update_cube(self, cube, coord="time"):
+        """
+        Adds every point of a cube to the accumulator, with x taken from
+        the coordinate coord (default is time).
+
+        args
+        ----
+        cube: iris cube, e.g. a new year of model output
+        coord: name of the 1D coordinate to regress against, defaults to 'time'.
+        """
+
+        if not isinstance(cube, iris.cube.Cube):
+            raise TypeError("Input is not a cube")
+
+        xi, dim, xunits = _regress_coord(cube, coord)
+        self.update(xi, np.moveaxis(cube.core_data(), dim, -1))
+
+    def merge(self, other):
+        """
+        Adds the points accumulated by another RegressionAccumulator,
+        e.g. one which has processed a different chunk of the record.
+
+        args
+        ----
+        other: RegressionAccumulator
+        """
+
+        if not isinstance(other, RegressionAccumulator):
+            raise TypeError("Can only merge with a RegressionAccumulator")
+        if other.sums is not None:
+            self._add(other.sums)
+
+    def _add(self, sums):
+        if self.sums is None:
+            self.sums = sums
+        else:
+            if np.shape(sums[2]) != np.shape(self.sums[2]):
+                raise ValueError(
+                    "Shape {} does not match the accumulated shape {}".format(
+                        str(np.shape(sums[2])), str(np.shape(self.sums[2]))
+                    )
+                )
+            self.sums = _merge_sums(self.sums, sums)
+
+    def linear_regress(self, min_samples=3):
+        """
+        Solves y = mx + c for all the points accumulated so far.
+
+        args
+        ----
+        min_samples: grid points with fewer unmasked points than this are
+                     masked in the results, defaults to 3.
+
+        Returns
+        -------
+        grad: gradient i.e. m in y = mx + c
+        intcp: intercept i.e. c in y = mx + c
+        sum_res: sum of the squared residuals
+        """
+
+        if self.sums is None:
+            raise ValueError("Nothing has been accumulated yet")
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            grad, intcp, sum_res, xmean, sxx = _regress_fit(self.sums)
+
+        invalid = _invalid_fit(self.n, sxx, min_samples, np.shape(grad))
+        grad, intcp, sum_res = [
+            _mask_invalid(x, invalid) for x in (grad, intcp, sum_res)
+        ]
+
+        return grad, intcp, sum_res
+
+    def ci_interval(self, alpha=0.05, min_samples=3):
+        """
+        Calculates the Confidence interval (default 95%) of the gradient
+        and intercept for all the points accumulated so far.
+
+        args
+        ----
+        alpha: required confidence interval (e.g. 0.05 for 95%). Default is 0.05.
+        min_samples: grid points with fewer unmasked points than this are
+                     masked in the results, defaults to 3.
+
+        Returns
+        -------
+        slope_conf_int: Gradient of confidence interval
+        intcp_conf_int: Intercept of confidence interval
+        """
+
+        if self.sums is None:
+            raise ValueError("Nothing has been accumulated yet")
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            grad, intcp, sum_res, xmean, sxx = _regress_fit(self.sums)
+            slope_conf_int, intcp_conf_int, sd_err = _ci_fit(
+                self.n, xmean, sxx, sum_res, alpha
+            )
+
+        invalid = _invalid_fit(self.n, sxx, min_samples, np.shape(slope_conf_int))
+        slope_conf_int = _mask_invalid(slope_conf_int, invalid)
+        intcp_conf_int = _mask_invalid(intcp_conf_int, invalid)
+
+        return slope_conf_int, intcp_conf_int
+
+    def save(self, filename):
+        """
+        Saves the accumulated statistics to a numpy .npz file.
+
+        args
+        ----
+        filename: name of the file to write
+        """
+
+        if self.sums is None:
+            raise ValueError("Nothing has been accumulated yet")
+
+        np.savez(filename, **dict(zip(self._names, self.sums)))
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Loads statistics saved by RegressionAccumulator.save.
+
+        args
+        ----
+        filename: name of the .npz file to read
+
+        Returns
+        -------
+        acc: RegressionAccumulator holding the saved statistics
+        """
+
+        acc = cls()
+        with np.load(filename) as saved:
+            acc.sums = tuple(saved[name][()] for name in cls._names)
+
+        return acc
+
+
+def _grid_coords(cube):
+    """Returns the x and y dimension coordinates of a cube."""
+
+    return cube.coord(axis="X", dim_coords=True), cube.coord(axis="Y", dim_coords=True)
+
+
+def _grid_fingerprint(cube):
+    """
+    Returns a hash of the horizontal grid of a cube, made from the names,
+    units, coordinate systems, points and bounds of its x and y
+    coordinates. Cubes on the same grid have the same fingerprint,
+    whatever their data and other coordinates.
+    """
+
+    sha = hashlib.sha1()
+    for coord in _grid_coords(cube):
+        header = (
+            coord.name(),
+            str(coord.units),
+            repr(coord.coord_system),
+            coord.shape,
+            getattr(coord, "circular", False),
+        )
+        sha.update(repr(header).encode())
+        sha.update(np.ascontiguousarray(coord.points, dtype=np.float64).tobytes())
+        if coord.has_bounds():
+            sha.update(np.ascontiguousarray(coord.bounds, dtype=np.float64).tobytes())
+
+    return sha.hexdigest()
+
+
+def _regrid_key(cube, target_cube, method, extrap, mdtol):
+    """
+    Returns a hash identifying the regridding of the grid of cube onto
+    the grid of target_cube with the given method, extrap and mdtol.
+    """
+
+    key = (_grid_fingerprint(cube), _grid_fingerprint(target_cube))
+    key += (method, extrap, float(mdtol))
+
+    return hashlib.sha1(repr(key).encode()).hexdigest()
+
+
+def _regrid_scheme(cube, target_cube, method, extrap, mdtol):
+    """
+    Returns the iris regridding scheme for method. For areaweighted,
+    missing bounds are guessed and the two cubes must share the same
+    coordinate system. conservative has no iris scheme, so only the
+    bounds are guessed and None is returned.
+    """
+
+    if method == "linear":
+        return iris.analysis.Linear(extrapolation_mode=extrap)
+
+    if method == "nearest":
+        return iris.analysis.Nearest(extrapolation_mode=extrap)
+
+    # areaweighted is VERY picky and often can't be used.
+    if method in ["areaweighted", "conservative"]:
+        xcoord, ycoord = _grid_coords(cube)
+        t_xcoord, t_ycoord = _grid_coords(target_cube)
+
+        if not xcoord.has_bounds():
+            print("Input cube to be regrided does not have lon bounds, guessing . . . ")
+            xcoord.guess_bounds()
+        if not ycoord.has_bounds():
+            print("Input cube to be regrided does not have lat bounds, guessing . . . ")
+            ycoord.guess_bounds()
+
+        if not t_xcoord.has_bounds():
+            print("Input target_cube does not have lon bounds, guessing . . . ")
+            t_xcoord.guess_bounds()
+        if not t_ycoord.has_bounds():
+            print("Input target_cube does not have lat bounds, guessing . . . ")
+            t_ycoord.guess_bounds()
+
+        if method == "conservative":
+            return None
+
+        if xcoord.coord_system != t_xcoord.coord_system:
+            raise ValueError(
+                "The input cubes must have the same coordinate system, "
+                "use method 'conservative' to regrid between them"
+            )
+
+        return iris.analysis.AreaWeighted(mdtol=mdtol)
+
+    raise ValueError(
+        "method must be 'linear', 'nearest', 'areaweighted' or 'conservative', "
+        "not {}".format(method)
+    )
+
+
+def _probe_classes(npts, spacing, circular):
+    """
+    Splits the indices 0 to npts - 1 into classes, so that any spacing
+    consecutive indices are in different classes. For circular
+    coordinates this also holds across the wrap from the last index
+    to the first.
+
+    Returns
+    -------
+    classes: array of the class of each index
+    nclasses: the number of classes
+    """
+
+    classes = np.arange(npts) % spacing
+    nclasses = min(spacing, npts)
+    tail = npts % spacing
+    if circular and tail and npts > spacing:
+        # the last few indices get classes of their own, so they
+        # never share one with the first few indices
+        classes[npts - tail :] = spacing + np.arange(tail)
+        nclasses = spacing + tail
+
+    return classes, nclasses
+
+
+def _probe_spacing(coord, t_coord, method):
+    """
+    Returns the number of consecutive source points along coord that can
+    contribute to one target point of t_coord, plus one.
+    """
+
+    if method == "nearest":
+        return 1
+    if method == "linear":
+        return 2
+
+    t_width = np.max(np.abs(np.diff(t_coord.bounds, axis=1)))
+    t_width = t_coord.units.convert(t_width, coord.units)
+    width = np.min(np.abs(np.diff(coord.bounds, axis=1)))
+
+    return 2 + int(np.ceil(t_width / width))
+
+
+def _probe_weights(cube, target_cube, scheme, method):
+    """
+    Works out the weights used by an iris regridding scheme, as a sparse
+    matrix mapping the flattened (y, x) source grid to the flattened
+    target grid.
+
+    The source points are split into classes so that each target point
+    takes at most one point from each class, see _probe_classes. Each
+    class is then regridded twice by the scheme itself, once as ones on
+    the class, giving the weight of its point, and once as the flat index
+    of the points in the class, giving which point it is. So the weights
+    are exactly those of iris, for any scheme, at the cost of regridding a
+    few fields.
+
+    Returns
+    -------
+    weights: scipy.sparse.csr_matrix of shape (target points, source points)
+    outside: boolean array, True for target points outside the source grid
+    """
+
+    xcoord, ycoord = _grid_coords(cube)
+    t_xcoord, t_ycoord = _grid_coords(target_cube)
+    ny, nx = len(ycoord.points), len(xcoord.points)
+    x_classes, nx_classes = _probe_classes(
+        nx, _probe_spacing(xcoord, t_xcoord, method), xcoord.circular
+    )
+    y_classes, ny_classes = _probe_classes(
+        ny, _probe_spacing(ycoord, t_ycoord, method), False
+    )
+
+    grid_cube = iris.cube.Cube(
+        np.zeros((ny, nx)),
+        dim_coords_and_dims=[(ycoord.copy(), 0), (xcoord.copy(), 1)],
+    )
+    regridder = scheme.regridder(grid_cube, target_cube)
+    # one plus the flat index, so the first point has a non-zero index
+    index = np.arange(1.0, ny * nx + 1.0).reshape(ny, nx)
+
+    classes = [(iy, ix) for iy in range(ny_classes) for ix in range(nx_classes)]
+    # regrid a few classes at a time, to limit the memory used
+    batch = max(1, 2 ** 23 // (ny * nx))
+    rows, cols, values = [], [], []
+    outside = None
+    for start in range(0, len(classes), batch):
+        probes = []
+        for iy, ix in classes[start : start + batch]:
+            ones = np.outer(y_classes == iy, x_classes == ix).astype(np.float64)
+            probes += [ones, ones * index]
+        probe_cube = iris.cube.Cube(
+            np.array(probes),
+            dim_coords_and_dims=[(ycoord.copy(), 1), (xcoord.copy(), 2)],
+        )
+        result = regridder(probe_cube).data
+        weight = np.ma.filled(result[0::2], np.nan).reshape(len(probes) // 2, -1)
+        point = np.ma.filled(result[1::2], np.nan).reshape(len(probes) // 2, -1)
+        if outside is None:
+            # masked or nan whatever the data, so outside the source grid
+            outside = ~np.isfinite(weight[0])
+
+        found = np.isfinite(weight) & (weight != 0.0)
+        rows.append(np.nonzero(found)[1])
+        values.append(weight[found])
+        cols.append(np.rint(point[found] / weight[found]).astype(np.int64) - 1)
+
+    weights = scipy.sparse.csr_matrix(
+        (np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(len(outside), ny * nx),
+    )
+
+    return weights, outside
+
+
+def _strip_weights(cube, target_cube, scheme, method, axis):
+    """
+    Works out the weights of an iris regridding scheme along one axis of
+    the grid, 'x' or 'y', with _probe_weights, from a strip of the source
+    grid two cells across the other axis onto the first of those cells.
+    The target cell is the source cell, so along the other axis all the
+    weight is on it.
+
+    Returns
+    -------
+    weights: scipy.sparse.csr_matrix of shape (target points, source points)
+             along axis
+    outside: boolean array, True for target points outside the source grid
+    """
+
+    coords = list(_grid_coords(cube))
+    t_coords = list(_grid_coords(target_cube))
+    # the other axis, 1 for y, as coords are (x, y)
+    other = 1 if axis == "x" else 0
+    strip = coords[other][:2].copy()
+    strip.circular = False
+    t_coords[other] = strip[:1].copy()
+    coords[other] = strip
+    grid_cube = iris.cube.Cube(
+        np.zeros((len(coords[1].points), len(coords[0].points))),
+        dim_coords_and_dims=[(coords[1], 0), (coords[0], 1)],
+    )
+    t_grid_cube = iris.cube.Cube(
+        np.zeros((len(t_coords[1].points), len(t_coords[0].points))),
+        dim_coords_and_dims=[(t_coords[1], 0), (t_coords[0], 1)],
+    )
+    weights, outside = _probe_weights(grid_cube, t_grid_cube, scheme, method)
+
+    # keep the weights of the first cell of the strip
+    if axis == "x":
+        return weights[:, : len(coords[0].points)], outside
+    return weights[:, 0::2], outside
+
+
+def _regrid_weights(cube, target_cube, scheme, method):
+    """
+    Works out the weights used by an iris regridding scheme, as a sparse
+    matrix mapping the flattened (y, x) source grid to the flattened
+    target grid, see _probe_weights.
+
+    Between grids on the same coordinate system, every scheme regrids x
+    and y separately, so the weights are products of weights along x and
+    along y. Then these are found with _strip_weights, which only regrids
+    a few strips two cells wide rather than fields the size of the source
+    grid, and multiplied together, giving the weights of iris to rounding.
+
+    Returns
+    -------
+    weights: scipy.sparse.csr_matrix of shape (target points, source points)
+    outside: boolean array, True for target points outside the source grid
+    """
+
+    xcoord, ycoord = _grid_coords(cube)
+    t_xcoord, t_ycoord = _grid_coords(target_cube)
+    if (
+        xcoord.coord_system != t_xcoord.coord_system
+        or ycoord.coord_system != t_ycoord.coord_system
+        or len(xcoord.points) < 2
+        or len(ycoord.points) < 2
+    ):
+        return _probe_weights(cube, target_cube, scheme, method)
+
+    x_weights, x_outside = _strip_weights(cube, target_cube, scheme, method, "x")
+    y_weights, y_outside = _strip_weights(cube, target_cube, scheme, method, "y")
+    weights = scipy.sparse.kron(y_weights, x_weights, format="csr")
+    outside = np.logical_or.outer(y_outside, x_outside).ravel()
+
+    return weights, outside
+
+
+def _cell_edges(xcoord, ycoord, nseg):
+    """
+    Returns the x and y, in degrees, of points along the edges of every
+    cell of a rectilinear grid, going round each cell from its lower left
+    corner with each edge split into nseg segments.
+
+    Returns
+    -------
+    xs, ys: arrays of shape (ny, nx, 4 * nseg)
+    """
+
+    xbounds = xcoord.units.convert(xcoord.bounds, "degrees")
+    ybounds = ycoord.units.convert(ycoord.bounds, "degrees")
+    frac = np.arange(nseg) / float(nseg)
+
+    x0 = xbounds[np.newaxis, :, 0:1]
+    x1 = xbounds[np.newaxis, :, 1:2]
+    y0 = ybounds[:, np.newaxis, 0:1]
+    y1 = ybounds[:, np.newaxis, 1:2]
+    # bottom, right, top and left edges
+    xs = [x0 + (x1 - x0) * frac, x1 + 0 * frac, x1 + (x0 - x1) * frac, x0 + 0 * frac]
+    ys = [y0 + 0 * frac, y0 + (y1 - y0) * frac, y1 + 0 * frac, y1 + (y0 - y1) * frac]
+    shape = (len(ybounds), len(xbounds), nseg)
+    xs = np.concatenate([np.broadcast_to(x, shape) for x in xs], axis=-1)
+    ys = np.concatenate([np.broadcast_to(y, shape) for y in ys], axis=-1)
+
+    return xs, ys
+
+
+def _overlap_ranges(lower, upper, lo, hi):
+    """
+    Returns the start and end, in the order of lower, of the cells with
+    edges lower and upper, sorted in increasing order, that overlap each
+    of the ranges lo to hi.
+    """
+
+    start = np.searchsorted(upper, lo, side="right")
+    end = np.searchsorted(lower, hi, side="left")
+
+    return start, np.maximum(end, start)
+
+
+def _clipped_areas(xs, ys, xlower, ylower, xupper, yupper):
+    """
+    Returns the areas of polygons clipped to rectangles, for many pairs of
+    polygon and rectangle at once, using the Sutherland-Hodgman algorithm,
+    which is exact for any simple polygon clipped to a convex shape.
+
+    args
+    ----
+    xs, ys: x and y of the vertices of each polygon, of shape (pairs, vertices)
+    xlower, ylower, xupper, yupper: edges of each rectangle, of shape (pairs,)
+
+    Returns
+    -------
+    areas: array of the area of each clipped polygon
+    """
+
+    for along_x, bound, sign in [
+        (True, xlower, 1.0),
+        (True, xupper, -1.0),
+        (False, ylower, 1.0),
+        (False, yupper, -1.0),
+    ]:
+        # keep the part of each polygon on the inside of one edge,
+        # going along the edges of the polygon from p to q
+        next_xs, next_ys = np.roll(xs, -1, axis=1), np.roll(ys, -1, axis=1)
+        p_coord, q_coord = (xs, next_xs) if along_x else (ys, next_ys)
+        bound = bound[:, np.newaxis]
+        p_in = sign * (p_coord - bound) >= 0.0
+        q_in = sign * (q_coord - bound) >= 0.0
+        cross = p_in != q_in
+        with np.errstate(divide="ignore", invalid="ignore"):
+            frac = np.where(cross, (bound - p_coord) / (q_coord - p_coord), 0.0)
+
+        # each edge gives the crossing point and q, if they are kept
+        first_xs = np.where(cross, xs + frac * (next_xs - xs), next_xs)
+        first_ys = np.where(cross, ys + frac * (next_ys - ys), next_ys)
+        keep_first = cross | q_in
+        keep_second = ~p_in & q_in
+        xs = np.stack([first_xs, next_xs], axis=2).reshape(len(xs), -1)
+        ys = np.stack([first_ys, next_ys], axis=2).reshape(len(ys), -1)
+        keep = np.stack([keep_first, keep_second], axis=2).reshape(len(xs), -1)
+
+        # move the kept vertices to the front, and repeat the last kept
+        # vertex after them, which adds nothing to the area
+        order = np.argsort(~keep, axis=1, kind="stable")
+        count = np.sum(keep, axis=1)
+        width = max(int(count.max()), 1)
+        order = order[:, :width]
+        count = count[:, np.newaxis]
+        last = np.take_along_axis(order, np.maximum(count - 1, 0), axis=1)
+        order = np.where(np.arange(width) < count, order, last)
+        xs = np.where(count > 0, np.take_along_axis(xs, order, axis=1), 0.0)
+        ys = np.where(count > 0, np.take_along_axis(ys, order, axis=1), 0.0)
+
+    return _polygon_areas(xs, ys)
+
+
+def _polygon_areas(xs, ys):
+    """
+    Returns the areas of polygons with vertices xs, ys, of shape
+    (polygons, vertices), using the shoelace formula.
+    """
+
+    return 0.5 * np.abs(
+        np.sum(xs * np.roll(ys, -1, axis=1) - np.roll(xs, -1, axis=1) * ys, axis=1)
+    )
+
+
+def _conservative_weights(cube, target_cube, nseg=None, batch=200000):
+    """
+    Works out the weights of conservative, i.e. area weighted, regridding
+    between two rectilinear grids on any coordinate systems, as a sparse
+    matrix mapping the flattened (y, x) source grid to the flattened
+    target grid.
+
+    The edges of the target cells are split into nseg segments, by default
+    about one per degree up to 8, and moved into the coordinate system of
+    the source, where the source cells are lat-lon rectangles. Both are
+    then mapped onto a cylindrical equal area projection (x = longitude,
+    y = sin(latitude)), where areas are the same as on the sphere and the
+    source cells are still rectangles, so the area of each overlap of a
+    target cell with a source cell is found by clipping, batch overlaps
+    at a time.
+
+    Returns
+    -------
+    weights: scipy.sparse.csr_matrix of shape (target points, source
+             points), each row summing to one over the source cells that
+             overlap the target cell
+    outside: boolean array, True for target cells that overlap no source cell
+    """
+
+    xcoord, ycoord = _grid_coords(cube)
+    t_xcoord, t_ycoord = _grid_coords(target_cube)
+    ny, nx = len(ycoord.points), len(xcoord.points)
+
+    # target cell edges in the coordinate system of the source, split
+    # finely enough to follow their curves in that system
+    cs, t_cs = xcoord.coord_system, t_xcoord.coord_system
+    if nseg is None:
+        width = max(
+            np.max(np.abs(np.diff(t_coord.units.convert(t_coord.bounds, "degrees"))))
+            for t_coord in [t_xcoord, t_ycoord]
+        )
+        nseg = 1 if cs == t_cs else int(np.clip(np.ceil(width), 1, 8))
+    xs, ys = _cell_edges(t_xcoord, t_ycoord, nseg)
+    xs = xs.reshape(-1, 4 * nseg)
+    ys = ys.reshape(-1, 4 * nseg)
+    if cs != t_cs:
+        if cs is None or t_cs is None:
+            raise ValueError(
+                "Both cubes need a coordinate system to regrid between them"
+            )
+        points = cs.as_cartopy_crs().transform_points(t_cs.as_cartopy_crs(), xs, ys)
+        xs, ys = points[..., 0], points[..., 1]
+
+    # keep each cell in one piece across the longitude seam, and start
+    # it within 360 degrees above the lowest source longitude
+    xbounds = np.sort(xcoord.units.convert(xcoord.bounds, "degrees"), axis=1)
+    ybounds = np.sort(ycoord.units.convert(ycoord.bounds, "degrees"), axis=1)
+    xs = xs[:, :1] + (xs - xs[:, :1] + 180.0) % 360.0 - 180.0
+    xs -= 360.0 * np.floor((xs[:, :1] - xbounds.min()) / 360.0)
+
+    # cylindrical equal area projection
+    xs, ys = np.radians(xs), np.sin(np.radians(np.clip(ys, -90.0, 90.0)))
+    xs_min, xs_max = xs.min(axis=1), xs.max(axis=1)
+    ys_min, ys_max = ys.min(axis=1), ys.max(axis=1)
+    areas_t = _polygon_areas(xs, ys)
+    xlower, xupper = np.radians(xbounds[:, 0]), np.radians(xbounds[:, 1])
+    ylower = np.sin(np.radians(ybounds[:, 0]))
+    yupper = np.sin(np.radians(ybounds[:, 1]))
+    xorder, yorder = np.argsort(xlower), np.argsort(ylower)
+
+    empty = np.zeros(0, dtype=np.int64)
+    rows, cols, areas = [empty], [empty], [np.zeros(0)]
+    for shift in [-2.0 * np.pi, 0.0, 2.0 * np.pi]:
+        # find the source cells overlapping the bounding box of each
+        # target cell, moved by shift to catch overlaps across the seam
+        xstart, xend = _overlap_ranges(
+            xlower[xorder], xupper[xorder], xs_min + shift, xs_max + shift
+        )
+        ystart, yend = _overlap_ranges(ylower[yorder], yupper[yorder], ys_min, ys_max)
+        counts = (xend - xstart) * (yend - ystart)
+        target = np.repeat(np.arange(len(counts)), counts)
+        offset = np.arange(len(target)) - np.repeat(np.cumsum(counts) - counts, counts)
+        width = (xend - xstart)[target]
+        ix = xorder[xstart[target] + offset % np.maximum(width, 1)]
+        iy = yorder[ystart[target] + offset // np.maximum(width, 1)]
+
+        for start in range(0, len(target), batch):
+            part = slice(start, start + batch)
+            tpart, ixpart, iypart = target[part], ix[part], iy[part]
+            overlap = np.zeros(len(tpart))
+
+            # target cells inside one source cell overlap by their own area
+            inside = (
+                (xs_min[tpart] + shift >= xlower[ixpart])
+                & (xs_max[tpart] + shift <= xupper[ixpart])
+                & (ys_min[tpart] >= ylower[iypart])
+                & (ys_max[tpart] <= yupper[iypart])
+            )
+            overlap[inside] = areas_t[tpart[inside]]
+            todo = np.nonzero(~inside)[0]
+            if len(todo) > 0:
+                overlap[todo] = _clipped_areas(
+                    xs[tpart[todo]] + shift,
+                    ys[tpart[todo]],
+                    xlower[ixpart[todo]],
+                    ylower[iypart[todo]],
+                    xupper[ixpart[todo]],
+                    yupper[iypart[todo]],
+                )
+
+            found = overlap > 0.0
+            rows.append(tpart[found])
+            cols.append(iypart[found] * nx + ixpart[found])
+            areas.append(overlap[found])
+
+    weights = scipy.sparse.csr_matrix(
+        (np.concatenate(areas), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(len(xs), ny * nx),
+    )
+    # weight by the fraction of the overlapping area of each target cell
+    totals = np.asarray(weights.sum(axis=1)).ravel()
+    outside = totals == 0.0
+    weights = scipy.sparse.diags(1.0 / np.where(outside, 1.0, totals)) @ weights
+
+    return scipy.sparse.csr_matrix(weights), outside
+
+
+def _bounds_in_degrees(coord):
+    """Returns the lower and upper bounds of coord in degrees, guessing any missing."""
+
+    if not coord.has_bounds():
+        coord = coord.copy()
+        coord.guess_bounds()
+    return np.sort(coord.units.convert(coord.bounds, "degrees"), axis=1).T
+
+
+def _source_cs_points(xs, ys, cs, t_cs, t_xcoord, t_xbounds, t_ybounds):
+    """
+    Moves the points xs, ys of a target grid, with bounds t_xbounds and
+    t_ybounds, from its coordinate system t_cs into cs, the coordinate
+    system of the source, dropping any that have no place in it.
+
+    Returns
+    -------
+    xs, ys: the points in cs
+    all_x: True if the target grid is round a pole of cs, in which case
+           the pole is added to ys and all the source longitudes are needed
+    """
+
+    points = cs.as_cartopy_crs().transform_points(t_cs.as_cartopy_crs(), xs, ys)
+    xs, ys = points[:, 0], points[:, 1]
+    finite = np.isfinite(xs) & np.isfinite(ys)
+    xs, ys = xs[finite], ys[finite]
+
+    # a target grid round a pole of the source needs all its longitudes
+    all_x = False
+    t_xmin, t_xmax = t_xbounds.min(), t_xbounds.max()
+    t_ymin, t_ymax = t_ybounds.min(), t_ybounds.max()
+    for pole in [90.0, -90.0]:
+        x, y = t_cs.as_cartopy_crs().transform_point(0.0, pole, cs.as_cartopy_crs())
+        if t_xcoord.units.is_convertible("degrees"):
+            x = t_xmin + (x - t_xmin) % 360.0
+        if t_xmin <= x <= t_xmax and t_ymin <= y <= t_ymax:
+            ys = np.append(ys, pole)
+            all_x = True
+
+    return xs, ys, all_x
+
+
+def _subset_columns(xcoord, xs, halo, all_x=False):
+    """
+    Returns the indices of the columns of the source grid of xcoord that
+    overlap the shortest arc of longitude holding all of the longitudes xs,
+    plus halo columns either side, or None if no column overlaps. On a
+    circular grid the columns may wrap past the last column, round the seam.
+    All the columns are returned if all_x is True.
+    """
+
+    # the shortest arc starts after the largest gap between the longitudes
+    nx = len(xcoord.points)
+    xlower, xupper = _bounds_in_degrees(xcoord)
+    rel = np.sort((xs - xlower.min()) % 360.0)
+    gaps = np.diff(np.append(rel, rel[0] + 360.0))
+    gap = np.argmax(gaps)
+    start = xlower.min() + rel[(gap + 1) % len(rel)]
+    cell_start = (xlower - start) % 360.0
+    columns = cell_start <= 360.0 - gaps[gap]
+    columns |= cell_start + xupper - xlower >= 360.0
+    if not np.any(columns):
+        return None
+    if all_x or np.all(columns):
+        return np.arange(nx)
+
+    # the columns are in one run, which may wrap past the last column
+    found = np.nonzero(columns)[0]
+    wraps = found[-1] - found[0] + 1 > len(found)
+    first = np.nonzero(~columns)[0][-1] + 1 if wraps else found[0]
+    first, length = first - halo, len(found) + 2 * halo
+    if xcoord.circular and length < nx:
+        return (first + np.arange(length)) % nx
+    if not xcoord.circular and not wraps:
+        return np.arange(max(first, 0), min(first + length, nx))
+    return np.arange(nx)
+
+
+def _source_subset(cube, target_cube, halo=2):
+    """
+    Works out the part of the source grid of cube needed to regrid onto
+    the grid of target_cube: the source cells under the target grid, once
+    moved into the coordinate system of the source, plus halo cells all
+    round. The part may wrap round the seam of a circular source grid.
+
+    Returns
+    -------
+    None if the whole source grid is needed, or can't be trimmed, else
+
+    grid_cube: cube of zeros on the needed part of the source grid, with
+               longitudes past the seam moved by 360 degrees
+    yindex, xindex: indices of the rows and columns of the source grid
+                    that make up grid_cube
+    """
+
+    xcoord, ycoord = _grid_coords(cube)
+    t_xcoord, t_ycoord = _grid_coords(target_cube)
+    cs, t_cs = xcoord.coord_system, t_xcoord.coord_system
+    ny, nx = len(ycoord.points), len(xcoord.points)
+    degrees = cf_units.Unit("degrees")
+    if cs != t_cs and (cs is None or t_cs is None):
+        return None
+    if min(ny, nx) < 2 or not all(
+        coord.units.is_convertible(degrees) for coord in [xcoord, ycoord]
+    ):
+        return None
+
+    # corners of the target cells, and points along the edges of the whole
+    # target grid to follow its curves in the coordinate system of the source
+    t_bounds = []
+    for coord in [t_xcoord, t_ycoord]:
+        if not coord.has_bounds():
+            if len(coord.points) < 2:
+                return None
+            coord = coord.copy()
+            coord.guess_bounds()
+        for units in [degrees, cf_units.Unit("m"), None]:
+            if units is None:
+                return None
+            if coord.units.is_convertible(units):
+                t_bounds.append(np.unique(coord.units.convert(coord.bounds, units)))
+                break
+    t_xbounds, t_ybounds = t_bounds
+    t_xmin, t_xmax = t_xbounds.min(), t_xbounds.max()
+    t_ymin, t_ymax = t_ybounds.min(), t_ybounds.max()
+    xs, ys = np.meshgrid(t_xbounds, t_ybounds)
+    xline = np.linspace(t_xmin, t_xmax, 8 * len(t_xbounds))
+    yline = np.linspace(t_ymin, t_ymax, 8 * len(t_ybounds))
+    xedge, yedge = np.full_like(yline, t_xmin), np.full_like(xline, t_ymin)
+    xs = np.concatenate([xs.ravel(), xline, xline, xedge, xedge - t_xmin + t_xmax])
+    ys = np.concatenate([ys.ravel(), yedge, yedge - t_ymin + t_ymax, yline, yline])
+
+    all_x = False
+    if cs != t_cs:
+        xs, ys, all_x = _source_cs_points(
+            xs, ys, cs, t_cs, t_xcoord, t_xbounds, t_ybounds
+        )
+    if len(xs) == 0:
+        return None
+
+    # rows of source cells overlapping the range of target latitudes
+    ylower, yupper = _bounds_in_degrees(ycoord)
+    rows = np.nonzero((yupper >= ys.min()) & (ylower <= ys.max()))[0]
+    if len(rows) == 0:
+        return None
+    yindex = np.arange(max(rows.min() - halo, 0), min(rows.max() + halo + 1, ny))
+
+    xindex = _subset_columns(xcoord, xs, halo, all_x)
+    if xindex is None or (len(yindex) == ny and len(xindex) == nx):
+        return None
+
+    # longitudes past the seam move on by 360 degrees, keeping them monotonic
+    period = degrees.convert(360.0, xcoord.units)
+    shift = np.sign(xcoord.points[-1] - xcoord.points[0]) * period
+    shift = np.where(xindex < xindex[0], shift, 0.0)
+    bounds = None
+    if xcoord.has_bounds():
+        bounds = xcoord.bounds[xindex] + shift[:, np.newaxis]
+    sub_xcoord = xcoord.copy(xcoord.points[xindex] + shift, bounds)
+    sub_xcoord.circular = xcoord.circular and len(xindex) == nx
+    sub_ycoord = ycoord[yindex[0] : yindex[-1] + 1].copy()
+
+    grid_cube = iris.cube.Cube(
+        np.zeros((len(yindex), len(xindex))),
+        dim_coords_and_dims=[(sub_ycoord, 0), (sub_xcoord, 1)],
+    )
+
+    return grid_cube, yindex, xindex
+
+
+class SparseRegridder(object):
+    """
+    Regrids cubes from one horizontal grid to another by multiplying the
+    data by a sparse matrix of weights. The weights are worked out once,
+    from the iris scheme for the regridding method, so each cube on the
+    source grid then costs a single sparse matrix multiplication for all
+    of its time steps and levels. Cubes with lazy data are regridded
+    lazily, one dask chunk of time steps and levels at a time.
+
+    Usually made by set_regridder, and called like an iris regridder,
+    regridder(cube).
+
+    args
+    ----
+    cube: cube on the source grid
+    target_cube: cube on the target grid
+    weights: scipy sparse matrix of the weights, of shape
+             (target points, source points), with the points of
+             each grid flattened in (y, x) order
+    outside: boolean array, True for target points outside the source grid
+    method: method of regridding, 'linear', 'nearest', 'areaweighted' or
+            'conservative'.
+    extrap: extrapolation mode for points outside the source grid,
+            'mask', 'nan', 'nanmask', 'error' or 'extrapolate'.
+    mdtol: tolerated fraction of masked data in any given target grid-box,
+           used by areaweighted and conservative. linear and nearest mask
+           any target point that takes a weight from a masked point.
+
+    Notes
+    -----
+    Coordinates of the regridded cube are set as iris does: the x and y
+    coordinates come from target_cube, coordinates that do not span the
+    grid are copied, and reference surfaces of derived coordinates, e.g.
+    surface altitude, are regridded too.
+    """
+
+    def __init__(
+        self, cube, target_cube, weights, outside, method, extrap="mask", mdtol=0.5
+    ):
+        xcoord, ycoord = _grid_coords(cube)
+        t_xcoord, t_ycoord = _grid_coords(target_cube)
+
+        self.fingerprint = _grid_fingerprint(cube)
+        self.src_shape = (len(ycoord.points), len(xcoord.points))
+        self.target_coords = (t_ycoord.copy(), t_xcoord.copy())
+        self.shape = (len(t_ycoord.points), len(t_xcoord.points))
+        self.weights = scipy.sparse.csr_matrix(weights)
+        self.outside = np.asarray(outside, dtype=bool)
+        self.method = method
+        self.extrap = extrap
+        # linear and nearest mask any target point with a masked source
+        self.mdtol = mdtol if method in ["areaweighted", "conservative"] else 0.0
+
+        # magnitudes of the weights, so masked points still count
+        # against mdtol where linear extrapolation makes weights negative
+        self._abs_weights = abs(self.weights)
+        self._abs_totals = np.asarray(self._abs_weights.sum(axis=1)).ravel()
+
+    def _regrid_array(self, data):
+        """
+        Regrids a numpy or numpy masked array of shape
+        (slices, source points), returning (slices, target points).
+        """
+
+        masked = np.ma.isMaskedArray(data)
+        mask = np.ma.getmaskarray(data) if masked else None
+        if masked and np.any(mask):
+            values = (self.weights @ np.ma.filled(data, 0.0).T).T
+            counts = (self.weights @ (~mask).T.astype(np.float64)).T
+            masked_weight = (self._abs_weights @ mask.T.astype(np.float64)).T
+            with np.errstate(divide="ignore", invalid="ignore"):
+                values = values / counts
+                masked_frac = masked_weight / self._abs_totals
+            result_mask = ~(masked_frac <= self.mdtol) | (counts == 0.0)
+        else:
+            values = (self.weights @ np.ma.getdata(data).T).T
+            result_mask = np.zeros(values.shape, dtype=bool)
+
+        # fill target points outside the source grid, as iris does
+        if self.extrap == "nan" or (self.extrap == "nanmask" and not masked):
+            values[:, self.outside] = np.nan
+            result_mask[:, self.outside] = False
+        else:
+            result_mask[:, self.outside] = True
+
+        values = values.astype(self._result_dtype(data.dtype), copy=False)
+
+        if np.any(result_mask):
+            return np.ma.masked_array(values, result_mask)
+        return values
+
+    def _result_dtype(self, dtype):
+        """
+        Returns the type of the regridded data for source data of type
+        dtype. Floats keep their type, nearest keeps any type unless NaN
+        can be put outside the source grid, and the rest become float64.
+        """
+
+        if np.issubdtype(dtype, np.floating):
+            return dtype
+        if self.method == "nearest" and not (
+            self.extrap in ["nan", "nanmask"] and np.any(self.outside)
+        ):
+            return dtype
+        return np.dtype(np.float64)
+
+    def _regrid_data(self, data, dims):
+        """
+        Regrids an array whose source grid is on dims, the (y, x)
+        dimensions of the array.
+        """
+
+        data = np.moveaxis(data, dims, (-2, -1))
+        lead = data.shape[:-2]
+        result = self._regrid_array(data.reshape((-1, data.shape[-2] * data.shape[-1])))
+
+        return np.moveaxis(result.reshape(lead + self.shape), (-2, -1), dims)
+
+    def __call__(self, cube):
+        """
+        Regrids cube, which must be on the source grid of the regridder.
+
+        args
+        ----
+        cube: cube to regrid
+
+        Returns
+        -------
+        cube_reg: cube on the target grid
+        """
+
+        if not isinstance(cube, iris.cube.Cube):
+            raise TypeError("Input is not a cube")
+
+        if _grid_fingerprint(cube) != self.fingerprint:
+            raise ValueError("The cube is not on the source grid of this regridder")
+
+        return self._regrid_cube(cube)
+
+    def _regrid_cube(self, cube):
+        """Regrids cube, already known to be on the source grid."""
+
+        xcoord, ycoord = _grid_coords(cube)
+        dims = (cube.coord_dims(ycoord)[0], cube.coord_dims(xcoord)[0])
+        if cube.has_lazy_data():
+            data = self._regrid_lazy(cube.lazy_data(), dims)
+        else:
+            data = self._regrid_data(cube.data, dims)
+
+        return self._result_cube(cube, data, dims)
+
+    def _regrid_lazy(self, data, dims):
+        """
+        Regrids a dask array whose source grid is on dims, block by block
+        along the other dimensions, e.g. time and level, keeping it lazy.
+        """
+
+        # every block needs the whole source grid
+        if any(len(data.chunks[dim]) > 1 for dim in dims):
+            data = data.rechunk(
+                {dim: -1 if dim in dims else "auto" for dim in range(data.ndim)}
+            )
+
+        chunks = list(data.chunks)
+        chunks[dims[0]], chunks[dims[1]] = (self.shape[0],), (self.shape[1],)
+        dtype = self._result_dtype(data.dtype)
+
+        return data.map_blocks(
+            self._regrid_data,
+            dims,
+            chunks=tuple(chunks),
+            dtype=dtype,
+            meta=np.ma.masked_array(np.empty((0,) * data.ndim, dtype=dtype)),
+        )
+
+    def _result_cube(self, cube, data, dims):
+        """Makes the regridded cube, with the data already regridded."""
+
+        result = iris.cube.Cube(data)
+        result.metadata = cube.metadata
+        result.add_dim_coord(self.target_coords[0].copy(), dims[0])
+        result.add_dim_coord(self.target_coords[1].copy(), dims[1])
+
+        # copy the coordinates that don't span the grid
+        coord_mapping = {}
+        for coords, add_coord in [
+            (cube.dim_coords, result.add_dim_coord),
+            (cube.aux_coords, result.add_aux_coord),
+        ]:
+            for coord in coords:
+                coord_dims = cube.coord_dims(coord)
+                if set(coord_dims) & set(dims):
+                    continue
+                if iris.util.guess_coord_axis(coord) in ["X", "Y"]:
+                    continue
+                new_coord = coord.copy()
+                add_coord(new_coord, coord_dims)
+                coord_mapping[id(coord)] = new_coord
+
+        # regrid the reference surfaces of derived coordinates
+        for factory in cube.aux_factories:
+            for coord in factory.dependencies.values():
+                if coord is None or id(coord) in coord_mapping:
+                    continue
+                coord_dims = cube.coord_dims(coord)
+                if sorted(coord_dims) != sorted(dims):
+                    break
+                # the positions of y and x among the dimensions of coord
+                coord_yx = tuple(np.argsort(np.argsort(dims)))
+                points = self._regrid_data(coord.points, coord_yx)
+                new_coord = coord.copy(np.ma.filled(points, np.nan))
+                result.add_aux_coord(new_coord, tuple(sorted(dims)))
+                coord_mapping[id(coord)] = new_coord
+            else:
+                result.add_aux_factory(factory.updated(coord_mapping))
+
+        return result
+
+
+def _sparse_regridder(cube, target_cube, method, extrap, mdtol, cache_dir=None):
+    """
+    Returns a SparseRegridder. If cache_dir is given, the weights of
+    areaweighted and conservative are read from there if the same
+    regridding has been set up before, or worked out and written there if
+    not. Those of linear and nearest are quicker to work out than to read.
+    """
+
+    scheme = _regrid_scheme(cube, target_cube, method, extrap, mdtol)
+    filename = None
+    if cache_dir is not None and method in ["areaweighted", "conservative"]:
+        filename = os.path.join(
+            cache_dir,
+            "regrid_{}.npz".format(
+                _regrid_key(cube, target_cube, method, extrap, mdtol)
+            ),
+        )
+
+    if filename is not None and os.path.exists(filename):
+        with np.load(filename) as cached:
+            weights = scipy.sparse.csr_matrix(
+                (cached["data"], cached["indices"], cached["indptr"]),
+                shape=tuple(cached["shape"]),
+            )
+            outside = cached["outside"]
+    else:
+        # the weights are worked out on the part of the source grid under
+        # the target grid, then moved back onto the whole source grid
+        subset = _source_subset(cube, target_cube)
+        grid_cube = cube if subset is None else subset[0]
+        if method == "conservative":
+            weights, outside = _conservative_weights(grid_cube, target_cube)
+        else:
+            weights, outside = _regrid_weights(grid_cube, target_cube, scheme, method)
+        if subset is not None:
+            grid_cube, yindex, xindex = subset
+            xcoord, ycoord = _grid_coords(cube)
+            nx = len(xcoord.points)
+            weights = weights.tocoo()
+            cols = yindex[weights.col // len(xindex)] * nx
+            cols += xindex[weights.col % len(xindex)]
+            weights = scipy.sparse.csr_matrix(
+                (weights.data, (weights.row, cols)),
+                shape=(weights.shape[0], len(ycoord.points) * nx),
+            )
+
+        if filename is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            # write to a temporary file first, so other runs never
+            # read a half written cache file
+            handle, tmpname = tempfile.mkstemp(dir=cache_dir, suffix=".npz")
+            with os.fdopen(handle, "wb") as tmpfile:
+                np.savez(
+                    tmpfile,
+                    data=weights.data,
+                    indices=weights.indices,
+                    indptr=weights.indptr,
+                    shape=weights.shape,
+                    outside=outside,
+                )
+            os.replace(tmpname, filename)
+
+    return SparseRegridder(
+        cube, target_cube, weights, outside, method, extrap=extrap, mdtol=mdtol
+    )
+
+
+RegridCacheInfo = collections.namedtuple(
+    "RegridCacheInfo", ["hits", "misses", "maxsize", "currsize"]
+)
+
+
+class _RegridderCache(object):
+    """
+    A least recently used cache of regridders, keyed by the fingerprints
+    of the two grids and the regridding options, see _regrid_key. These
+    are SparseRegridders, or a KDTreeRegridder for kdtree, whose grids
+    are identified by the positions of their points. The size is read
+    from conf.REGRID_CACHE_SIZE each time a regridder is added, so it can
+    be changed at any time.
+    """
+
+    def __init__(self):
+        self._regridders = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, cube, target_cube, method, extrap, mdtol):
+        """Returns the regridder, setting it up if it isn't cached."""
+
+        if method == "kdtree":
+            key = (_kdtree_fingerprint(cube), _kdtree_fingerprint(target_cube))
+            key = hashlib.sha1(repr(key + (method, extrap)).encode()).hexdigest()
+            return self._lookup(
+                key, lambda: KDTreeRegridder(cube, target_cube, extrap=extrap)
+            )
+
+        # guess any missing bounds before the grids are fingerprinted, or a
+        # cube without them would miss the cache on every call
+        _regrid_scheme(cube, target_cube, method, extrap, mdtol)
+        return self._lookup(
+            _regrid_key(cube, target_cube, method, extrap, mdtol),
+            lambda: _sparse_regridder(cube, target_cube, method, extrap, mdtol),
+        )
+
+    def _lookup(self, key, make):
+        """Returns the item for key, calling make to make it if it isn't cached."""
+
+        with self._lock:
+            if key in self._regridders:
+                self.hits += 1
+                self._regridders.move_to_end(key)
+                return self._regridders[key]
+            self.misses += 1
+
+        regridder = make()
+        with self._lock:
+            self._regridders[key] = regridder
+            while len(self._regridders) > max(conf.REGRID_CACHE_SIZE, 0):
+                self._regridders.popitem(last=False)
+
+        return regridder
+
+    def info(self):
+        """Returns the hits, misses, maximum size and size of the cache."""
+
+        with self._lock:
+            return RegridCacheInfo(
+                self.hits, self.misses, conf.REGRID_CACHE_SIZE, len(self._regridders)
+            )
+
+    def clear(self):
+        """Empties the cache and resets the hit and miss counts."""
+
+        with self._lock:
+            self._regridders.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+_REGRIDDER_CACHE = _RegridderCache()
+
+
+def regrid_cache_info():
+    """
+    Returns the statistics of the cache of regridders used by
+    regrid_to_target, in the style of functools.lru_cache.
+
+    Returns
+    -------
+    info: named tuple of hits, the number of calls that reused a cached
+          regridder, misses, the number that had to set one up, maxsize,
+          the most regridders kept (conf.REGRID_CACHE_SIZE), and currsize,
+          the number kept now.
+
+    Notes
+    -----
+    An example:
+
+    >>> regrid_cache_clear()
+    >>> print(regrid_cache_info())
+    RegridCacheInfo(hits=0, misses=0, maxsize=8, currsize=0)
+    """
+
+    return _REGRIDDER_CACHE.info()
+
+
+def regrid_cache_clear():
+    """
+    Empties the cache of regridders used by regrid_to_target, and
+    resets its hit and miss counts.
+    """
+
+    _REGRIDDER_CACHE.clear()
+
+
+def _horizontal_lonlat(cube):
+    """
+    Returns the longitudes and latitudes, in degrees, of the points of the
+    horizontal grid of a cube, and the dimensions of the cube they span,
+    in increasing order. The grid can be curvilinear, with latitude and
+    longitude aux coords, e.g. from preparation.add_aux_unrotated_coords,
+    or rectilinear on any coordinate system.
+
+    Returns
+    -------
+    lons, lats: arrays of the shape of the grid
+    dims: tuple of the dimensions of the cube spanned by the grid
+    """
+
+    lon_coords, lat_coords = cube.coords("longitude"), cube.coords("latitude")
+    if lon_coords and lat_coords:
+        lon_coord, lat_coord = lon_coords[0], lat_coords[0]
+        dims = cube.coord_dims(lat_coord)
+        if dims and cube.coord_dims(lon_coord) == dims:
+            order = np.argsort(dims)
+            lons = lon_coord.units.convert(lon_coord.points, "degrees")
+            lats = lat_coord.units.convert(lat_coord.points, "degrees")
+            return lons.transpose(order), lats.transpose(order), tuple(sorted(dims))
+
+    xcoord, ycoord = _grid_coords(cube)
+    dims = (cube.coord_dims(ycoord)[0], cube.coord_dims(xcoord)[0])
+    points = []
+    for coord in [xcoord, ycoord]:
+        if coord.units.is_convertible("degrees"):
+            points.append(coord.units.convert(coord.points, "degrees"))
+        else:
+            points.append(coord.points)
+    xs, ys = np.meshgrid(*points)
+
+    cs = xcoord.coord_system
+    if cs is not None and not isinstance(cs, iris.coord_systems.GeogCS):
+        crs = cs.as_cartopy_crs()
+        lonlat = ccrs.Geodetic(globe=crs.globe).transform_points(crs, xs, ys)
+        xs, ys = lonlat[..., 0], lonlat[..., 1]
+    if dims[0] > dims[1]:
+        xs, ys = xs.T, ys.T
+
+    return xs, ys, tuple(sorted(dims))
+
+
+def _cartesian(lons, lats):
+    """
+    Returns the positions on the unit sphere of points with longitudes
+    and latitudes in degrees, as an array of shape (points, 3).
+    """
+
+    lons, lats = np.radians(np.ravel(lons)), np.radians(np.ravel(lats))
+
+    return np.stack(
+        [np.cos(lats) * np.cos(lons), np.cos(lats) * np.sin(lons), np.sin(lats)],
+        axis=-1,
+    )
+
+
+class _KDTreeCache(_RegridderCache):
+    """
+    A least recently used cache of KD-trees of the points of source grids,
+    with the distance between neighbouring points, keyed by a hash of the
+    points. It holds up to conf.REGRID_CACHE_SIZE trees.
+    """
+
+    def get(self, points, shape):
+        """Returns the tree and spacing of points, on a grid of shape shape."""
+
+        key = hashlib.sha1(np.ascontiguousarray(points).tobytes()).hexdigest()
+
+        def make():
+            tree = scipy.spatial.cKDTree(points)
+            if len(shape) == 2 and min(shape) > 1:
+                # the largest distance between neighbours along the grid
+                grid = points.reshape(shape + (3,))
+                spacing = max(
+                    np.max(np.linalg.norm(np.diff(grid, axis=axis), axis=-1))
+                    for axis in [0, 1]
+                )
+            elif len(points) > 1:
+                spacing = np.max(tree.query(points, k=2)[0][:, 1])
+            else:
+                spacing = np.inf
+            return tree, spacing
+
+        return self._lookup(key, make)
+
+
+_KDTREE_CACHE = _KDTreeCache()
+
+
+def _kdtree_fingerprint(cube):
+    """
+    Returns the dimensions of the horizontal grid of cube and a hash of the
+    positions of its points, which identify the grid for KDTreeRegridder.
+    """
+
+    lons, lats, dims = _horizontal_lonlat(cube)
+
+    return dims, hashlib.sha1(_cartesian(lons, lats).tobytes()).hexdigest()
+
+
+def _kdtree_source(cube):
+    """
+    Returns the source grid of cube as used by KDTreeRegridder: the
+    dimensions and shape of the grid, a hash of its points, and the
+    KD-tree of the points with the spacing between them.
+    """
+
+    lons, lats, dims = _horizontal_lonlat(cube)
+    points = _cartesian(lons, lats)
+    fingerprint = hashlib.sha1(points.tobytes()).hexdigest()
+    tree, spacing = _KDTREE_CACHE.get(points, lons.shape)
+
+    return dims, lons.shape, fingerprint, tree, spacing
+
+
+class KDTreeRegridder(object):
+    """
+    Regrids cubes to the nearest neighbour, from any horizontal grid to any
+    other, including curvilinear grids with 2-D latitude and longitude aux
+    coords and rotated grids. The source points are put in a KD-tree, from
+    their positions on the sphere, and all the target points are looked up
+    in it at once, so the regridding is then a gather of the data of the
+    nearest source points, for all time steps and levels at once.
+
+    The trees are cached for each source grid, so regridders from the same
+    source grid onto different targets only build one.
+
+    args
+    ----
+    cube: cube on the source grid
+    target_cube: cube on the target grid
+    extrap: extrapolation mode for target points outside the source grid,
+            'mask', 'nan', 'nanmask', 'error' or 'extrapolate', which takes
+            the nearest point however far away it is.
+    max_distance: distance, in km, beyond which a target point is outside the
+                  source grid. Default is None, the largest distance between
+                  neighbouring points of the source grid.
+    source: the source grid from _kdtree_source, to share it between
+            regridders. Default is None, which works it out from cube.
+
+    Notes
+    -----
+    The grid of the regridded cube takes the place of the source grid after
+    the other dimensions, with the coordinates of target_cube on it, so a
+    cube of (time, y, x) stays (time, y, x) even if the target grid is
+    curvilinear.
+    """
+
+    def __init__(
+        self, cube, target_cube, extrap="mask", max_distance=None, source=None
+    ):
+        if extrap not in ["mask", "nan", "nanmask", "error", "extrapolate"]:
+            raise ValueError(
+                "extrap must be 'mask', 'nan', 'nanmask', 'error' or 'extrapolate'"
+            )
+
+        if source is None:
+            source = _kdtree_source(cube)
+        self.src_dims, self.src_shape, self.fingerprint, tree, spacing = source
+
+        t_lons, t_lats, t_dims = _horizontal_lonlat(target_cube)
+        self.shape = t_lons.shape
+        distance, self.index = tree.query(_cartesian(t_lons, t_lats))
+
+        # distance on the sphere as the length of the chord
+        if max_distance is not None:
+            radius = iris.fileformats.pp.EARTH_RADIUS / 1000.0
+            spacing = 2.0 * np.sin(min(max_distance / (2.0 * radius), np.pi / 2.0))
+        self.outside = distance > spacing
+        if extrap == "extrapolate":
+            self.outside[:] = False
+        if extrap == "error" and np.any(self.outside):
+            raise ValueError("Some target points are outside the source grid")
+        self.extrap = extrap
+
+        # coordinates on the target grid, with their dimensions among its own
+        self.target_coords = []
+        for coords, dim_coords in [
+            (target_cube.dim_coords, True),
+            (target_cube.aux_coords, False),
+        ]:
+            for coord in coords:
+                coord_dims = target_cube.coord_dims(coord)
+                if coord_dims and set(coord_dims) <= set(t_dims):
+                    grid_dims = tuple(t_dims.index(dim) for dim in coord_dims)
+                    self.target_coords.append((coord.copy(), grid_dims, dim_coords))
+
+    def _result_dtype(self, dtype):
+        """Returns the type of the regridded data for source data of type dtype."""
+
+        if np.issubdtype(dtype, np.floating) or self.extrap not in ["nan", "nanmask"]:
+            return dtype
+        if not np.any(self.outside):
+            return dtype
+        return np.dtype(np.float64)
+
+    def _gather(self, data):
+        """
+        Regrids a numpy or numpy masked array of shape (..., source points),
+        returning (..., target points).
+        """
+
+        values = data.take(self.index, axis=-1)
+        values = values.astype(self._result_dtype(data.dtype), copy=False)
+        if np.any(self.outside):
+            if self.extrap == "nan" or (
+                self.extrap == "nanmask" and not np.ma.isMaskedArray(data)
+            ):
+                values[..., self.outside] = np.nan
+            else:
+                values = np.ma.masked_array(values)
+                values[..., self.outside] = np.ma.masked
+
+        return values
+
+    def _regrid_data(self, data, dims):
+        """
+        Regrids a numpy or dask array whose source grid is on dims, putting
+        the target grid after the other dimensions.
+        """
+
+        data = np.moveaxis(data, dims, tuple(range(-len(dims), 0)))
+        lead = data.shape[: -len(dims)]
+        if isinstance(data, da.Array):
+            # every block needs the whole source grid
+            data = data.rechunk({dim: -1 for dim in range(len(lead), data.ndim)})
+            data = data.reshape(lead + (-1,))
+            dtype = self._result_dtype(data.dtype)
+            data = data.map_blocks(
+                self._gather,
+                chunks=data.chunks[:-1] + ((len(self.index),),),
+                dtype=dtype,
+                meta=np.ma.masked_array(np.empty((0,) * data.ndim, dtype=dtype)),
+            )
+        else:
+            data = self._gather(data.reshape(lead + (-1,)))
+
+        return data.reshape(lead + self.shape)
+
+    def __call__(self, cube):
+        """
+        Regrids cube, which must be on the source grid of the regridder.
+
+        args
+        ----
+        cube: cube to regrid
+
+        Returns
+        -------
+        cube_reg: cube on the target grid
+        """
+
+        if not isinstance(cube, iris.cube.Cube):
+            raise TypeError("Input is not a cube")
+
+        if _kdtree_fingerprint(cube) != (self.src_dims, self.fingerprint):
+            raise ValueError("The cube is not on the source grid of this regridder")
+
+        return self._regrid_cube(cube)
+
+    def _regrid_cube(self, cube):
+        """Regrids cube, already known to be on the source grid."""
+
+        dims = self.src_dims
+        result = iris.cube.Cube(self._regrid_data(cube.core_data(), dims))
+        result.metadata = cube.metadata
+
+        # the other dimensions come first, then the target grid
+        lead_dims = [dim for dim in range(cube.ndim) if dim not in dims]
+        new_dims = {dim: i for i, dim in enumerate(lead_dims)}
+        for coord, grid_dims, dim_coords in self.target_coords:
+            coord_dims = tuple(len(lead_dims) + dim for dim in grid_dims)
+            if dim_coords:
+                result.add_dim_coord(coord.copy(), coord_dims)
+            else:
+                result.add_aux_coord(coord.copy(), coord_dims)
+
+        # copy the coordinates that don't span the grid
+        coord_mapping = {}
+        for coords, add_coord in [
+            (cube.dim_coords, result.add_dim_coord),
+            (cube.aux_coords, result.add_aux_coord),
+        ]:
+            for coord in coords:
+                coord_dims = cube.coord_dims(coord)
+                if set(coord_dims) & set(dims):
+                    continue
+                if iris.util.guess_coord_axis(coord) in ["X", "Y"]:
+                    continue
+                new_coord = coord.copy()
+                add_coord(new_coord, tuple(new_dims[dim] for dim in coord_dims))
+                coord_mapping[id(coord)] = new_coord
+
+        # regrid the reference surfaces of derived coordinates
+        grid_dims = tuple(range(len(lead_dims), result.ndim))
+        for factory in cube.aux_factories:
+            for coord in factory.dependencies.values():
+                if coord is None or id(coord) in coord_mapping:
+                    continue
+                if cube.coord_dims(coord) != dims:
+                    break
+                points = self._gather(coord.points.reshape(-1)).reshape(self.shape)
+                new_coord = coord.copy(np.ma.filled(points, np.nan))
+                result.add_aux_coord(new_coord, grid_dims)
+                coord_mapping[id(coord)] = new_coord
+            else:
+                result.add_aux_factory(factory.updated(coord_mapping))
+
+        return result
+
+
+class MultiTargetRegridder(object):
+    """
+    Regrids cubes on one source grid onto each of several target grids,
+    e.g. a model run onto each of its verification grids. The source grid
+    is prepared once, when this is set up: its bounds guessed if needed,
+    its fingerprint taken, and for kdtree its points moved onto the sphere
+    and put in a KD-tree. The weights onto each target are only worked out
+    the first time that target is used, and then kept.
+
+    args
+    ----
+    cube: cube on the source grid
+    target_cubes: list of cubes on the target grids
+    method: method of regridding, options are 'linear', 'nearest',
+            'areaweighted', 'conservative' and 'kdtree'.
+    extrap: extraopolation mode, options are 'mask', 'nan', 'error' and 'nanmask'
+    mdtol: tolerated fraction of masked data in any given target grid-box,
+           only used if method='areaweighted' or 'conservative', between 0 and 1.
+    cache_dir: directory to keep the regridding weights in between runs,
+               used for methods 'areaweighted' and 'conservative' only,
+               default is None, which does not keep them.
+
+    Notes
+    -----
+    Calling it with a cube returns a CubeList of the cube on each target
+    grid, in the order of target_cubes. The cube is checked to be on the
+    source grid once, not once per target. regridder(i) returns the
+    regridder onto target_cubes[i] alone, a KDTreeRegridder for kdtree
+    and a SparseRegridder for the other methods.
+    """
+
+    def __init__(
+        self,
+        cube,
+        target_cubes,
+        method="linear",
+        extrap="mask",
+        mdtol=0.5,
+        cache_dir=None,
+    ):
+        if not isinstance(cube, iris.cube.Cube):
+            raise TypeError("Input is not a cube")
+
+        target_cubes = list(target_cubes)
+        if not target_cubes:
+            raise ValueError("target_cubes is empty")
+        for target_cube in target_cubes:
+            if not isinstance(target_cube, iris.cube.Cube):
+                raise TypeError("Target_cube is not of type cube")
+
+        # the source grid, prepared once for all the targets
+        if method == "kdtree":
+            if extrap not in ["mask", "nan", "nanmask", "error", "extrapolate"]:
+                raise ValueError(
+                    "extrap must be 'mask', 'nan', 'nanmask', 'error' or "
+                    "'extrapolate'"
+                )
+            self._source = _kdtree_source(cube)
+            self.fingerprint = self._source[2]
+        else:
+            # checks every target before any weights are worked out, and
+            # guesses the source bounds the first time they are needed
+            for target_cube in target_cubes:
+                _regrid_scheme(cube, target_cube, method, extrap, mdtol)
+            self._source = cube.copy(
+                data=da.zeros(cube.shape, chunks=cube.shape, dtype=np.int8)
+            )
+            self.fingerprint = _grid_fingerprint(cube)
+
+        self.target_cubes = target_cubes
+        self.method = method
+        self.extrap = extrap
+        self.mdtol = mdtol
+        self.cache_dir = cache_dir
+        self._regridders = [None] * len(target_cubes)
+
+    def __len__(self):
+        return len(self.target_cubes)
+
+    def regridder(self, index):
+        """Returns the regridder onto target_cubes[index], setting it up if new."""
+
+        if self._regridders[index] is None:
+            target_cube = self.target_cubes[index]
+            if self.method == "kdtree":
+                regridder = KDTreeRegridder(
+                    None, target_cube, extrap=self.extrap, source=self._source
+                )
+            else:
+                regridder = _sparse_regridder(
+                    self._source,
+                    target_cube,
+                    self.method,
+                    self.extrap,
+                    self.mdtol,
+                    cache_dir=self.cache_dir,
+                )
+            self._regridders[index] = regridder
+
+        return self._regridders[index]
+
+    def __call__(self, cube):
+        if not isinstance(cube, iris.cube.Cube):
+            raise TypeError("Input is not a cube")
+
+        if self.method == "kdtree":
+            on_grid = _kdtree_fingerprint(cube) == (self._source[0], self.fingerprint)
+        else:
+            # guesses the bounds, as on the source grid, for the area methods
+            _regrid_scheme(
+                cube, self.target_cubes[0], self.method, self.extrap, self.mdtol
+            )
+            on_grid = _grid_fingerprint(cube) == self.fingerprint
+        if not on_grid:
+            raise ValueError("The cube is not on the source grid of this regridder")
+
+        return iris.cube.CubeList(
+            self.regridder(i)._regrid_cube(cube) for i in range(len(self))
+        )
+
+
+def regrid_to_target(cube, target_cube, method="linear", extrap="mask", mdtol=0.5):
+    """
+    Takes in two cubes, and regrids one onto the grid
+    of the other. Optional arguments include the method
+    of regridding, default is linear. The method of
+    extrapolation (if it is required), the default is
+    to mask the data, even if the source data is not
+    a masked array. And, if the method is areaweighted,
+    choose a missing data tolerance, default is 0.5.
+    For full info, see
+    https://scitools.org.uk/iris/docs/latest/userguide/interpolation_and_regridding.html
+
+    args
+    ----
+    cube: cube you want to regrid
+    target_cube: cube on the target grid
+    method: method of regridding, options are 'linear', 'nearest', 'areaweighted',
+            'conservative' and 'kdtree'.
+    extrap: extraopolation mode, options are 'mask', 'nan', 'error' and 'nanmask'
+    mdtol: tolerated fraction of masked data in any given target grid-box, only used
+           if method='areaweighted' or 'conservative', between 0 and 1.
+
+    Returns
+    -------
+    cube_reg: input cube on the grid of target_cube
+
+    Notes
+    -----
+    areaweighted is VERY picky, it will not allow you to regrid using this method
+    if the two input cubes are not on the
+    same coordinate system, and both input grids must also contain monotonic,
+    bounded, 1D spatial coordinates.
+
+    conservative is area weighted too, but works between any two coordinate
+    systems, e.g. from a rotated pole RCM grid onto a regular lat-lon grid.
+    The overlaps of the source and target cells are worked out on the sphere
+    from their corners, see set_regridder.
+
+    The regridders set up here are kept in a least recently used cache, holding
+    up to conf.REGRID_CACHE_SIZE of them, keyed by fingerprints of the two
+    grids and the method, extrap and mdtol. So regridding many cubes on the
+    same grid onto the same target, e.g. in a loop over months, only works out
+    the weights once. See regrid_cache_info and regrid_cache_clear.
+
+    The weights are worked out on the part of the source grid under the
+    target grid, plus a couple of cells all round, so regridding a global
+    field onto a regional grid only does the work for the region. The part
+    is found with the target grid moved into the coordinate system of the
+    source, so it works for rotated grids and across the longitude seam.
+
+    kdtree is nearest neighbour regridding between any two grids, including
+    curvilinear grids with 2-D latitude and longitude coordinates, see
+    KDTreeRegridder. Target points further from the source grid than the
+    spacing of its points are outside it, and treated as set by extrap.
+
+    A cube with lazy data, e.g. straight from iris.load, is not read: the
+    regridded cube has lazy data too, regridded one chunk of time steps and
+    levels at a time when it is used. So a long run can be regridded and
+    written out with iris.save holding only a few chunks in memory at once.
+
+    An example:
+
+    >>> file1 = os.path.join(conf.DATA_DIR, 'gcm_monthly.pp')
+    >>> file2 = os.path.join(conf.DATA_DIR, 'rcm_monthly.pp')
+    >>> cube = iris.load_cube(file1, 'air_temperature')
+    >>> tgrid = iris.load_cube(file2, 'air_temperature')
+    >>> cube_reg = regrid_to_target(cube, tgrid)
+    regridding from GeogCS(6371229.0) to \
+RotatedGeogCS(39.25, 198.0, ellipsoid=GeogCS(6371229.0)) using method linear
+    >>> print(cube.shape, tgrid.shape)
+    (145, 192) (2, 433, 444)
+    >>> print(cube_reg.shape)
+    (433, 444)
+    """
+
+    if not isinstance(cube, iris.cube.Cube):
+        raise TypeError("Input is not a cube")
+
+    if not isinstance(target_cube, iris.cube.Cube):
+        raise TypeError("Input is not a cube")
+
+    if method == "kdtree":
+        print(
+            "regridding from {} to {} using method kdtree".format(
+                str(cube.coord_system()), str(target_cube.coord_system())
+            )
+        )
+        regridder = _REGRIDDER_CACHE.get(cube, target_cube, method, extrap, mdtol)
+        # the cache key has already checked the grid of cube
+        return regridder._regrid_cube(cube)
+
+    target_cs = target_cube.coord(axis="x").coord_system
+    orig_cs = cube.coord(axis="x").coord_system
+
+    # checks the method, and guesses any missing bounds for areaweighted
+    _regrid_scheme(cube, target_cube, method, extrap, mdtol)
+
+    print(
+        "regridding from {} to {} using method {}".format(
+            str(orig_cs), str(target_cs), method
         )
+    )
 
+    regridder = _REGRIDDER_CACHE.get(cube, target_cube, method, extrap, mdtol)
+    cube_reg = regridder(cube)
 
-def regrid_to_target(cube, target_cube, method="linear", extrap="mask", mdtol=0.5):
+    return cube_reg
+
+
+def regrid_cubelist(
+    cubelist,
+    target_cube,
+    method="linear",
+    extrap="mask",
+    mdtol=0.5,
+    workers=None,
+    pool="thread",
+):
     """
-    Takes in two cubes, and regrids one onto the grid
-    of the other. Optional arguments include the method
-    of regridding, default is linear. The method of
-    extrapolation (if it is required), the default is
-    to mask the data, even if the source data is not
-    a masked array. And, if the method is areaweighted,
-    choose a missing data tolerance, default is 0.5.
-    For full info, see
-    https://scitools.org.uk/iris/docs/latest/userguide/interpolation_and_regridding.html
+    Regrids every cube of a cubelist onto the grid of target_cube, as
+    regrid_to_target does, working out the weights once for all the
+    cubes on the same grid and sharing the regridding of the cubes
+    between a pool of workers.
 
     args
     ----
-    cube: cube you want to regrid
+    cubelist: cubelist, or list of cubes, you want to regrid
     target_cube: cube on the target grid
-    method: method of regridding, options are 'linear', 'nearest' and 'areaweighted'.
+    method: method of regridding, options are 'linear', 'nearest', 'areaweighted'
+            and 'conservative'.
     extrap: extraopolation mode, options are 'mask', 'nan', 'error' and 'nanmask'
     mdtol: tolerated fraction of masked data in any given target grid-box, only used
-           if method='areaweighted', between 0 and 1.
+           if method='areaweighted' or 'conservative', between 0 and 1.
+    workers: number of workers to regrid the cubes with, default is None, which
+             regrids them one at a time.
+    pool: kind of pool of workers, 'thread' or 'process', default is 'thread'.
 
     Returns
     -------
-    cube_reg: input cube on the grid of target_cube
+    cubelist_reg: cubelist of the regridded cubes, in the same order as cubelist
 
     Notes
     -----
-    areaweighted is VERY picky, it will not allow you to regrid using this method
-    if the two input cubes are not on the
-    same coordinate system, and both input grids must also contain monotonic,
-    bounded, 1D spatial coordinates.
+    Cubes are grouped by their grid, e.g. the winds of a PP file may be on a
+    staggered grid, and each group takes its regridder from the cache used
+    by regrid_to_target, so the weights are shared with it too.
+
+    Threads share the regridders and the data in memory, and do most of the
+    work in numpy and scipy outside the global interpreter lock, so they
+    suit most cases. Processes are sent a copy of the regridder and the cube,
+    so are only worth it for large cubes and many cores.
 
     An example:
 
     >>> file1 = os.path.join(conf.DATA_DIR, 'gcm_monthly.pp')
     >>> file2 = os.path.join(conf.DATA_DIR, 'rcm_monthly.pp')
-    >>> cube = iris.load_cube(file1, 'air_temperature')
+    >>> cubes = iris.load(file1, ['air_temperature', 'cloud_area_fraction'])
     >>> tgrid = iris.load_cube(file2, 'air_temperature')
-    >>> cube_reg = regrid_to_target(cube, tgrid)
-    regridding from GeogCS(6371229.0) to \
+    >>> cubes_reg = regrid_cubelist(cubes, tgrid, workers=2)
+    regridding 2 cubes from GeogCS(6371229.0) to \
 RotatedGeogCS(39.25, 198.0, ellipsoid=GeogCS(6371229.0)) using method linear
-    >>> print(cube.shape, tgrid.shape)
-    (145, 192) (2, 433, 444)
-    >>> print(cube_reg.shape)
+    >>> for cube_reg in cubes_reg:
+    ...     print(cube_reg.shape)
+    (433, 444)
     (433, 444)
     """
 
-    if not isinstance(cube, iris.cube.Cube):
-        raise TypeError("Input is not a cube")
+    if not isinstance(cubelist, (list, tuple)) or not all(
+        isinstance(cube, iris.cube.Cube) for cube in cubelist
+    ):
+        raise TypeError("Input is not a cubelist")
 
     if not isinstance(target_cube, iris.cube.Cube):
         raise TypeError("Input is not a cube")
 
+    if pool not in ["thread", "process"]:
+        raise ValueError("pool must be 'thread' or 'process'")
+
     target_cs = target_cube.coord(axis="x").coord_system
-    orig_cs = cube.coord(axis="x").coord_system
 
-    # get coord names for cube
-    # Longitude
-    xcoord = cube.coord(axis="X", dim_coords=True)
-    # Latitude
-    ycoord = cube.coord(axis="Y", dim_coords=True)
-    # get coord names for target_cube
-    # Longitude
-    t_xcoord = target_cube.coord(axis="X", dim_coords=True)
-    # Latitude
-    t_ycoord = target_cube.coord(axis="Y", dim_coords=True)
+    # checks the method, and guesses any missing bounds for areaweighted
+    for cube in cubelist:
+        _regrid_scheme(cube, target_cube, method, extrap, mdtol)
+
+    # one regridder for each source grid among the cubes
+    groups = collections.OrderedDict()
+    for cube in cubelist:
+        groups.setdefault(_grid_fingerprint(cube), []).append(cube)
+    regridders = {}
+    for fingerprint, cubes in groups.items():
+        print(
+            "regridding {} cubes from {} to {} using method {}".format(
+                len(cubes),
+                str(cubes[0].coord(axis="x").coord_system),
+                str(target_cs),
+                method,
+            )
+        )
+        regridders[fingerprint] = _REGRIDDER_CACHE.get(
+            cubes[0], target_cube, method, extrap, mdtol
+        )
 
-    if method == "linear":
-        scheme = iris.analysis.Linear(extrapolation_mode=extrap)
+    jobs = [(regridders[_grid_fingerprint(cube)], cube) for cube in cubelist]
+    if workers is None:
+        cubes_reg = [regridder(cube) for regridder, cube in jobs]
+    else:
+        if pool == "thread":
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        else:
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        with executor:
+            futures = [executor.submit(regridder, cube) for regridder, cube in jobs]
+            cubes_reg = [future.result() for future in futures]
 
-    if method == "nearest":
-        scheme = iris.analysis.Nearest(extrapolation_mode=extrap)
+    return iris.cube.CubeList(cubes_reg)
 
-    # areaweighted is VERY picky and often can't be used.
-    if method == "areaweighted":
-        if not cube.coord(xcoord).has_bounds():
-            print("Input cube to be regrided does not have lon bounds, guessing . . . ")
-            cube.coord(xcoord).guess_bounds()
-        if not cube.coord(ycoord).has_bounds():
-            print("Input cube to be regrided does not have lat bounds, guessing . . . ")
-            cube.coord(ycoord).guess_bounds()
 
-        if not target_cube.coord(t_xcoord).has_bounds():
-            print("Input target_cube does not have lon bounds, guessing . . . ")
-            target_cube.coord(t_xcoord).guess_bounds()
-        if not target_cube.coord(t_ycoord).has_bounds():
-            print("Input target_cube does not have lat bounds, guessing . . . ")
-            target_cube.coord(t_ycoord).guess_bounds()
+def _wind_rotation(cube, target_cs):
+    """
+    Returns the cosine and sine of the angle from the x direction of the
+    grid of cube to the x direction of target_cs, at every point of the
+    grid, as arrays of shape (y, x). They are worked out once, with
+    rotate_winds on a wind of one along x.
+    """
+
+    xcoord, ycoord = _grid_coords(cube)
+    grid_cube = iris.cube.Cube(
+        np.ones((len(ycoord.points), len(xcoord.points))),
+        standard_name="x_wind",
+        units="m s-1",
+        dim_coords_and_dims=[(ycoord.copy(), 0), (xcoord.copy(), 1)],
+    )
+    v_grid_cube = grid_cube.copy(np.zeros(grid_cube.shape))
+    v_grid_cube.standard_name = "y_wind"
+    u_rot, v_rot = iris.analysis.cartography.rotate_winds(
+        grid_cube, v_grid_cube, target_cs
+    )
 
-        if target_cs != orig_cs:
-            raise ValueError("The input cubes must have the same coordinate system")
-        scheme = iris.analysis.AreaWeighted(mdtol=mdtol)
+    # the angle is not defined at the poles, where the winds are left alone
+    cos = np.ma.filled(u_rot.data, 1.0)
+    sin = np.ma.filled(v_rot.data, 0.0)
+    norm = np.hypot(cos, sin)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cos = np.where(norm > 0.0, cos / norm, 1.0)
+        sin = np.where(norm > 0.0, sin / norm, 0.0)
 
+    return cos, sin
+
+
+def regrid_vector(
+    u_cube, v_cube, target_cube, method="linear", extrap="mask", mdtol=0.5
+):
+    """
+    Regrids the x and y components of a vector, e.g. the wind, onto the grid
+    of target_cube, turning them to be along the x and y directions of the
+    target grid. If the grids are on different coordinate systems, e.g. from
+    a rotated pole RCM grid to a regular lat-lon grid, the components are
+    turned first, on the source grid, then both are regridded together with
+    one set of weights.
+
+    args
+    ----
+    u_cube: cube of the x component, e.g. x_wind
+    v_cube: cube of the y component, e.g. y_wind, on the same grid as u_cube
+    target_cube: cube on the target grid
+    method: method of regridding, options are 'linear', 'nearest', 'areaweighted'
+            and 'conservative'.
+    extrap: extraopolation mode, options are 'mask', 'nan', 'error' and 'nanmask'
+    mdtol: tolerated fraction of masked data in any given target grid-box, only used
+           if method='areaweighted' or 'conservative', between 0 and 1.
+
+    Returns
+    -------
+    u_reg: cube of the x component on the grid of target_cube
+    v_reg: cube of the y component on the grid of target_cube
+
+    Notes
+    -----
+    Regridding the components and then using rotate_winds turns them with
+    the angles of the target grid, but the components are still relative to
+    the source grid, so the angles must be those of the source grid. Here
+    they are found once with rotate_winds on the source grid, and the
+    regridding uses the cache of regrid_to_target, so does the same work
+    as regridding a single cube. Cubes with lazy data stay lazy.
+
+    An example:
+
+    >>> file1 = os.path.join(conf.DATA_DIR, 'rcm_monthly.pp')
+    >>> file2 = os.path.join(conf.DATA_DIR, 'gcm_monthly.pp')
+    >>> u_cube = iris.load_cube(file1, 'x_wind')
+    >>> v_cube = iris.load_cube(file1, 'y_wind')
+    >>> tgrid = iris.load_cube(file2, 'air_temperature')
+    >>> u_reg, v_reg = regrid_vector(u_cube, v_cube, tgrid)
+    regridding vector from RotatedGeogCS(39.25, 198.0, \
+ellipsoid=GeogCS(6371229.0)) to GeogCS(6371229.0) using method linear
+    >>> print(u_reg.shape, v_reg.shape)
+    (2, 145, 192) (2, 145, 192)
+    """
+
+    for cube in [u_cube, v_cube, target_cube]:
+        if not isinstance(cube, iris.cube.Cube):
+            raise TypeError("Input is not a cube")
+
+    if u_cube.units != v_cube.units:
+        raise ValueError(
+            "units do not match, {} and {}".format(u_cube.units, v_cube.units)
+        )
+
+    # checks the method, and guesses any missing bounds for areaweighted
+    _regrid_scheme(u_cube, target_cube, method, extrap, mdtol)
+    _regrid_scheme(v_cube, target_cube, method, extrap, mdtol)
+
+    if _grid_fingerprint(u_cube) != _grid_fingerprint(v_cube):
+        raise ValueError("u_cube and v_cube must be on the same grid")
+
+    xcoord, ycoord = _grid_coords(u_cube)
+    dims = (u_cube.coord_dims(ycoord)[0], u_cube.coord_dims(xcoord)[0])
+    if u_cube.shape != v_cube.shape or dims != (
+        v_cube.coord_dims(ycoord)[0],
+        v_cube.coord_dims(xcoord)[0],
+    ):
+        raise ValueError("u_cube and v_cube must have the same shape")
+
+    orig_cs = xcoord.coord_system
+    target_cs = _grid_coords(target_cube)[0].coord_system
     print(
-        "regridding from {} to {} using method {}".format(
+        "regridding vector from {} to {} using method {}".format(
             str(orig_cs), str(target_cs), method
         )
     )
 
-    cube_reg = cube.regrid(target_cube, scheme)
+    u_data, v_data = u_cube.core_data(), v_cube.core_data()
+    if orig_cs != target_cs:
+        if orig_cs is None or target_cs is None:
+            raise ValueError("Both cubes need a coordinate system to turn the vector")
+        cos, sin = _wind_rotation(u_cube, target_cs)
+        # line the angles up with the y and x dimensions of the data
+        shape = [1] * u_cube.ndim
+        shape[dims[0]], shape[dims[1]] = cos.shape
+        if dims[0] > dims[1]:
+            cos, sin = cos.T, sin.T
+        cos, sin = cos.reshape(shape), sin.reshape(shape)
+        u_data, v_data = u_data * cos - v_data * sin, u_data * sin + v_data * cos
+
+    # both components are regridded by one sparse matrix multiplication
+    regridder = _REGRIDDER_CACHE.get(u_cube, target_cube, method, extrap, mdtol)
+    stack_dims = (dims[0] + 1, dims[1] + 1)
+    if u_cube.has_lazy_data() or v_cube.has_lazy_data():
+        data = regridder._regrid_lazy(da.stack([u_data, v_data]), stack_dims)
+    elif np.ma.isMaskedArray(u_data) or np.ma.isMaskedArray(v_data):
+        data = regridder._regrid_data(np.ma.stack([u_data, v_data]), stack_dims)
+    else:
+        data = regridder._regrid_data(np.stack([u_data, v_data]), stack_dims)
+
+    u_reg = regridder._result_cube(u_cube, data[0], dims)
+    v_reg = regridder._result_cube(v_cube, data[1], dims)
 
-    return cube_reg
+    return u_reg, v_reg
 
 
-def set_regridder(cube, target_cube, method="linear", extrap="mask", mdtol=0.5):
+def set_regridder(
+    cube, target_cube, method="linear", extrap="mask", mdtol=0.5, cache_dir=None
+):
     """
     Takes in two cubes, and sets up a regridder, mapping
     one cube to another. The most computationally expensive
@@ -353,15 +3839,21 @@ def set_regridder(cube, target_cube, method="linear", extrap="mask", mdtol=0.5):
     Note: areaweighted is VERY picky, it will not allow you to regrid using
     this method if the two input cubes are not on the same coordinate system,
     and both input grids must also contain monotonic, bounded, 1D spatial coordinates.
+    Use conservative to regrid area weighted means between coordinate systems.
 
     args
     ----
     cube: cube you want to regrid
-    target_cube: cube on the target grid
-    method: method of regridding, options are 'linear', 'nearest' and 'areaweighted'.
+    target_cube: cube on the target grid, or a list of cubes on several
+                 target grids
+    method: method of regridding, options are 'linear', 'nearest', 'areaweighted',
+            'conservative' and 'kdtree'.
     extrap: extraopolation mode, options are 'mask', 'nan', 'error' and 'nanmask'
     mdtol: tolerated fraction of masked data in any given target grid-box,
-           only used if method='areaweighted', between 0 and 1.
+           only used if method='areaweighted' or 'conservative', between 0 and 1.
+    cache_dir: directory to keep the regridding weights in between runs,
+               used for methods 'areaweighted' and 'conservative' only,
+               default is None, which does not keep them.
 
     Returns
     -------
@@ -375,6 +3867,36 @@ def set_regridder(cube, target_cube, method="linear", extrap="mask", mdtol=0.5):
     https://scitools.org.uk/iris/docs/latest/userguide/interpolation_and_regridding.html
     for more information
 
+    If cache_dir is given with method areaweighted or conservative, the
+    weights of the regridding are written to a file in cache_dir, named by a
+    fingerprint of the coordinates, bounds and coordinate systems of the two
+    grids and of method, extrap and mdtol. Later calls with the same grids
+    and options, including from other scripts, read the weights back instead
+    of working them out again, and a SparseRegridder is returned. Data
+    regridded with it is the same as using iris directly. The files can be
+    deleted at any time, they are remade when next needed. As in
+    regrid_to_target, the weights of a SparseRegridder are worked out on the
+    part of the source grid under the target grid only. The iris regridders
+    for linear and nearest take less time to set up than reading a file, so
+    cache_dir is not used for them.
+
+    With method kdtree, a KDTreeRegridder is returned, which works with
+    curvilinear grids too.
+
+    With a list of target cubes, a MultiTargetRegridder is returned, which
+    prepares the source grid once and regrids onto every target, returning
+    a CubeList. The weights onto each target are worked out when first used.
+
+    With method conservative, a SparseRegridder is always returned. The corners
+    of each target cell, with points added along the edges, are moved into the
+    coordinate system of the source, as preparation.add_aux_unrotated_coords
+    does for cell centres, and mapped onto an equal area projection. The area
+    of every overlap of a target cell with a source cell is then its weight,
+    so all time steps are regridded by one sparse matrix multiplication.
+    Target cells partly outside the source grid are averaged over the part
+    inside it, and mdtol sets the fraction of masked data allowed, as for
+    areaweighted.
+
     An example:
 
     >>> file1 = os.path.join(conf.DATA_DIR, 'gcm_monthly.pp')
@@ -387,59 +3909,779 @@ def set_regridder(cube, target_cube, method="linear", extrap="mask", mdtol=0.5):
     (145, 192)
     >>> regridder(cube2)
     <iris 'Cube' of cloud_area_fraction / (1) (grid_latitude: 433; grid_longitude: 444)>
+    >>> coarse = cube[::2, ::2]
+    >>> for coord in coarse.coords(dim_coords=True):
+    ...     coord.bounds = None
+    ...     coord.guess_bounds()
+    >>> with tempfile.TemporaryDirectory() as cache_dir:
+    ...     regridder = set_regridder(cube, coarse, 'areaweighted', cache_dir=cache_dir)
+    ...     print(len(os.listdir(cache_dir)))
+    1
+    >>> regridder(cube2)
+    <iris 'Cube' of cloud_area_fraction / (1) (latitude: 73; longitude: 96)>
     """
 
     if not isinstance(cube, iris.cube.Cube):
         raise TypeError("Input is not a cube")
 
+    if isinstance(target_cube, (list, tuple)):
+        return MultiTargetRegridder(
+            cube, target_cube, method, extrap, mdtol, cache_dir=cache_dir
+        )
+
     if not isinstance(target_cube, iris.cube.Cube):
         raise TypeError("Target_cube is not of type cube")
 
-    target_cs = target_cube.coord(axis="x").coord_system
-    orig_cs = cube.coord(axis="x").coord_system
+    if method == "kdtree":
+        return KDTreeRegridder(cube, target_cube, extrap=extrap)
 
-    # get coord names for cube
-    # Longitude
-    xcoord = cube.coord(axis="X", dim_coords=True)
-    # Latitude
-    ycoord = cube.coord(axis="Y", dim_coords=True)
-    # get coord names for target_cube
-    # Longitude
-    t_xcoord = target_cube.coord(axis="X", dim_coords=True)
-    # Latitude
-    t_ycoord = target_cube.coord(axis="Y", dim_coords=True)
+    if method == "conservative" or (
+        cache_dir is not None and method == "areaweighted"
+    ):
+        return _sparse_regridder(
+            cube, target_cube, method, extrap, mdtol, cache_dir=cache_dir
+        )
 
-    if method == "linear":
-        regridder = iris.analysis.Linear(extrapolation_mode=extrap).regridder(
-            cube, target_cube
+    scheme = _regrid_scheme(cube, target_cube, method, extrap, mdtol)
+    regridder = scheme.regridder(cube, target_cube)
+
+    return regridder
+
+
+class PercentileSketch(object):
+    """
+    Approximate percentiles of many series at once, e.g. of every grid point
+    of a cube, from a histogram of the values of each series, built up one
+    chunk of the series at a time. So percentiles of hourly data can be
+    found without ever holding all of it, and sketches of different chunks,
+    e.g. worked out in parallel, can be merged.
+
+    The bins of each histogram have a width of a power of two, wide enough
+    for all the values of the series so far: when new values fall outside,
+    the bins are merged in pairs, and recentred, until they fit. As all the
+    bins are on the same lattice, merging sketches only needs the finer of
+    them to be coarsened. The exact minimum and maximum of each series are
+    kept too.
+
+    args
+    ----
+    nbins: number of bins in the histogram of each series, default 256.
+           Percentiles are accurate to about 4 / nbins of the range of the
+           series, at worst, and the histograms take 4 * nbins bytes per
+           series.
+
+    A simple example:
+
+    >>> values = np.arange(1000.0).reshape(100, 10)
+    >>> sketch = PercentileSketch()
+    >>> sketch.update(values[:50])
+    >>> sketch.update(values[50:])
+    >>> print(sketch.n)
+    [100 100 100 100 100 100 100 100 100 100]
+    >>> print(np.percentile(values, 50, axis=0)[:3])
+    [495. 496. 497.]
+    >>> print(sketch.percentile(50)[:3], sketch.percentile_error(50)[:3])
+    [496.0 496.0 498.0] [2.0 2.0 2.0]
+    """
+
+    def __init__(self, nbins=256):
+        if nbins < 8 or nbins % 2 != 0:
+            raise ValueError("nbins must be an even number of at least 8")
+        self.nbins = nbins
+        self.shape = None
+        self.counts = None
+
+    @property
+    def n(self):
+        """Number of values in each series so far."""
+        if self.counts is None:
+            return 0
+        return self.counts.sum(axis=-1).reshape(self.shape)
+
+    def update(self, values):
+        """
+        Adds a chunk of new values to the sketch.
+
+        args
+        ----
+        values: numpy array, masked or not, with the values of each series
+                along the first dimension. The other dimensions must match
+                previous updates.
+        """
+
+        values = np.ma.asanyarray(values)
+        shape = values.shape[1:]
+        self._check_shape(shape)
+        valid = ~np.ma.getmaskarray(values).reshape(len(values), -1)
+        values = np.ma.getdata(values).reshape(len(values), -1)
+        values = np.where(valid, values, 0.0).astype(np.float64)
+
+        vmin = np.where(valid, values, np.inf).min(axis=0, initial=np.inf)
+        vmax = np.where(valid, values, -np.inf).max(axis=0, initial=-np.inf)
+        self._fit(vmin, vmax)
+
+        # the bin of every value, counted for each series
+        index = np.floor(np.ldexp(values, -self.exponent)).astype(np.int64)
+        index += np.arange(values.shape[1]) * self.nbins - self.start
+        self.counts += np.bincount(
+            index[valid], minlength=self.counts.size
+        ).reshape(self.counts.shape)
+
+    def update_cube(self, cube, coord="time"):
+        """
+        Adds every point of a cube to the sketch, one chunk of coord at a
+        time, so lazy data is read a chunk at a time.
+
+        args
+        ----
+        cube: iris cube, with the series along coord
+        coord: name of the coordinate along the series, defaults to 'time'.
+        """
+
+        if not isinstance(cube, iris.cube.Cube):
+            raise TypeError("Input is not a cube")
+
+        dim = cube.coord_dims(coord)[0]
+        data = np.moveaxis(cube.core_data(), dim, 0)
+        if cube.has_lazy_data():
+            for block in data.blocks:
+                self.update(block.compute())
+        else:
+            self.update(data)
+
+    def merge(self, other):
+        """
+        Adds the values of another PercentileSketch, e.g. one which has
+        processed a different chunk of the series.
+
+        args
+        ----
+        other: PercentileSketch
+        """
+
+        if not isinstance(other, PercentileSketch):
+            raise TypeError("Can only merge with a PercentileSketch")
+        if other.nbins != self.nbins:
+            raise ValueError("Can only merge sketches with the same nbins")
+        if other.counts is None:
+            return
+        self._check_shape(other.shape)
+
+        # bring the two onto the same bins, then add them up
+        self._fit(other.vmin, other.vmax, exponent=other.exponent)
+        other = other._copy()
+        other._fit(self.vmin, self.vmax, exponent=self.exponent)
+        other._rebin(self.exponent, self.start)
+        self.counts += other.counts
+
+    def _copy(self):
+        sketch = PercentileSketch(self.nbins)
+        sketch.shape = self.shape
+        for name in ["counts", "exponent", "start", "vmin", "vmax"]:
+            setattr(sketch, name, getattr(self, name).copy())
+        return sketch
+
+    def _check_shape(self, shape):
+        if self.counts is None:
+            size = int(np.prod(shape))
+            self.shape = tuple(shape)
+            self.counts = np.zeros((size, self.nbins), dtype=np.int32)
+            self.exponent = np.zeros(size, dtype=np.int64)
+            self.start = np.zeros(size, dtype=np.int64)
+            self.vmin = np.full(size, np.inf)
+            self.vmax = np.full(size, -np.inf)
+        elif tuple(shape) != self.shape:
+            raise ValueError(
+                "Shape {} does not match the sketched shape {}".format(
+                    str(tuple(shape)), str(self.shape)
+                )
+            )
+
+    def _fit(self, vmin, vmax, exponent=None):
+        """
+        Widens the bins of each series, if needed, to hold values from vmin
+        to vmax and to be at least 2**exponent wide.
+        """
+
+        empty = self.counts.sum(axis=-1) == 0
+        self.vmin = np.minimum(self.vmin, vmin)
+        self.vmax = np.maximum(self.vmax, vmax)
+        todo = np.isfinite(self.vmin)
+        lower, upper = self.vmin[todo], self.vmax[todo]
+
+        # new series start with the data over half the bins, leaving room
+        new_exponent = self.exponent[todo]
+        first = empty[todo]
+        spread = np.maximum(upper - lower, np.abs(lower) * 2.0**-40)
+        spread = np.maximum(spread[first], np.finfo(float).tiny)
+        new_exponent[first] = np.ceil(np.log2(spread / (self.nbins // 2 - 2)))
+        if exponent is not None:
+            new_exponent = np.maximum(new_exponent, exponent[todo])
+
+        # then double the width of the bins until the values fit
+        while True:
+            low = np.floor(np.ldexp(lower, -new_exponent)).astype(np.int64)
+            high = np.floor(np.ldexp(upper, -new_exponent)).astype(np.int64)
+            wide = high - low + 1 > self.nbins
+            if not np.any(wide):
+                break
+            new_exponent[wide] += 1
+
+        # keep the bins where they are if they fit, otherwise centre them
+        start = self.start[todo]
+        moved = (new_exponent != self.exponent[todo]) | first
+        moved |= (low < start) | (high >= start + self.nbins)
+        start = np.where(moved, low - (self.nbins - (high - low + 1)) // 2, start)
+        exponents = self.exponent.copy()
+        exponents[todo] = new_exponent
+        starts = self.start.copy()
+        starts[todo] = start
+        self._rebin(exponents, starts)
+
+    def _rebin(self, exponent, start):
+        """
+        Moves the counts onto bins 2**exponent wide, which must be at least
+        as wide as the current bins, starting at bin number start.
+        """
+
+        moved = (exponent != self.exponent) | (start != self.start)
+        if np.any(moved):
+            shift = np.maximum(exponent - self.exponent, 0)[moved, np.newaxis]
+            bins = (self.start[moved, np.newaxis] + np.arange(self.nbins)) >> shift
+            bins -= start[moved, np.newaxis]
+            bins += np.arange(np.count_nonzero(moved))[:, np.newaxis] * self.nbins
+            counts = self.counts[moved]
+            self.counts[moved] = np.bincount(
+                bins[counts > 0], weights=counts[counts > 0], minlength=counts.size
+            ).reshape(counts.shape)
+        self.exponent = exponent
+        self.start = start
+
+    def _ranks(self, pc):
+        """
+        Returns the bounds of the bins holding the two values either side of
+        the pc percentile of each series, and its position between them.
+        """
+
+        n = self.counts.sum(axis=-1)
+        rank = pc / 100.0 * np.maximum(n - 1, 0)
+        cumulative = np.cumsum(self.counts, axis=-1)
+        width = np.ldexp(1.0, self.exponent)
+        vmin = np.where(n > 0, self.vmin, 0.0)
+        vmax = np.where(n > 0, self.vmax, 0.0)
+        bounds = []
+        for order in [np.floor(rank), np.minimum(np.floor(rank) + 1, n - 1)]:
+            # the bin of the value of this order, and where it is in the bin
+            bins = (cumulative <= order[:, np.newaxis]).sum(axis=-1)
+            bins = np.minimum(bins, self.nbins - 1)[:, np.newaxis]
+            count = np.take_along_axis(self.counts, bins, axis=-1)[:, 0]
+            before = np.take_along_axis(cumulative, bins, axis=-1)[:, 0] - count
+            lower = (self.start + bins[:, 0]) * width
+            within = (order - before + 0.5) / np.maximum(count, 1)
+            value = np.clip(lower + within * width, vmin, vmax)
+            low = np.maximum(lower, vmin)
+            high = np.minimum(lower + width, vmax)
+            # the smallest and largest values are known exactly
+            for exact, known in [(order <= 0, vmin), (order >= n - 1, vmax)]:
+                value, low, high = [
+                    np.where(exact, known, x) for x in (value, low, high)
+                ]
+            bounds.append((value, low, high))
+        return bounds, rank - np.floor(rank), n == 0
+
+    def percentile(self, pc):
+        """
+        Returns the approximate pc percentile of each series, interpolated
+        between values as numpy.percentile does, masked where a series has
+        no values.
+
+        args
+        ----
+        pc: percentile, between 0 and 100
+        """
+
+        if self.counts is None:
+            raise ValueError("Nothing has been sketched yet")
+
+        bounds, fraction, empty = self._ranks(pc)
+        low, high = bounds[0][0], bounds[1][0]
+        result = low + fraction * (high - low)
+
+        return np.ma.masked_array(result, mask=empty).reshape(self.shape)
+
+    def percentile_error(self, pc):
+        """
+        Returns the largest possible difference between the approximate
+        pc percentile of each series and its exact value.
+
+        args
+        ----
+        pc: percentile, between 0 and 100
+        """
+
+        if self.counts is None:
+            raise ValueError("Nothing has been sketched yet")
+
+        bounds, fraction, empty = self._ranks(pc)
+        result = self.percentile(pc).reshape(-1)
+        error = np.maximum(
+            result - bounds[0][1] - fraction * (bounds[1][1] - bounds[0][1]),
+            bounds[0][2] + fraction * (bounds[1][2] - bounds[0][2]) - result,
         )
 
-    if method == "nearest":
-        regridder = iris.analysis.Nearest(extrapolation_mode=extrap).regridder(
-            cube, target_cube
+        return np.ma.masked_array(error, mask=empty).reshape(self.shape)
+
+
+def _month_year(time_coord):
+    """
+    Returns the month and year of every point of a time coordinate, as
+    integer arrays, decoding the points to dates once.
+    """
+
+    dates = time_coord.units.num2date(time_coord.points)
+    months = np.array([date.month for date in dates], dtype=int)
+    years = np.array([date.year for date in dates], dtype=int)
+
+    return months, years
+
+
+def _season_index(months, years, seas_mons, year_range, by_year=False):
+    """
+    Returns the time indices of every season of seas_mons within year_range,
+    one season after another in one array, the offsets in it at which each
+    group of times starts, the season of each group and the season year of
+    each time in the array. A time in more than one season is in each of
+    them.
+
+    Each season is one group, unless by_year, when each season of each year
+    is a group of its own. The year of a season that spans the new year,
+    e.g. djf, is the year it ends in, and year_range is of those years.
+    """
+
+    indices = []
+    index_years = []
+    group_season = []
+    offsets = []
+    start = 0
+    for i, season in enumerate(seas_mons):
+        # the position of each month in the season, and the months before
+        # it wraps round to January, which are in the next season year
+        position = np.full(13, -1)
+        position[season] = np.arange(len(season))
+        position = position[months]
+        wraps = np.flatnonzero(np.diff(season) < 0)
+        season_years = years.copy()
+        if len(wraps) > 0:
+            season_years += (position >= 0) & (position <= wraps[0])
+
+        group_years = season_years if by_year else years
+        in_years = (group_years >= year_range[0]) & (group_years <= year_range[1])
+        index = np.flatnonzero((position >= 0) & in_years)
+        if len(index) == 0:
+            raise Exception(
+                "Cube constriants of seas_mons and/or years do not match "
+                "data in the input cube"
+            )
+
+        # the times are in order, so each year of the season is a run of them
+        starts = [0]
+        if by_year:
+            starts += list(np.flatnonzero(np.diff(season_years[index]) != 0) + 1)
+        offsets += [start + offset for offset in starts]
+        group_season += [i] * len(starts)
+        indices.append(index)
+        index_years.append(season_years[index])
+        start += len(index)
+
+    return (
+        np.concatenate(indices),
+        np.array(offsets),
+        np.array(group_season),
+        np.concatenate(index_years),
+    )
+
+
+def _group_stats(data, index, offsets, metrics, pc=None):
+    """
+    Reduces data along its first axis, over each group of times in index,
+    starting at offsets, with each of metrics, from one gather of the data.
+    The metrics share their sums and sort: the mean and standard deviation
+    come from the same sums, and if a percentile is wanted the minimum and
+    maximum come from its sort too. Masked points are left out, and a cell
+    with no data in a group is masked. Returns a dictionary of metric to a
+    masked array with a first axis of groups.
+    """
+
+    for metric in metrics:
+        if metric not in ["mean", "std_dev", "min", "max", "percentile"]:
+            raise ValueError(
+                "metric must be 'mean', 'std_dev', 'min', 'max' or 'percentile', "
+                "not {}".format(metric)
+            )
+
+    gathered = data[index]
+    valid = ~np.ma.getmaskarray(gathered)
+    count = np.add.reduceat(valid, offsets, axis=0)
+    values = np.ma.getdata(gathered)
+    ends = np.append(offsets[1:], len(index))
+    stats = {}
+
+    if "mean" in metrics or "std_dev" in metrics:
+        # for the standard deviation, sums about the first value of each
+        # group, which keeps the rounding small
+        if "std_dev" in metrics:
+            shift = np.where(valid[offsets], values[offsets], 0).astype(np.float64)
+            dev = np.repeat(shift, ends - offsets, axis=0)
+            dev = np.where(valid, values - dev, 0.0)
+        else:
+            shift = 0.0
+            dev = np.where(valid, values, 0)
+        sum1 = np.add.reduceat(dev, offsets, axis=0, dtype=np.float64)
+        if "mean" in metrics:
+            stats["mean"] = shift + sum1 / np.maximum(count, 1)
+        if "std_dev" in metrics:
+            # with one degree of freedom, like iris.analysis.STD_DEV
+            sum2 = np.add.reduceat(dev * dev, offsets, axis=0)
+            var = (sum2 - sum1 * sum1 / np.maximum(count, 1)) / np.maximum(
+                count - 1, 1
+            )
+            stats["std_dev"] = np.ma.masked_array(
+                np.sqrt(np.maximum(var, 0.0)), mask=count < 2
+            )
+
+    if "percentile" in metrics:
+        # one sort of each group, with masked points sorted to the end, then
+        # the percentile is interpolated between the valid ones, as numpy does
+        shape = (len(offsets),) + values.shape[1:]
+        stats["percentile"] = np.empty(shape)
+        low_high = np.empty((2,) + shape, dtype=values.dtype)
+        for i, (start, end) in enumerate(zip(offsets, ends)):
+            ordered = np.ma.sort(gathered[start:end], axis=0, endwith=True)
+            ordered = np.ma.getdata(ordered)
+            last = np.maximum(count[i] - 1, 0)
+            rank = pc / 100.0 * last
+            lower = np.floor(rank).astype(int)
+            upper = np.minimum(lower + 1, last)
+            low = np.take_along_axis(ordered, lower[np.newaxis], axis=0)[0]
+            high = np.take_along_axis(ordered, upper[np.newaxis], axis=0)[0]
+            stats["percentile"][i] = low + (rank - lower) * (high - low)
+            low_high[0, i] = ordered[0]
+            low_high[1, i] = np.take_along_axis(ordered, last[np.newaxis], axis=0)[0]
+        if "min" in metrics:
+            stats["min"] = low_high[0]
+        if "max" in metrics:
+            stats["max"] = low_high[1]
+    else:
+        if "min" in metrics:
+            fill = np.ma.minimum_fill_value(values)
+            stats["min"] = np.minimum.reduceat(
+                np.where(valid, values, fill), offsets, axis=0
+            )
+        if "max" in metrics:
+            fill = np.ma.maximum_fill_value(values)
+            stats["max"] = np.maximum.reduceat(
+                np.where(valid, values, fill), offsets, axis=0
+            )
+
+    empty = count == 0
+    return {
+        metric: np.ma.masked_array(stat, mask=np.ma.getmaskarray(stat) | empty)
+        for metric, stat in stats.items()
+    }
+
+
+def _take(data, indices):
+    """
+    Returns the points of a dask array in indices, a dictionary of axis to
+    the indices along it, taking one slice for each run of consecutive
+    indices along every axis. So reading the result only reads those
+    points, rather than the whole of every chunk they are in, as taking
+    them with the indices themselves would.
+    """
+
+    slices = []
+    for axis in range(data.ndim):
+        if axis in indices:
+            index = np.asarray(indices[axis])
+            runs = np.split(index, np.flatnonzero(np.diff(index) != 1) + 1)
+            slices.append([slice(run[0], run[-1] + 1) for run in runs])
+        else:
+            slices.append([slice(None)])
+
+    def blocks(key):
+        if len(key) == data.ndim:
+            return data[tuple(key)]
+        return [blocks(key + [piece]) for piece in slices[len(key)]]
+
+    return da.block(blocks([]))
+
+
+def _intersection_index(cube, area):
+    """
+    Returns cube.intersection(**area) for a cube with lazy data, and the
+    indices in cube of the points of the intersection, as a dictionary of
+    dimension to indices. The intersection is of a copy of the cube without
+    its data, which is then taken with _take, so that it can be taken
+    again along with other indices, in one slice of the data for each run.
+    """
+
+    grid = cube.copy(data=da.zeros(cube.shape, dtype=cube.dtype, chunks=cube.shape))
+    for name in area:
+        dim = cube.coord_dims(name)[0]
+        aux_index = iris.coords.AuxCoord(
+            np.arange(cube.shape[dim]), long_name="index_" + name
         )
+        grid.add_aux_coord(aux_index, dim)
+    grid = grid.intersection(**area)
 
-    if method == "areaweighted":
-        if not cube.coord(xcoord).has_bounds():
-            print("Input cube to be regrided does not have lon bounds, guessing . . . ")
-            cube.coord(xcoord).guess_bounds()
-        if not cube.coord(ycoord).has_bounds():
-            print("Input cube to be regrided does not have lat bounds, guessing . . . ")
-            cube.coord(ycoord).guess_bounds()
+    indices = {}
+    for name in area:
+        aux_index = grid.coord("index_" + name)
+        indices[grid.coord_dims(aux_index)[0]] = aux_index.points
+        grid.remove_coord(aux_index)
 
-        if not target_cube.coord(t_xcoord).has_bounds():
-            print("Input target_cube does not have lon bounds, guessing . . . ")
-            target_cube.coord(t_xcoord).guess_bounds()
-        if not target_cube.coord(t_ycoord).has_bounds():
-            print("Input target_cube does not have lat bounds, guessing . . . ")
-            target_cube.coord(t_ycoord).guess_bounds()
+    return grid.copy(data=_take(cube.core_data(), indices)), indices
+
+
+def _lazy_group_stats(data, index, offsets, metrics, pc=None):
+    """
+    As _group_stats, for a dask array, keeping the statistics lazy. Only the
+    times in index are read, and each block of them, with all its times but
+    a part of the other dimensions, is reduced in turn.
+    """
 
-        if target_cs != orig_cs:
-            raise ValueError("The input cubes must have the same coordinate system")
+    # every block needs all the times of the groups
+    data = _take(data, {0: index})
+    data = data.rechunk({0: -1, **{dim: "auto" for dim in range(1, data.ndim)}})
 
-        regridder = iris.analysis.AreaWeighted(mdtol=mdtol).regridder(cube, target_cube)
+    def group_stats(block):
+        stats = _group_stats(block, np.arange(len(block)), offsets, metrics, pc=pc)
+        return np.ma.stack([stats[metric] for metric in metrics])
 
-    return regridder
+    stats = data.map_blocks(
+        group_stats,
+        new_axis=0,
+        chunks=((len(metrics),), (len(offsets),)) + data.chunks[1:],
+        dtype=np.float64,
+        meta=np.ma.masked_array(np.empty((0,) * (data.ndim + 1))),
+    )
+
+    return {metric: stats[i] for i, metric in enumerate(metrics)}
+
+
+def _sketch_chunk(block, axis, keepdims, nbins):
+    sketch = PercentileSketch(nbins)
+    sketch.update(block)
+    return sketch
+
+
+def _sketch_combine(sketches, axis, keepdims):
+    # dask passes the sketches of the chunks in nested lists
+    while isinstance(sketches[0], list):
+        sketches = [sketch for inner in sketches for sketch in inner]
+    merged = sketches[0]
+    for sketch in sketches[1:]:
+        merged.merge(sketch)
+    return merged
+
+
+def _sketch_aggregate(sketches, axis, keepdims, pc):
+    sketch = _sketch_combine(sketches, axis, keepdims)
+    return np.ma.stack([sketch.percentile(pc), sketch.percentile_error(pc)])
+
+
+def _sketch_group_stats(data, index, offsets, pc, nbins):
+    """
+    Returns the approximate pc percentile along the first axis of data, of
+    each group of times in index starting at offsets, and how far it may be
+    from the exact percentile, from a PercentileSketch of each group. Lazy
+    data is sketched one chunk of times at a time, and stays lazy.
+    """
+
+    ends = np.append(offsets[1:], len(index))
+    if isinstance(data, da.Array):
+        # the sketch of a block holds nbins counts for each of its points,
+        # so split the other dimensions to keep that within the chunk size
+        limit = dask.utils.parse_bytes(dask.config.get("array.chunk-size"))
+        points = max(1, limit // (nbins * np.dtype(np.int32).itemsize))
+        data = data.rechunk(
+            {dim: "auto" for dim in range(1, data.ndim)},
+            block_size_limit=min(
+                limit, max(data.chunks[0]) * data.dtype.itemsize * points
+            ),
+        )
+        stats = []
+        for start, end in zip(offsets, ends):
+            stats.append(
+                da.reduction(
+                    _take(data, {0: index[start:end]}),
+                    functools.partial(_sketch_chunk, nbins=nbins),
+                    functools.partial(_sketch_aggregate, pc=pc),
+                    axis=0,
+                    keepdims=True,
+                    combine=_sketch_combine,
+                    concatenate=False,
+                    output_size=2,
+                    dtype=np.float64,
+                    meta=np.ma.masked_array(np.empty((0,) * data.ndim)),
+                )
+            )
+        stats = da.stack(stats, axis=1)
+    else:
+        stats = []
+        for start, end in zip(offsets, ends):
+            sketch = PercentileSketch(nbins)
+            sketch.update(data[index[start:end]])
+            stats.append([sketch.percentile(pc), sketch.percentile_error(pc)])
+        stats = np.ma.stack([np.ma.stack(stat) for stat in zip(*stats)])
+
+    return stats[0], stats[1]
+
+
+def _aggregate_like(aggregator, dtype, masked, lazy, **kwargs):
+    """
+    Returns what the iris aggregator gives for a sample of two zeros of
+    type dtype, masked or lazy if the data is, to give the data type and
+    kind of array iris would give the statistic of the data.
+    """
+
+    sample = np.zeros((2, 1), dtype=dtype)
+    if masked:
+        sample = np.ma.masked_array(sample, mask=False)
+    if lazy:
+        sample = da.from_array(sample, chunks=sample.shape, asarray=False)
+        return aggregator.lazy_aggregate(sample, 0, **kwargs).compute()
+
+    return aggregator.aggregate(sample, 0, **kwargs)
+
+
+def _like_iris(stat, like, masked=True):
+    """
+    Returns stat, a numpy or dask masked array, with the data type of like,
+    and as a plain array if like is one and nothing in stat is masked. For
+    a dask array that isn't known until it is computed, so masked says
+    whether anything may be.
+    """
+
+    stat = stat.astype(like.dtype)
+    if np.ma.isMaskedArray(like):
+        return stat
+    if isinstance(stat, da.Array):
+        if masked:
+            return stat
+        return stat.map_blocks(
+            np.ma.getdata, meta=np.empty((0,) * stat.ndim, dtype=like.dtype)
+        )
+    if np.ma.is_masked(stat):
+        return stat
+
+    return np.ma.getdata(stat)
+
+
+def _season_stats(data, index, offsets, metrics, aggregators, kwargs, pc, pc_bins):
+    """
+    Returns a dictionary of each of metrics along the first axis of data, of
+    each group of times in index starting at offsets, with the types iris
+    would give them, and how far out an approximate percentile may be, or
+    None. Lazy data gives lazy statistics.
+    """
+
+    lazy = isinstance(data, da.Array)
+    exact = metrics
+    if pc_bins:
+        exact = [name for name in metrics if name != "percentile"]
+    stats = {}
+    if lazy:
+        if exact:
+            stats = _lazy_group_stats(data, index, offsets, exact, pc=pc)
+        masked = isinstance(da.utils.meta_from_array(data), np.ma.MaskedArray)
+    else:
+        if exact:
+            stats = _group_stats(data, index, offsets, exact, pc=pc)
+        masked = np.ma.isMaskedArray(data)
+    pc_error = None
+    if pc_bins and "percentile" in metrics:
+        stats["percentile"], pc_error = _sketch_group_stats(
+            data, index, offsets, pc, pc_bins
+        )
+
+    # the data types and kinds of array iris gives the statistics; for
+    # data without a mask only a standard deviation of one time is masked
+    one_time = np.any(np.diff(np.append(offsets, len(index))) < 2)
+    like = {
+        name: _aggregate_like(
+            aggregators[name], data.dtype, masked, lazy, **kwargs.get(name, {})
+        )
+        for name in metrics
+    }
+    stats = {
+        name: _like_iris(
+            stats[name], like[name], masked or (name == "std_dev" and one_time)
+        )
+        for name in metrics
+    }
+
+    return stats, pc_error
+
+
+def _season_cubes(
+    template,
+    season_stat,
+    stats,
+    aggregators,
+    kwargs,
+    by_year=False,
+    season=None,
+    pc_error=None,
+    metric_coord=False,
+):
+    """
+    Returns a list of a cube of each statistic in stats for one season,
+    collapsing template, a cube of the times of the season without data,
+    for the coords. season_stat picks the season out of a statistic, and
+    season is the short and full names of the season.
+    """
+
+    cubes = []
+    for name, stat in stats.items():
+        # collapse the times of the season, or of each year of it,
+        # and put in the statistic
+        if by_year:
+            cube_stat = template.aggregated_by(
+                "season_year", aggregators[name], **kwargs.get(name, {})
+            )
+        else:
+            cube_stat = template.collapsed(
+                "time", aggregators[name], **kwargs.get(name, {})
+            )
+        cube_stat.data = season_stat(stat)
+
+        # and how far out an approximate percentile may be
+        if name == "percentile" and pc_error is not None:
+            error = iris.coords.AncillaryVariable(
+                season_stat(pc_error),
+                long_name="percentile_error",
+                units=template.units,
+            )
+            cube_stat.add_ancillary_variable(error, tuple(range(cube_stat.ndim)))
+
+        # add a coord describing the season
+        aux_seas = iris.coords.AuxCoord(season[0], long_name="season", units="no_unit")
+        cube_stat.add_aux_coord(aux_seas)
+
+        aux_seas_fullname = iris.coords.AuxCoord(
+            season[1], long_name="season_fullname", units="no_unit"
+        )
+        cube_stat.add_aux_coord(aux_seas_fullname)
+
+        # and the metric, if there are several
+        if metric_coord:
+            aux_metric = iris.coords.AuxCoord(name, long_name="metric", units="no_unit")
+            cube_stat.add_aux_coord(aux_metric)
+
+        cubes.append(cube_stat)
+
+    return cubes
 
 
 def seas_time_stat(
@@ -449,6 +4691,8 @@ def seas_time_stat(
     pc=[],
     years=[],
     ext_area=[],
+    by_year=False,
+    pc_bins=None,
 ):
     """
     Takes in a cube and calculates a seasonal metric. Defaults to
@@ -463,18 +4707,29 @@ def seas_time_stat(
     seas_mons: list of seasons to calculate the metric over,
              defaults to seas_mons=[[3,4,5],[6,7,8],[9,10,11],[12,1,2]].
     metric: string, optional argument, defaults to 'mean', but can
-          be 'mean', 'std_dev', 'min', 'max' or 'percentile'
+          be 'mean', 'std_dev', 'min', 'max' or 'percentile', or a
+          list of them, e.g. ['mean', 'max'].
     pc: optional argument, percentile level to calculate,
        must be an integer and must be set if metric='percentile'.
     years: list of start and end year, default is
            the whole time span of the cube.
     ext_area: optional argument, if set expects a list of
             the form [lonmin, lonmax, latmin, latmax].
+    by_year: optional argument, if True the metric is calculated
+             for each season of each year, rather than over all
+             years together. Defaults to False.
+    pc_bins: optional argument, if set the percentile is approximated
+             from a histogram of this many bins for each grid point,
+             see PercentileSketch, rather than worked out exactly.
 
     Returns
     -------
     cube_list: a cube list containing one cube per
-             season of the calculated metric
+             season of the calculated metric, or if metric
+             is a list, one cube per season and metric, with
+             a coord 'metric' naming which. If by_year, each
+             cube has a time dimension of the years of the
+             season, with a coord 'season_year'.
 
     Notes
     -----
@@ -483,7 +4738,37 @@ def seas_time_stat(
     i.e. djf, and will calculate the metric over all months
     that meet the season criteria. For calculation
     where continuous seasons are important
-    iris.aggregated_by is better.
+    use by_year.
+
+    With by_year, a season that spans the new year, e.g. djf, is counted
+    in the year it ends, so December 2000 is in djf 2001 with January and
+    February 2001, and years is then a range of these season years. The
+    first and last seasons may only be partly in the cube, and are worked
+    out from the months there are.
+
+    The times of the cube are decoded to months and years once, and the
+    times of every season found from them, so all the seasons are worked
+    out from one pass over the data rather than an extraction each.
+    Several metrics are worked out from that one pass too, sharing their
+    sums, and one sort of each season for the percentile, minimum and
+    maximum, so ask for them together rather than one at a time.
+    If the cube has lazy data, e.g. straight from iris.load, no data is
+    read here: the statistics are lazy too, and worked out one block of
+    the other dimensions at a time when they are used. The area of
+    ext_area and the times of the seasons are picked out as slices before
+    then, so only those parts of the file are ever read. The statistics
+    of several metrics share their reads if they are realised together,
+    e.g. with cube_list.realise_data().
+
+    Exact percentiles need every time of a season at once. With pc_bins,
+    the percentile is instead approximated from a histogram of each grid
+    point, sketched one chunk of times at a time and merged, so e.g. the
+    99th percentile of a long hourly run can be found a chunk at a time.
+    The most it can be out by is added to its cube as an ancillary
+    variable 'percentile_error'. The bins are all the same width, so the
+    error is about 4 / pc_bins of the range of the data, which for
+    heavy-tailed data, e.g. hourly precipitation, can be much of the size
+    of the percentile itself.
 
     See an example:
 
@@ -506,6 +4791,15 @@ lat and lon
     Calculating mean for 2000-2001 jja
     Calculating mean for 2000-2001 jjas
     Calculating mean for 2000-2001 on
+    >>> seas_stats_cubelist = seas_time_stat(cube, seas_mons=[[6,7,8]], \
+metric=['mean', 'max'], years=[2000,2000])
+    Calculating mean, max for 2000-2000 jja
+    >>> print(seas_stats_cubelist[1].coord('metric').points)
+    ['max']
+    >>> djf_cubelist = seas_time_stat(cube, seas_mons=[[12,1,2]], by_year=True)
+    Calculating mean for 2000-2001 djf
+    >>> print(djf_cubelist[0].coord('season_year').points)
+    [2000 2001]
     >>> # now load a gcm cube
     ... cube2 = iris.load_cube(file2)
     >>> seas_pc_cubelist = seas_time_stat(cube2, seas_mons=[[11]], \
@@ -557,6 +4851,8 @@ bound=(2000-06-01 00:00:00, 2000-09-01 00:00:00)
                 time_info.units.num2date(time_info.bounds[-1][1]).year,
             ]
 
+        source = cube.core_data()
+        area_index = {}
         if ext_area:
             # check the coordinate system of the cube
             cs_str = str(cube.coord_system())
@@ -573,20 +4869,26 @@ bound=(2000-06-01 00:00:00, 2000-09-01 00:00:00)
                 )
             else:
                 if "grid_latitude" in coord_names:
-                    cube = cube.intersection(
-                        grid_longitude=(ext_area[0], ext_area[1]),
-                        grid_latitude=(ext_area[2], ext_area[3]),
-                    )
+                    area = {
+                        "grid_longitude": (ext_area[0], ext_area[1]),
+                        "grid_latitude": (ext_area[2], ext_area[3]),
+                    }
                 elif "latitude" in coord_names:
-                    cube = cube.intersection(
-                        longitude=(ext_area[0], ext_area[1]),
-                        latitude=(ext_area[2], ext_area[3]),
-                    )
+                    area = {
+                        "longitude": (ext_area[0], ext_area[1]),
+                        "latitude": (ext_area[2], ext_area[3]),
+                    }
                 else:
                     raise IndexError(
                         "Neither latitude nor grid_latitude coordinates in "
                         "cube, can't extract area"
                     )
+                # for lazy data, only the indices of the area are found
+                # here, to be read along with the times of the seasons
+                if cube.has_lazy_data():
+                    cube, area_index = _intersection_index(cube, area)
+                else:
+                    cube = cube.intersection(**area)
 
         # dictionary of month number to month letter, used to make strings
         # of season names e.g. 'jja'
@@ -619,10 +4921,64 @@ bound=(2000-06-01 00:00:00, 2000-09-01 00:00:00)
             12: "dec",
         }
 
+        # the aggregator for the metadata of each collapsed season
+        aggregators = {
+            "mean": iris.analysis.MEAN,
+            "std_dev": iris.analysis.STD_DEV,
+            "min": iris.analysis.MIN,
+            "max": iris.analysis.MAX,
+            "percentile": iris.analysis.PERCENTILE,
+        }
+        metrics = [metric] if isinstance(metric, str) else list(metric)
+        for name in metrics:
+            if name not in aggregators:
+                raise ValueError(
+                    "metric must be 'mean', 'std_dev', 'min', 'max' or "
+                    "'percentile', not {}".format(name)
+                )
+        kwargs = {}
+        if "percentile" in metrics:
+            if not pc:
+                raise ValueError("percentile to calculate, pc, is not set.")
+            if not isinstance(pc, int):
+                raise TypeError(
+                    " pc must be an integer, it is currently {} of type {}".format(
+                        pc, type(pc)
+                    )
+                )
+            kwargs["percentile"] = {"percent": pc}
+
+        # decode the times once, and find the times of all the seasons
+        months, point_years = _month_year(cube.coord("time"))
+        index, offsets, group_season, index_years = _season_index(
+            months, point_years, seas_mons, years, by_year=by_year
+        )
+
+        # reduce every season, for every metric, in one pass over the data,
+        # or for lazy data, in one pass over each block of it
+        tdim = cube.coord_dims("time")[0]
+        data = cube.core_data()
+        data_index = index
+        if cube.has_lazy_data():
+            # pick out the area and the times of the seasons together, from
+            # the data as it was given, so that they are all that is read
+            data = _take(source, {**area_index, tdim: index})
+            data_index = np.arange(len(index))
+        data = np.moveaxis(data, tdim, 0)
+        stats, pc_error = _season_stats(
+            data, data_index, offsets, metrics, aggregators, kwargs, pc, pc_bins
+        )
+
+        # a copy of the cube without its data, to collapse for the coords
+        template = cube.copy(
+            data=da.zeros(cube.shape, dtype=cube.dtype, chunks=cube.shape)
+        )
+        ends = np.append(offsets[1:], len(index))
+
         cube_list = iris.cube.CubeList()
 
         # loop round the seasons
-        for season in seas_mons:
+        for i, season in enumerate(seas_mons):
             # make strings of the season
             seas_str = []
             seas_fullname_str = []
@@ -637,69 +4993,41 @@ bound=(2000-06-01 00:00:00, 2000-09-01 00:00:00)
             print(
                 (
                     "Calculating {} for {}-{} {}".format(
-                        metric, str(years[0]), str(years[1]), season_string
+                        ", ".join(metrics), str(years[0]), str(years[1]), season_string
                     )
                 )
             )
 
-            # set up an iris constraint for the season
-            season_constraint = iris.Constraint(
-                time=lambda cell: cell.point.month in season
-            )
-            # year constraint
-            year_constraint = iris.Constraint(
-                time=lambda cell: years[0] <= cell.point.year <= years[1]
-            )
-            # extract the data matching the season and year constraints
-            season_cube = cube.extract(year_constraint & season_constraint)
-
-            # make sure season_cube exists
-            if season_cube is None:
-                raise Exception(
-                    "Cube constriants of seas_mons and/or years do not match "
-                    "data in the input cube"
+            groups = np.flatnonzero(group_season == i)
+            start, end = offsets[groups[0]], ends[groups[-1]]
+            slices = [slice(None)] * cube.ndim
+            slices[tdim] = index[start:end]
+            season_template = template[tuple(slices)]
+            if by_year:
+                aux_year = iris.coords.AuxCoord(
+                    index_years[start:end], long_name="season_year", units="1"
+                )
+                season_template.add_aux_coord(aux_year, tdim)
+
+            def season_stat(stat):
+                # the statistic of the season, or of each year of it
+                if by_year:
+                    return np.moveaxis(stat[groups[0] : groups[-1] + 1], 0, tdim)
+                return stat[i]
+
+            cube_list.extend(
+                _season_cubes(
+                    season_template,
+                    season_stat,
+                    stats,
+                    aggregators,
+                    kwargs,
+                    by_year=by_year,
+                    season=(season_string, season_fullname_string),
+                    pc_error=pc_error,
+                    metric_coord=not isinstance(metric, str),
                 )
-
-            # calculate a time mean
-            if metric == "mean":
-                cube_stat = season_cube.collapsed("time", iris.analysis.MEAN)
-            # calculate standard deviation (D.O.F=1)
-            if metric == "std_dev":
-                cube_stat = season_cube.collapsed("time", iris.analysis.STD_DEV)
-            # calculate minimum
-            if metric == "min":
-                cube_stat = season_cube.collapsed("time", iris.analysis.MIN)
-            # calculate maximum
-            if metric == "max":
-                cube_stat = season_cube.collapsed("time", iris.analysis.MAX)
-            # calculate percentile
-            if metric == "percentile":
-                if not pc:
-                    raise ValueError("percentile to calculate, pc, is not set.")
-                if isinstance(pc, int):
-                    cube_stat = season_cube.collapsed(
-                        "time", iris.analysis.PERCENTILE, percent=pc
-                    )
-                else:
-                    raise TypeError(
-                        " pc must be an integer, it is currently {} of type {}".format(
-                            pc, type(pc)
-                        )
-                    )
-
-            # add a coord describing the season
-            aux_seas = iris.coords.AuxCoord(
-                season_string, long_name="season", units="no_unit"
-            )
-            cube_stat.add_aux_coord(aux_seas)
-
-            aux_seas_fullname = iris.coords.AuxCoord(
-                season_fullname_string, long_name="season_fullname", units="no_unit"
             )
-            cube_stat.add_aux_coord(aux_seas_fullname)
-
-            # add seasonal statistic of cube to cube list
-            cube_list.append(cube_stat)
 
     return cube_list
 
@@ -40,3 +40,6 @@ DATA_DIR = os.path.join(ROOT_PATH, "data")
 
 # The full path of the KGO dir
 KGO_DIR = os.path.join(ROOT_PATH, "kgo")
+
+# The number of regridders kept in memory by analysis.regrid_to_target
+REGRID_CACHE_SIZE = 8
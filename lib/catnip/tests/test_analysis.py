@@ -31,10 +31,14 @@
 # -----------------------------------------------------------------------------
 
 import os
+import tempfile
 import unittest
 import numpy as np
 import iris
+import iris.coord_categorisation
 from catnip.analysis import *
+from catnip.analysis import _source_subset
+from catnip.preparation import add_aux_unrotated_coords
 import catnip.config as conf
 
 
@@ -112,6 +116,282 @@ class TestAnalysis(unittest.TestCase):
         y = np.array([5, 6, 2, 9, 1, 4, 7])
         self.assertRaises(ValueError, ci_interval, x, y)
 
+    def test_linear_regress_cube(self):
+
+        cube = self.mslp_daily_cube[:, :10, :10]
+        grad_cube, intcp_cube, sum_res_cube = linear_regress_cube(cube)
+        self.assertEqual(grad_cube.shape, (10, 10))
+        self.assertEqual(intcp_cube.shape, (10, 10))
+        self.assertEqual(sum_res_cube.shape, (10, 10))
+        self.assertEqual(grad_cube.coord("grid_latitude"), cube.coord("grid_latitude"))
+
+        # compare a grid point with the 1D regression
+        x = cube.coord("time").points
+        grad, intcp, xp, yp, sum_res = linear_regress(x, cube.data[:, 3, 7])
+        np.testing.assert_allclose(grad_cube.data[3, 7], grad)
+        np.testing.assert_allclose(intcp_cube.data[3, 7], intcp)
+        np.testing.assert_allclose(sum_res_cube.data[3, 7], sum_res[0], rtol=1e-6)
+
+        self.assertRaises(TypeError, linear_regress_cube, "cube")
+        self.assertRaises(ValueError, linear_regress_cube, cube[:1])
+
+    def test_linear_regress_cube_lazy(self):
+
+        file4 = os.path.join(conf.DATA_DIR, "mslp.daily.rcm.viet.nc")
+        lazy_cube = iris.load_cube(file4)
+        real_cube = lazy_cube.copy(data=lazy_cube.core_data().compute())
+        self.assertTrue(lazy_cube.has_lazy_data())
+
+        lazy_results = linear_regress_cube(lazy_cube)
+        lazy_results += ci_interval_cube(lazy_cube)
+        self.assertTrue(lazy_cube.has_lazy_data())
+
+        real_results = linear_regress_cube(real_cube)
+        real_results += ci_interval_cube(real_cube)
+        for lazy_result, real_result in zip(lazy_results, real_results):
+            self.assertFalse(lazy_result.has_lazy_data())
+            np.testing.assert_allclose(lazy_result.data, real_result.data)
+
+    def test_linear_regress_cube_masked(self):
+
+        cube = self.mslp_daily_cube[:, :10, :10].copy()
+        mask = np.zeros(cube.shape, dtype=bool)
+        mask[::3, 3, 7] = True
+        mask[2:, 0, 0] = True
+        cube.data = np.ma.masked_array(cube.data, mask=mask)
+
+        grad_cube, intcp_cube, sum_res_cube = linear_regress_cube(cube)
+        slope_ci_cube, intcp_ci_cube = ci_interval_cube(cube)
+
+        # a grid point with gaps matches the 1D regression of its valid points
+        x = cube.coord("time").points[~mask[:, 3, 7]]
+        y = cube.data.data[~mask[:, 3, 7], 3, 7]
+        grad, intcp, xp, yp, sum_res = linear_regress(x, y)
+        slope_conf_int, intcp_conf_int = ci_interval(x, y)[:2]
+        np.testing.assert_allclose(grad_cube.data[3, 7], grad)
+        np.testing.assert_allclose(intcp_cube.data[3, 7], intcp)
+        np.testing.assert_allclose(slope_ci_cube.data[3, 7], slope_conf_int)
+        np.testing.assert_allclose(intcp_ci_cube.data[3, 7], intcp_conf_int)
+
+        # a grid point with fewer than min_samples points is masked
+        self.assertTrue(grad_cube.data.mask[0, 0])
+        self.assertTrue(slope_ci_cube.data.mask[0, 0])
+        self.assertFalse(grad_cube.data.mask[3, 7])
+        grad_cube = linear_regress_cube(cube, min_samples=2)[0]
+        self.assertFalse(np.ma.is_masked(grad_cube.data[0, 0]))
+
+    def test_linear_regress_cube_float32(self):
+
+        cube = self.mslp_daily_cube[:, :10, :10]
+        cube = cube.copy(data=cube.data.astype(np.float32))
+        grad_cube = linear_regress_cube(cube)[0]
+        grad_cube32 = linear_regress_cube(cube, dtype=np.float32)[0]
+        self.assertEqual(grad_cube32.dtype, np.float32)
+        np.testing.assert_allclose(grad_cube32.data, grad_cube.data, rtol=1e-4)
+
+        slope_ci_cube = ci_interval_cube(cube)[0]
+        slope_ci_cube32 = ci_interval_cube(cube, dtype=np.float32)[0]
+        self.assertEqual(slope_ci_cube32.dtype, np.float32)
+        np.testing.assert_allclose(slope_ci_cube32.data, slope_ci_cube.data, rtol=1e-4)
+
+        self.assertRaises(ValueError, linear_regress_cube, cube, dtype=np.int32)
+
+    def test_ci_interval_batch(self):
+
+        x = np.array([1, 4, 2, 7, 0, 6, 3, 2, 1, 9])
+        y = np.array([[5, 6, 2, 9, 1, 4, 7, 8, 2, 3], [1, 4, 2, 8, 0, 7, 3, 2, 1, 9]])
+        slope_conf_int, intcp_conf_int = ci_interval_batch(x, y)
+
+        self.assertEqual(slope_conf_int.shape, (2,))
+        self.assertEqual(float("%.3f" % slope_conf_int[0]), 0.726)
+        self.assertEqual(float("%.3f" % intcp_conf_int[0]), 3.254)
+
+        # the plotting vectors match those of ci_interval
+        batch = ci_interval_batch(x, y, plot_pts=True)
+        single = ci_interval(x, y[1])
+        self.assertEqual(len(batch), len(single))
+        np.testing.assert_allclose(batch[3][1], single[3])
+        np.testing.assert_allclose(batch[6][1], single[6])
+
+        self.assertRaises(ValueError, ci_interval_batch, x, y[:, :5])
+
+    def test_ci_interval_cube(self):
+
+        cube = self.mslp_daily_cube[:, :10, :10]
+        slope_ci_cube, intcp_ci_cube = ci_interval_cube(cube)
+        self.assertEqual(slope_ci_cube.shape, (10, 10))
+        self.assertEqual(intcp_ci_cube.shape, (10, 10))
+
+        x = cube.coord("time").points
+        slope_conf_int, intcp_conf_int = ci_interval(x, cube.data[:, 3, 7])[:2]
+        np.testing.assert_allclose(slope_ci_cube.data[3, 7], slope_conf_int)
+        np.testing.assert_allclose(intcp_ci_cube.data[3, 7], intcp_conf_int)
+
+        self.assertRaises(TypeError, ci_interval_cube, "cube")
+
+    def test_regression_accumulator(self):
+
+        cube = self.mslp_daily_cube[:, :10, :10]
+        grad_cube, intcp_cube, sum_res_cube = linear_regress_cube(cube)
+        slope_ci_cube, intcp_ci_cube = ci_interval_cube(cube)
+
+        # accumulate the cube in two separate pieces then merge
+        acc1 = RegressionAccumulator()
+        acc1.update_cube(cube[:100])
+        acc2 = RegressionAccumulator()
+        acc2.update_cube(cube[100:200])
+        acc2.update_cube(cube[200:])
+        acc1.merge(acc2)
+        np.testing.assert_array_equal(acc1.n, cube.shape[0])
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "acc.npz")
+            acc1.save(filename)
+            acc = RegressionAccumulator.load(filename)
+
+        grad, intcp, sum_res = acc.linear_regress()
+        np.testing.assert_allclose(grad, grad_cube.data)
+        np.testing.assert_allclose(intcp, intcp_cube.data)
+        slope_conf_int, intcp_conf_int = acc.ci_interval()
+        np.testing.assert_allclose(slope_conf_int, slope_ci_cube.data)
+        np.testing.assert_allclose(intcp_conf_int, intcp_ci_cube.data)
+
+        self.assertRaises(ValueError, RegressionAccumulator().linear_regress)
+        self.assertRaises(ValueError, acc.update_cube, self.mslp_daily_cube)
+        self.assertRaises(TypeError, acc.merge, "acc")
+
+    def test_rolling_trend_cube(self):
+
+        cube = self.mslp_daily_cube[:, :10, :10]
+        window = 10
+        grad_cube, slope_ci_cube = rolling_trend_cube(cube, window)
+        nwindow = cube.shape[0] - window + 1
+        self.assertEqual(grad_cube.shape, (nwindow, 10, 10))
+        self.assertEqual(slope_ci_cube.shape, (nwindow, 10, 10))
+
+        # each window matches fitting it on its own
+        xi = cube.coord("time").points
+        for start in [0, nwindow - 1]:
+            x_win = xi[start : start + window]
+            y_win = cube.data[start : start + window, 3, 7]
+            grad, intcp, xp, yp, sum_res = linear_regress(x_win, y_win)
+            slope_ci, intcp_ci = ci_interval(x_win, y_win)[:2]
+            np.testing.assert_allclose(grad_cube.data[start, 3, 7], grad)
+            np.testing.assert_allclose(slope_ci_cube.data[start, 3, 7], slope_ci)
+            self.assertEqual(grad_cube.coord("time").points[start], x_win[0])
+            self.assertEqual(grad_cube.coord("time").bounds[start, 1], x_win[-1])
+
+        self.assertRaises(ValueError, rolling_trend_cube, cube, 1)
+        self.assertRaises(TypeError, rolling_trend_cube, "cube", window)
+
+    def test_ci_interval_bootstrap(self):
+
+        x = np.array([1, 4, 2, 7, 0, 6, 3, 2, 1, 9])
+        y = np.array([5, 6, 2, 9, 1, 4, 7, 8, 2, 3])
+        slope_lo, slope_hi, intcp_lo, intcp_hi = ci_interval_bootstrap(x, y, seed=0)
+        grad, intcp, xp, yp, sum_res = linear_regress(x, y)
+        self.assertTrue(slope_lo < grad < slope_hi)
+        self.assertTrue(intcp_lo < intcp < intcp_hi)
+
+        # the same seed gives the same answer
+        self.assertEqual(ci_interval_bootstrap(x, y, seed=0)[0], slope_lo)
+
+        # gridded input, shared between processes with a block bootstrap
+        cube = self.mslp_daily_cube[:, :4, :5]
+        yi = np.moveaxis(cube.data, 0, -1)
+        xi = cube.coord("time").points
+        bounds = ci_interval_bootstrap(xi, yi, nboot=200, block_size=5, seed=1)
+        bounds_pool = ci_interval_bootstrap(
+            xi, yi, nboot=200, block_size=5, seed=1, processes=2
+        )
+        self.assertEqual(bounds[0].shape, (4, 5))
+        for bound, bound_pool in zip(bounds, bounds_pool):
+            np.testing.assert_allclose(bound, bound_pool)
+
+        self.assertRaises(ValueError, ci_interval_bootstrap, x, y[:5])
+        self.assertRaises(ValueError, ci_interval_bootstrap, x, y, block_size=11)
+
+    def test_theil_sen(self):
+
+        x = np.array([1, 2, 3, 4, 5, 6, 7, 8, 9, 10])
+        y = np.array([2, 4, 6, 8, 10, 12, 14, 16, 18, 100])
+        grad, intcp = theil_sen(x, y)
+        self.assertEqual(float("%.3f" % grad), 2.0)
+        self.assertEqual(float("%.3f" % intcp), 0.0)
+
+        # both algorithms give the same answer
+        cube = self.mslp_daily_cube[:, :3, :4]
+        xi = cube.coord("time").points
+        yi = np.moveaxis(cube.data, 0, -1)
+        grad, intcp = theil_sen(xi, yi, method="pairwise")
+        grad_bisect, intcp_bisect = theil_sen(xi, yi, method="bisect")
+        self.assertEqual(grad.shape, (3, 4))
+        np.testing.assert_allclose(grad, grad_bisect, rtol=1e-8)
+        np.testing.assert_allclose(intcp, intcp_bisect, rtol=1e-8)
+
+        self.assertRaises(ValueError, theil_sen, x, y[:5])
+        self.assertRaises(ValueError, theil_sen, np.ones(10), y)
+        self.assertRaises(ValueError, theil_sen, x, y, method="median")
+
+    def test_mann_kendall(self):
+
+        x = np.array([1, 2, 3, 4, 5, 6, 7, 8, 9, 10])
+        y = np.array([2, 4, 6, 8, 10, 12, 14, 16, 18, 100])
+        z, pval = mann_kendall(x, y)
+        self.assertEqual(float("%.3f" % z), 3.935)
+        self.assertTrue(pval < 0.001)
+
+        z, pval = mann_kendall(x, y[::-1])
+        self.assertEqual(float("%.3f" % z), -3.935)
+
+        cube = self.mslp_daily_cube[:, :3, :4]
+        xi = cube.coord("time").points
+        yi = np.moveaxis(cube.data, 0, -1)
+        z, pval = mann_kendall(xi, yi, method="pairwise")
+        z_bisect, pval_bisect = mann_kendall(xi, yi, method="bisect")
+        np.testing.assert_allclose(z, z_bisect)
+        np.testing.assert_allclose(pval, pval_bisect)
+
+    def test_theil_sen_cube(self):
+
+        cube = self.mslp_daily_cube[:, :4, :4]
+        grad_cube, intcp_cube, pval_cube = theil_sen_cube(cube)
+        self.assertEqual(grad_cube.shape, (4, 4))
+        self.assertEqual(pval_cube.shape, (4, 4))
+
+        grad, intcp = theil_sen(cube.coord("time").points, cube.data[:, 1, 2])
+        np.testing.assert_allclose(grad_cube.data[1, 2], grad)
+
+        # sharing the grid points between processes gives the same answer
+        grad_cube_pool = theil_sen_cube(cube, processes=2)[0]
+        np.testing.assert_allclose(grad_cube.data, grad_cube_pool.data)
+
+        self.assertRaises(TypeError, theil_sen_cube, "cube")
+
+    def test_correlate_index(self):
+
+        cube = self.mslp_daily_cube[:, :10, :10]
+        index = cube.data[:, 0, 0]
+        corr_cube, regress_cube, pval_cube = correlate_index(cube, index)
+        self.assertEqual(corr_cube.shape, (10, 10))
+        self.assertAlmostEqual(corr_cube.data[0, 0], 1.0)
+        np.testing.assert_allclose(
+            corr_cube.data[3, 4], np.corrcoef(index, cube.data[:, 3, 4])[0, 1]
+        )
+        grad, intcp, xp, yp, sum_res = linear_regress(index, cube.data[:, 3, 4])
+        np.testing.assert_allclose(regress_cube.data[3, 4], grad)
+        self.assertTrue(np.all((pval_cube.data >= 0) & (pval_cube.data <= 1)))
+
+        # lazy data gives the same maps
+        file4 = os.path.join(conf.DATA_DIR, "mslp.daily.rcm.viet.nc")
+        lazy_cube = iris.load_cube(file4)
+        lazy_corr = correlate_index(lazy_cube[:, :10, :10], index)[0]
+        self.assertTrue(lazy_cube.has_lazy_data())
+        np.testing.assert_allclose(lazy_corr.data, corr_cube.data)
+
+        self.assertRaises(ValueError, correlate_index, cube, index[:-1])
+        self.assertRaises(TypeError, correlate_index, "cube", index)
+
     def test_regrid_to_target(self):
 
         gcm_cube = self.gcm_t_cube.copy()
@@ -150,6 +430,32 @@ class TestAnalysis(unittest.TestCase):
         self.assertRaises(TypeError, regrid_to_target, gcm_cube, "target_cube")
         self.assertRaises(TypeError, regrid_to_target, "cube", rcm_cube)
 
+    def test_regrid_cache(self):
+
+        regrid_cache_clear()
+        self.assertEqual(regrid_cache_info().currsize, 0)
+
+        # the weights are worked out once for the loop
+        for month in range(2):
+            cube_reg = regrid_to_target(self.rcm_t_cube[month], self.gcm_t_cube)
+        info = regrid_cache_info()
+        self.assertEqual((info.hits, info.misses, info.currsize), (1, 1, 1))
+        self.assertEqual(cube_reg.shape, self.gcm_t_cube.shape)
+
+        regrid_to_target(self.rcm_t_cube, self.gcm_t_cube, "nearest")
+        self.assertEqual(regrid_cache_info().misses, 2)
+
+        # a target without bounds, which are guessed, is found the second time
+        target = self.gcm_t_cube[..., ::2, ::2].copy()
+        for coord in target.coords(dim_coords=True):
+            coord.bounds = None
+        for month in range(2):
+            regrid_to_target(self.gcm_t_cube, target, "areaweighted")
+        self.assertEqual(regrid_cache_info()[:2], (2, 3))
+
+        regrid_cache_clear()
+        self.assertEqual(regrid_cache_info(), (0, 0, conf.REGRID_CACHE_SIZE, 0))
+
     def test_set_regridder(self):
 
         gcm_cube = self.gcm_t_cube.copy()
@@ -166,6 +472,232 @@ class TestAnalysis(unittest.TestCase):
         self.assertRaises(TypeError, set_regridder, "gcm_cube", rcm_cube)
         self.assertRaises(TypeError, set_regridder, gcm_cube, "rcm_cube")
 
+    def test_regrid_to_target_subset(self):
+
+        # areaweighted needs a regional target on the grid of the source
+        box = self.gcm_t_cube[..., 40:80, 50:100]
+        ny, nx = self.gcm_t_cube.shape[-2:]
+        schemes = {
+            "linear": iris.analysis.Linear(extrapolation_mode="mask"),
+            "nearest": iris.analysis.Nearest(extrapolation_mode="mask"),
+            "areaweighted": iris.analysis.AreaWeighted(mdtol=0.5),
+            "conservative": None,
+        }
+        for method, scheme in schemes.items():
+            target = box if method == "areaweighted" else self.rcm_t_cube
+
+            # the weights are worked out on a part of the global source only
+            grid_cube, yindex, xindex = _source_subset(self.gcm_t_cube, target)
+            self.assertEqual(grid_cube.shape, (len(yindex), len(xindex)))
+            self.assertTrue(grid_cube.data.size < 0.5 * ny * nx)
+            regridder = set_regridder(self.gcm_t_cube, [target], method).regridder(0)
+            used = np.unique(regridder.weights.indices)
+            self.assertTrue(np.all(np.isin(used, np.add.outer(yindex * nx, xindex))))
+
+            # which gives the same result as iris regridding the whole globe
+            cube_reg = regrid_to_target(self.gcm_t_cube, target, method)
+            if scheme is not None:
+                cube_iris = self.gcm_t_cube.regrid(target, scheme)
+                np.testing.assert_array_equal(
+                    np.ma.getmaskarray(cube_reg.data),
+                    np.ma.getmaskarray(cube_iris.data),
+                )
+                np.testing.assert_allclose(
+                    np.ma.compressed(cube_reg.data),
+                    np.ma.compressed(cube_iris.data),
+                    rtol=1e-10,
+                )
+
+    def test_regrid_to_target_lazy(self):
+
+        file4 = os.path.join(conf.DATA_DIR, "mslp.daily.rcm.viet.nc")
+        lazy_cube = iris.load_cube(file4)
+        real_cube = lazy_cube.copy(data=lazy_cube.core_data().compute())
+
+        # areaweighted needs a target on the same coordinate system
+        coarse = real_cube[..., ::2, ::2]
+        for coord in coarse.coords(dim_coords=True):
+            coord.bounds = None
+            coord.guess_bounds()
+
+        for method in ["linear", "nearest", "areaweighted", "conservative", "kdtree"]:
+            target = coarse if method == "areaweighted" else self.gcm_t_cube
+            lazy_reg = regrid_to_target(lazy_cube, target, method)
+            self.assertTrue(lazy_cube.has_lazy_data())
+            self.assertTrue(lazy_reg.has_lazy_data())
+
+            real_reg = regrid_to_target(real_cube, target, method)
+            self.assertEqual(lazy_reg.dtype, real_reg.dtype)
+            np.testing.assert_array_equal(lazy_reg.data, real_reg.data)
+
+    def test_regrid_cubelist(self):
+
+        cubes = iris.cube.CubeList([self.gcm_cfrac_cube, self.gcm_t_cube])
+        regrid_cache_clear()
+
+        for workers, pool in [(None, "thread"), (2, "thread"), (2, "process")]:
+            cubes_reg = regrid_cubelist(
+                cubes, self.rcm_t_cube, workers=workers, pool=pool
+            )
+            for cube, cube_reg in zip(cubes, cubes_reg):
+                self.assertEqual(cube_reg.name(), cube.name())
+                np.testing.assert_array_equal(
+                    cube_reg.data, regrid_to_target(cube, self.rcm_t_cube).data
+                )
+
+        # both cubes are on one grid, so share one set of weights
+        self.assertEqual(regrid_cache_info().misses, 1)
+
+        self.assertRaises(TypeError, regrid_cubelist, self.gcm_t_cube, self.rcm_t_cube)
+        self.assertRaises(
+            ValueError, regrid_cubelist, cubes, self.rcm_t_cube, workers=2, pool="x"
+        )
+
+    def test_regrid_vector(self):
+
+        regrid_cache_clear()
+        u_reg, v_reg = regrid_vector(self.rcm_u_cube, self.rcm_v_cube, self.gcm_t_cube)
+        # one set of weights, worked out once, for both components
+        self.assertEqual(regrid_cache_info()[:2], (0, 1))
+        self.assertEqual(u_reg.shape[-2:], self.gcm_t_cube.shape[-2:])
+        self.assertEqual(v_reg.name(), self.rcm_v_cube.name())
+
+        # the same as turning the winds on the source grid and then regridding
+        u_rot, v_rot = iris.analysis.cartography.rotate_winds(
+            self.rcm_u_cube, self.rcm_v_cube, self.gcm_t_cube.coord_system()
+        )
+        for cube_reg, cube_rot in [(u_reg, u_rot), (v_reg, v_rot)]:
+            for coord in cube_rot.coords(dim_coords=False):
+                if coord.name().startswith("projection"):
+                    cube_rot.remove_coord(coord)
+            cube_ref = regrid_to_target(cube_rot, self.gcm_t_cube)
+            np.testing.assert_allclose(
+                np.ma.filled(cube_reg.data, 0.0),
+                np.ma.filled(cube_ref.data, 0.0),
+                atol=1e-2,
+            )
+
+        self.assertRaises(
+            ValueError, regrid_vector, self.rcm_u_cube, self.rcm_t_cube, self.gcm_t_cube
+        )
+
+    def test_kdtree_regridder(self):
+
+        cube = self.mslp_daily_cube[:5]
+        regridder = set_regridder(cube, self.gcm_t_cube, "kdtree")
+        self.assertIsInstance(regridder, KDTreeRegridder)
+        cube_reg = regridder(cube)
+        self.assertEqual(cube_reg.shape, (5,) + self.gcm_t_cube.shape[-2:])
+
+        # nearly always the same points as iris, which measures distance
+        # in degrees rather than on the sphere
+        cube_iris = cube.regrid(
+            self.gcm_t_cube, iris.analysis.Nearest(extrapolation_mode="mask")
+        )
+        both = ~np.ma.getmaskarray(cube_reg.data) & ~np.ma.getmaskarray(cube_iris.data)
+        self.assertTrue(np.mean(cube_reg.data[both] == cube_iris.data[both]) > 0.99)
+
+        # a curvilinear grid, with only 2-D latitude and longitude, gives the same
+        aux_cube = add_aux_unrotated_coords(cube)
+        aux_cube.remove_coord("grid_latitude")
+        aux_cube.remove_coord("grid_longitude")
+        regrid_cache_clear()
+        aux_reg = regrid_to_target(aux_cube, self.gcm_t_cube, "kdtree")
+        np.testing.assert_array_equal(aux_reg.data, cube_reg.data)
+
+        # and regrid_to_target reuses its regridder from the cache
+        regrid_to_target(aux_cube[:2], self.gcm_t_cube, "kdtree")
+        self.assertEqual(regrid_cache_info()[:2], (1, 1))
+
+        self.assertRaises(ValueError, regridder, self.gcm_t_cube)
+        self.assertRaises(
+            ValueError, set_regridder, cube, self.gcm_t_cube, "kdtree", "error"
+        )
+
+    def test_multi_target_regridder(self):
+
+        cube = self.rcm_t_cube.copy()
+        targets = [self.gcm_t_cube, self.gcm_t_cube[..., ::2, ::2]]
+        for method in ["linear", "kdtree"]:
+            regridder = set_regridder(cube, targets, method)
+            self.assertIsInstance(regridder, MultiTargetRegridder)
+            cubes_reg = regridder(cube)
+            self.assertEqual(len(cubes_reg), 2)
+            for target, cube_reg in zip(targets, cubes_reg):
+                cube_ref = regrid_to_target(cube, target, method)
+                np.testing.assert_array_equal(
+                    np.ma.getmaskarray(cube_reg.data),
+                    np.ma.getmaskarray(cube_ref.data),
+                )
+                np.testing.assert_allclose(
+                    np.ma.compressed(cube_reg.data), np.ma.compressed(cube_ref.data)
+                )
+            self.assertIs(regridder.regridder(1), regridder.regridder(1))
+            self.assertRaises(ValueError, regridder, self.gcm_t_cube)
+
+    def test_conservative_regrid(self):
+
+        rcm_cube = self.rcm_t_cube.copy()
+        rcm_cube.data = np.ma.ones(rcm_cube.shape) * 5.0
+
+        # a constant field stays constant across the rotated pole
+        regridder = set_regridder(rcm_cube, self.gcm_t_cube, "conservative")
+        cube_reg = regridder(rcm_cube)
+        self.assertEqual(cube_reg.shape[-2:], self.gcm_t_cube.shape[-2:])
+        self.assertTrue(np.ma.count(cube_reg.data) > 0)
+        np.testing.assert_allclose(np.ma.compressed(cube_reg.data), 5.0)
+
+        # on one coordinate system it matches area weighted regridding
+        gcm_cube = self.gcm_t_cube.copy()
+        target = self.gcm_t_cube[..., ::2, ::2]
+        for coord in target.coords(dim_coords=True):
+            coord.bounds = None
+        cube_reg = regrid_to_target(gcm_cube, target, "conservative")
+        cube_aw = regrid_to_target(gcm_cube, target, "areaweighted")
+        np.testing.assert_allclose(cube_reg.data, cube_aw.data, rtol=1e-10)
+
+        self.assertRaises(
+            ValueError, regrid_to_target, rcm_cube, self.gcm_t_cube, "areaweighted"
+        )
+
+    def test_set_regridder_cache(self):
+
+        gcm_cube = self.gcm_t_cube.copy()
+        target = self.gcm_t_cube[..., ::2, ::2]
+        for coord in target.coords(dim_coords=True):
+            coord.bounds = None
+            coord.guess_bounds()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        cache_dir = tmpdir.name
+
+        # linear is quicker to set up with iris, so nothing is kept
+        set_regridder(gcm_cube, target, cache_dir=cache_dir)
+        self.assertEqual(os.listdir(cache_dir), [])
+
+        for method in ["areaweighted", "conservative"]:
+            cube_ref = regrid_to_target(self.gcm_cfrac_cube, target, method)
+            regridder = set_regridder(gcm_cube, target, method, cache_dir=cache_dir)
+            # the same as regridding without the cache
+            np.testing.assert_allclose(
+                regridder(self.gcm_cfrac_cube).data, cube_ref.data, rtol=1e-10
+            )
+
+        # one file of weights for each method, and no temporary files left
+        names = os.listdir(cache_dir)
+        self.assertEqual(len(names), 2)
+        for name in names:
+            self.assertTrue(name.startswith("regrid_") and name.endswith(".npz"))
+
+        # read back from the cache the second time
+        regridder2 = set_regridder(
+            gcm_cube, target, "conservative", cache_dir=cache_dir
+        )
+        self.assertEqual(len(os.listdir(cache_dir)), 2)
+        self.assertEqual((regridder2.weights != regridder.weights).nnz, 0)
+
+        self.assertRaises(ValueError, regridder, self.rcm_t_cube)
+
     def test_seas_time_stat(self):
 
         seas_min_cubelist = seas_time_stat(
@@ -219,6 +751,128 @@ class TestAnalysis(unittest.TestCase):
             IndexError, seas_time_stat, nolat_cube, ext_area=[340, 350, 0, 10]
         )
 
+        # every season from one pass gives the same as extracting each one
+        cube = self.mslp_daily_cube
+        seas_mons = [[12, 1, 2], [6, 7, 8], [6, 7, 8, 9]]
+        for metric, pc in [("std_dev", []), ("max", []), ("percentile", 90)]:
+            cubelist = seas_time_stat(cube, seas_mons=seas_mons, metric=metric, pc=pc)
+            for season, cube_stat in zip(seas_mons, cubelist):
+                season_cube = cube.extract(
+                    iris.Constraint(time=lambda cell: cell.point.month in season)
+                )
+                if metric == "percentile":
+                    cube_ref = season_cube.collapsed(
+                        "time", iris.analysis.PERCENTILE, percent=pc
+                    )
+                else:
+                    cube_ref = season_cube.collapsed(
+                        "time", getattr(iris.analysis, metric.upper())
+                    )
+                self.assertEqual(cube_stat.coord("time"), cube_ref.coord("time"))
+                np.testing.assert_allclose(cube_stat.data, cube_ref.data, rtol=1e-5)
+
+    def test_seas_time_stat_metrics(self):
+
+        metrics = ["mean", "std_dev", "min", "max", "percentile"]
+        cubelist = seas_time_stat(self.mslp_daily_cube, metric=metrics, pc=95)
+        self.assertEqual(len(cubelist), 4 * len(metrics))
+        for metric in metrics:
+            cubes = cubelist.extract(iris.Constraint(metric=metric))
+            cubes_ref = seas_time_stat(self.mslp_daily_cube, metric=metric, pc=95)
+            self.assertEqual(len(cubes), 4)
+            for cube_stat, cube_ref in zip(cubes, cubes_ref):
+                self.assertEqual(
+                    cube_stat.coord("season").points, cube_ref.coord("season").points
+                )
+                np.testing.assert_allclose(cube_stat.data, cube_ref.data)
+
+        self.assertRaises(
+            ValueError, seas_time_stat, self.mslp_daily_cube, metric=["mean", "median"]
+        )
+
+    def test_seas_time_stat_by_year(self):
+
+        cube = self.mslp_daily_cube.copy()
+        cubelist = seas_time_stat(cube, seas_mons=[[6, 7, 8], [12, 1, 2]], by_year=True)
+
+        # the same as aggregating by season year, with djf across the new year
+        cube_ref = cube.copy()
+        iris.coord_categorisation.add_season(cube_ref, "time")
+        iris.coord_categorisation.add_season_year(cube_ref, "time")
+        cube_ref = cube_ref.aggregated_by(["season", "season_year"], iris.analysis.MEAN)
+        for cube_stat in cubelist:
+            season = cube_stat.coord("season").points[0]
+            season_years = cube_stat.coord("season_year").points
+            season_ref = cube_ref.extract(iris.Constraint(season=season))
+            season_ref = season_ref[
+                np.isin(season_ref.coord("season_year").points, season_years)
+            ]
+            self.assertEqual(cube_stat.shape, season_ref.shape)
+            self.assertEqual(cube_stat.coord("time"), season_ref.coord("time"))
+            np.testing.assert_allclose(cube_stat.data, season_ref.data, rtol=1e-6)
+
+        # and lazy data stays lazy
+        cube.data = cube.lazy_data()
+        cubelist_lazy = seas_time_stat(
+            cube, seas_mons=[[6, 7, 8], [12, 1, 2]], by_year=True
+        )
+        self.assertTrue(cubelist_lazy[1].has_lazy_data())
+        np.testing.assert_allclose(cubelist_lazy[1].data, cubelist[1].data)
+
+    def test_seas_time_stat_lazy(self):
+
+        file4 = os.path.join(conf.DATA_DIR, "mslp.daily.rcm.viet.nc")
+        lazy_cube = iris.load_cube(file4)
+        real_cube = lazy_cube.copy(data=lazy_cube.core_data().compute())
+        lons = lazy_cube.coord("grid_longitude").points
+        lats = lazy_cube.coord("grid_latitude").points
+        ext_area = [lons[2], lons[8], lats[3], lats[10]]
+        metrics = ["mean", "max", "percentile"]
+
+        lazy_cubelist = seas_time_stat(
+            lazy_cube, metric=metrics, pc=90, ext_area=ext_area
+        )
+        self.assertTrue(lazy_cube.has_lazy_data())
+        self.assertTrue(all(cube.has_lazy_data() for cube in lazy_cubelist))
+
+        real_cubelist = seas_time_stat(
+            real_cube, metric=metrics, pc=90, ext_area=ext_area
+        )
+        lazy_cubelist.realise_data()
+        for lazy_stat, real_stat in zip(lazy_cubelist, real_cubelist):
+            self.assertEqual(lazy_stat.coords(), real_stat.coords())
+            np.testing.assert_allclose(lazy_stat.data, real_stat.data)
+
+    def test_percentile_sketch(self):
+
+        cube = self.mslp_daily_cube[:, :10, :10]
+        exact = np.percentile(cube.data, 99, axis=0)
+
+        # sketch the cube in two separate pieces then merge
+        sketch1 = PercentileSketch()
+        sketch1.update_cube(cube[:100])
+        sketch2 = PercentileSketch()
+        sketch2.update_cube(cube[100:])
+        sketch1.merge(sketch2)
+        np.testing.assert_array_equal(sketch1.n, cube.shape[0])
+        error = sketch1.percentile_error(99)
+        self.assertTrue(np.all(np.abs(sketch1.percentile(99) - exact) <= error))
+        self.assertTrue(np.all(error <= 0.02 * np.ptp(cube.data, axis=0)))
+
+        # and from seas_time_stat, with the error alongside
+        cube_stat = seas_time_stat(
+            cube, seas_mons=[[6, 7, 8]], metric="percentile", pc=99, pc_bins=256
+        )[0]
+        cube_exact = seas_time_stat(
+            cube, seas_mons=[[6, 7, 8]], metric="percentile", pc=99
+        )[0]
+        error = cube_stat.ancillary_variable("percentile_error").data
+        self.assertTrue(np.all(np.abs(cube_stat.data - cube_exact.data) <= error))
+
+        self.assertRaises(ValueError, PercentileSketch().percentile, 50)
+        self.assertRaises(ValueError, sketch1.update_cube, self.mslp_daily_cube)
+        self.assertRaises(TypeError, sketch1.merge, "sketch")
+
     def test_regular_point_to_rotated(self):
 
         reg_lon = 289